@@ -12,7 +12,8 @@ setup(name='smallfry',
       author='Avner May / Jian Zhang',
       author_email='zjian@stanford.edu',
       license='Apache Version 2',
-      install_requires = ['numpy',
-                          'torch']
+      python_requires='>=3.8',
+      install_requires = ['numpy>=1.17',
+                          'torch>=1.13']
                           
       )
\ No newline at end of file
@@ -0,0 +1,274 @@
+'''
+Benchmark suite for compression, loading and lookup of quantized embeddings.
+
+Run it with
+    python -m smallfry.benchmark --out results.json
+and compare two runs (e.g. two releases) with
+    python -m smallfry.benchmark --out new.json --compare old.json
+The results are written as JSON, one record per benchmark case.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+import concurrent.futures
+import platform
+import resource
+import tempfile
+import datetime
+import numpy as np
+import torch
+from smallfry import compress
+from smallfry import quant_embedding
+from smallfry.quant_embedding import QuantEmbedding
+
+
+def timeit(f, repeats=5, warmup=1):
+    '''
+    Call f warmup + repeats times and return the median and minimum
+    duration (in seconds) of the timed calls.
+    '''
+    for _ in range(warmup):
+        f()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations)), float(np.min(durations))
+
+def get_peak_rss():
+    '''Peak resident set size of this process, in bytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_case(f, args):
+    '''
+    Run f(*args) and add the peak resident set size of the process, and
+    its increase during the call, to the results.
+    '''
+    start_peak = get_peak_rss()
+    results = f(*args)
+    results['peak_rss_bytes'] = get_peak_rss()
+    results['rss_increase_bytes'] = results['peak_rss_bytes'] - start_peak
+    return results
+
+def run_case_in_subprocess(f, args):
+    '''
+    run_case in a fresh child process, since the peak RSS of a process
+    never decreases: every case reports its own peak rather than the
+    maximum over the earlier cases. Children are forked where possible,
+    which is much faster than spawning a new interpreter.
+    '''
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        'fork' if 'fork' in methods else 'spawn')
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_case, f, args).result()
+
+def random_embedding(vocab_size, dim, seed=0):
+    rng = np.random.RandomState(seed)
+    return torch.FloatTensor(rng.randn(vocab_size, dim).astype(np.float32))
+
+def bench_forward(nbit, vocab_size, dim, batch_size, seq_len, repeats):
+    '''
+    Latency and throughput of QuantEmbedding.forward against nn.Embedding,
+    along with the packed-vs-float memory of the two tables.
+    '''
+    weight = random_embedding(vocab_size, dim)
+    float_model = torch.nn.Sequential(torch.nn.Embedding(
+        vocab_size, dim, _weight=weight.clone()))
+    quant_model = torch.nn.Sequential(QuantEmbedding(
+        vocab_size, dim, nbit=nbit, _weight=weight.clone()))
+    input = torch.LongTensor(batch_size, seq_len).random_(to=vocab_size)
+    results = {}
+    with torch.no_grad():
+        for name, model in (('float', float_model), ('quant', quant_model)):
+            median, best = timeit(lambda: model(input), repeats=repeats)
+            results[name + '_latency_s'] = median
+            results[name + '_best_latency_s'] = best
+            results[name + '_tokens_per_s'] = input.numel() / median
+    float_mem, _ = quant_embedding.get_model_mem(float_model)
+    quant_mem, _ = quant_embedding.get_model_mem(quant_model)
+    results['float_bytes'] = float_mem
+    results['quant_bytes'] = quant_mem
+    results['bytes_ratio'] = quant_mem / float_mem
+    results['slowdown'] = results['quant_latency_s'] / results['float_latency_s']
+    return results
+
+def bench_packing(nbit, n_rows, dim, repeats):
+    '''Throughput of packing and unpacking n_rows x dim codes.'''
+    codes = torch.LongTensor(n_rows, dim).random_(to=2**nbit)
+    if quant_embedding.LONG_BITS % nbit == 0:
+        pack = lambda: quant_embedding.compress_long_mat(codes, nbit)
+        unpack = lambda packed: quant_embedding.decompress_long_mat(
+            packed, nbit, dim)
+        layout = 'long'
+    else:
+        pack = lambda: quant_embedding.compress_stream_mat(codes, nbit)
+        unpack = lambda packed: quant_embedding.decompress_stream_mat(
+            packed, nbit, dim)
+        layout = 'stream'
+    packed = pack()
+    pack_s, _ = timeit(pack, repeats=repeats)
+    unpack_s, _ = timeit(lambda: unpack(packed), repeats=repeats)
+    return {
+        'layout': layout,
+        'pack_s': pack_s,
+        'unpack_s': unpack_s,
+        'pack_codes_per_s': codes.numel() / pack_s,
+        'unpack_codes_per_s': codes.numel() / unpack_s,
+    }
+
+def bench_compress(nbit, n_rows, dim, repeats):
+    '''Time of the clipping range search and of the full compression.'''
+    X = random_embedding(n_rows, dim).numpy()
+    results = {}
+    for oracle in ('exact', 'histogram'):
+        results['find_optimal_range_' + oracle + '_s'], _ = timeit(
+            lambda: compress.find_optimal_range(X, nbit, oracle=oracle),
+            repeats=repeats, warmup=0)
+    results['compress_uniform_s'], _ = timeit(
+        lambda: compress.compress_uniform(X, nbit, adaptive_range=True),
+        repeats=repeats, warmup=0)
+    results['compress_uniform_codes_s'], _ = timeit(
+        lambda: compress.compress_uniform_codes(X, nbit, adaptive_range=True),
+        repeats=repeats, warmup=0)
+    return results
+
+def bench_file_load(nbit, n_rows, dim, repeats):
+    '''Time of building a QuantEmbedding from a GloVe format file.'''
+    X = random_embedding(n_rows, dim).numpy()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'embed.txt')
+        with open(file_name, 'w') as f:
+            for i in range(n_rows):
+                f.write('w' + str(i) + ' ' + ' '.join(map(str, X[i])) + '\n')
+        load_s, _ = timeit(lambda: QuantEmbedding(
+            n_rows, dim, nbit=nbit, embedding_file=file_name),
+            repeats=repeats, warmup=0)
+        file_bytes = os.path.getsize(file_name)
+    return {'load_s': load_s, 'file_bytes': file_bytes,
+            'file_mb_per_s': file_bytes / 1e6 / load_s}
+
+def run_benchmarks(args):
+    '''Run every benchmark case configured in args and return the records.'''
+    records = []
+
+    def record(benchmark, params, f, *f_args):
+        logging.info('Running ' + benchmark + ' ' + json.dumps(params))
+        results = run_case_in_subprocess(f, f_args)
+        records.append({'benchmark': benchmark, 'params': params,
+                        'results': results})
+
+    for nbit in args.nbits:
+        for vocab_size in args.vocab_sizes:
+            for dim in args.dims:
+                for batch_size, seq_len in args.shapes:
+                    params = {'nbit': nbit, 'vocab_size': vocab_size,
+                              'dim': dim, 'batch_size': batch_size,
+                              'seq_len': seq_len}
+                    record('forward', params, bench_forward,
+                           nbit, vocab_size, dim, batch_size, seq_len,
+                           args.repeats)
+        for dim in args.dims:
+            params = {'nbit': nbit, 'n_rows': args.pack_rows, 'dim': dim}
+            record('packing', params, bench_packing,
+                   nbit, args.pack_rows, dim, args.repeats)
+            params = {'nbit': nbit, 'n_rows': args.compress_rows, 'dim': dim}
+            record('compress', params, bench_compress,
+                   nbit, args.compress_rows, dim, args.compress_repeats)
+            params = {'nbit': nbit, 'n_rows': args.file_rows, 'dim': dim}
+            record('file_load', params, bench_file_load,
+                   nbit, args.file_rows, dim, args.compress_repeats)
+    return records
+
+def get_environment():
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'torch_threads': torch.get_num_threads(),
+    }
+
+def compare_results(old, new, metric_suffix='_s', threshold=1.1):
+    '''
+    Returns the (benchmark, params, metric, ratio) tuples of the timings
+    (metrics ending with metric_suffix) in new which are more than
+    threshold times slower than the same case in old.
+    '''
+    old_records = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)):
+                   r['results'] for r in old['records']}
+    regressions = []
+    for r in new['records']:
+        key = (r['benchmark'], json.dumps(r['params'], sort_keys=True))
+        if key not in old_records:
+            continue
+        for metric, value in r['results'].items():
+            old_value = old_records[key].get(metric)
+            if (metric.endswith(metric_suffix) and old_value
+                    and value / old_value > threshold):
+                regressions.append((r['benchmark'], r['params'], metric,
+                                    value / old_value))
+    return regressions
+
+def parse_shape(shape):
+    batch_size, seq_len = shape.split('x')
+    return int(batch_size), int(seq_len)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', type=str, default='bench_output.json',
+        help='JSON file the results are written to.')
+    parser.add_argument('--compare', type=str, default=None,
+        help='JSON file of a previous run to check for regressions.')
+    parser.add_argument('--threshold', type=float, default=1.1,
+        help='Slowdown ratio reported as a regression by --compare.')
+    parser.add_argument('--nbits', type=int, nargs='+', default=[1, 2, 3, 4, 8])
+    parser.add_argument('--vocab-sizes', type=int, nargs='+',
+        default=[10000, 400000])
+    parser.add_argument('--dims', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--shapes', type=parse_shape, nargs='+',
+        default=[(1, 1), (32, 400)], help='batch x sequence shapes, e.g. 32x400')
+    parser.add_argument('--pack-rows', type=int, default=100000)
+    parser.add_argument('--compress-rows', type=int, default=100000)
+    parser.add_argument('--file-rows', type=int, default=20000)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--compress-repeats', type=int, default=1)
+    parser.add_argument('--quick', action='store_true',
+        help='Run a small configuration, e.g. as a smoke test.')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.nbits = [2, 3]
+        args.vocab_sizes = [1000]
+        args.dims = [50]
+        args.shapes = [(4, 20)]
+        args.pack_rows = args.compress_rows = args.file_rows = 500
+        args.repeats = 2
+
+    output = {'environment': get_environment(), 'records': run_benchmarks(args)}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    logging.info('Wrote benchmark results to ' + args.out)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare_results(old, output, threshold=args.threshold)
+        for benchmark, params, metric, ratio in regressions:
+            logging.warning('Regression in {} {} {}: {:.2f}x slower'.format(
+                benchmark, json.dumps(params), metric, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    sys.exit(main())
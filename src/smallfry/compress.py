@@ -4,11 +4,14 @@ import math
 import time
 import pathlib
 import traceback
+import collections
+import concurrent.futures
 import numpy as np
 from smallfry import utils
+from smallfry import compression_cache
 
 def compress_uniform(X, bit_rate, adaptive_range=False, stochastic_round=False,
-        skip_quantize=False):
+        skip_quantize=False, cache=None):
     '''
     This function compresses an embedding matrix using uniform quantization.
 
@@ -21,6 +24,9 @@ def compress_uniform(X, bit_rate, adaptive_range=False, stochastic_round=False,
         stochastic_round (bool): If True, stochastic rounding is used for the quantization.
         skip_quantize (bool): If True, the embedding matrix will not be quantized.
             If adaptive_range is True, the extreme values of X will still be clipped.
+        cache (CompressionCache, str or bool): Cache of the clipping range search,
+            see compression_cache.resolve_cache. By default the cache set by
+            SMALLFRY_CACHE_DIR is used, if any.
 
     Returns:
         Xq (numpy array): The compressed embedding matrix.
@@ -30,11 +36,7 @@ def compress_uniform(X, bit_rate, adaptive_range=False, stochastic_round=False,
     '''
 
     start = time.time()
-    if adaptive_range:
-        # Note that deterministic quantization is always uses for find_optimal_range.
-        range_limit = find_optimal_range(X, bit_rate, stochastic_round=False)
-    else:
-        range_limit = get_max_abs(X)
+    range_limit = get_cached_range(X, bit_rate, adaptive_range, cache)
 
     Xq = _compress_uniform(X, bit_rate, range_limit,
         stochastic_round=stochastic_round, skip_quantize=skip_quantize)
@@ -42,6 +44,29 @@ def compress_uniform(X, bit_rate, adaptive_range=False, stochastic_round=False,
     frob_squared_error = np.linalg.norm(X-Xq)**2
     return Xq, frob_squared_error, elapsed
 
+def get_cached_range(X, bit_rate, adaptive_range=False, cache=None):
+    '''
+    The clipping value of compress_uniform, looked up in (and added to) the
+    compression cache. Only the range search is cached: the (possibly
+    stochastic) rounding is cheap compared to it and is always run.
+    '''
+    cache = compression_cache.resolve_cache(cache)
+    if cache is not None:
+        key = compression_cache.hash_array(np.asarray(X), {
+            'function': 'compress_uniform', 'bit_rate': bit_rate,
+            'adaptive_range': adaptive_range})
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]['range_limit']
+    if adaptive_range:
+        # Note that deterministic quantization is always uses for find_optimal_range.
+        range_limit = find_optimal_range(X, bit_rate, stochastic_round=False)
+    else:
+        range_limit = get_max_abs(X)
+    if cache is not None:
+        cache.put(key, {'range_limit': float(range_limit)})
+    return range_limit
+
 # Internal function.  This one expects an explicit range_limit.
 def _compress_uniform(X, bit_rate, range_limit, stochastic_round=False,
         skip_quantize=False):
@@ -61,7 +86,7 @@ def _compress_uniform(X, bit_rate, range_limit, stochastic_round=False,
         Xq (numpy array): The compressed embedding matrix.
     '''
     assert range_limit >= 0, 'range_limit must be non-negative.'
-    assert X.dtype == np.float or X.dtype == np.float64 or X.dtype == np.float32,\
+    assert X.dtype == np.float64 or X.dtype == np.float32,\
                 'Only floating point inputs allowed.'
     Xq = np.copy(X)
     if get_max_abs(Xq) > range_limit:
@@ -73,20 +98,372 @@ def _compress_uniform(X, bit_rate, range_limit, stochastic_round=False,
         if bit_rate == 0:
             Xq[:] = 0
         elif bit_rate < 32:
-            # affine transform to put Xq in [0,2**bit_rate - 1]
-            Xq = (2**bit_rate - 1) * (Xq + range_limit) / (2 * range_limit)
-            if stochastic_round:
-                # each entry will round down if noise > fraction part
-                np.ceil(Xq - np.random.rand(*Xq.shape), out=Xq)
-            else:
-                np.round(Xq, out=Xq)
-            # undo affine transformation
-            Xq = (Xq * 2 * range_limit) / (2**bit_rate - 1) - range_limit
+            scale, offset = get_scale_and_offset(bit_rate, range_limit)
+            Xq = _dequantize(_quantize(Xq, bit_rate, range_limit,
+                stochastic_round=stochastic_round), scale, offset)
         elif bit_rate >= 32:
             pass # don't quantize if bitrate >= 32
     return Xq
 
-def find_optimal_range(X, bit_rate, stochastic_round=False, tol=1e-2):
+def _quantize(X, bit_rate, range_limit, stochastic_round=False):
+    '''
+    Maps the (already clipped) entries of X to the integer grid
+    {0, ..., 2**bit_rate - 1}. The integers are returned in a floating
+    point array of the same dtype as X.
+    '''
+    # affine transform to put X in [0,2**bit_rate - 1]
+    Xq = (2**bit_rate - 1) * (X + range_limit) / (2 * range_limit)
+    if stochastic_round:
+        # each entry will round down if noise > fraction part
+        np.ceil(Xq - np.random.rand(*Xq.shape), out=Xq)
+    else:
+        np.round(Xq, out=Xq)
+    return Xq
+
+def _dequantize(Xq, scale, offset):
+    '''
+    Undo the affine transformation of _quantize, i.e. map codes to
+    codes * scale + offset, in the dtype of Xq.
+    '''
+    return Xq * scale + offset
+
+def get_scale_and_offset(bit_rate, range_limit):
+    '''
+    Returns the (scale, offset) of the uniform quantization grid with
+    2**bit_rate levels over [-range_limit, range_limit]; the value of
+    code c is c * scale + offset.
+    '''
+    return 2 * range_limit / (2**bit_rate - 1), -range_limit
+
+def get_codes_dtype(bit_rate):
+    '''
+    Returns the smallest unsigned integer numpy dtype which can hold
+    codes of bit_rate bits.
+    '''
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if bit_rate <= 8 * np.dtype(dtype).itemsize:
+            return dtype
+    raise ValueError('Codes are only supported for bit_rate <= 32.')
+
+def compress_uniform_codes(X, bit_rate, adaptive_range=False, stochastic_round=False):
+    '''
+    This function compresses an embedding matrix using uniform quantization,
+    like compress_uniform, but returns the integer codes instead of the
+    dequantized matrix.
+
+    Parameters:
+        X (numpy array): Embedding matrix (rows of X are word embeddings).
+        bit_rate (int): Number of bits to use per entry of the compressed embedding matrix.
+        adaptive_range (bool): If True, golden section search is used to find the optimal
+            value at which to clip the extreme values of the embedding matrix X before
+            performing quantization.
+        stochastic_round (bool): If True, stochastic rounding is used for the quantization.
+
+    Returns:
+        codes (numpy array): The codes in {0, ..., 2**bit_rate - 1}, in the smallest
+            unsigned integer dtype which fits bit_rate bits.
+        scale (float), offset (float): The compressed embedding matrix is
+            codes * scale + offset.
+        frob_squared_error (float): The Frobenius norm of the difference between
+            the compressed and uncompressed embedding matrices.
+        elapsed (float): The duration (in seconds) of this function call.
+    '''
+    assert 1 <= bit_rate < 32, 'Codes are only supported for 1 <= bit_rate < 32.'
+    start = time.time()
+    if adaptive_range:
+        # Note that deterministic quantization is always uses for find_optimal_range.
+        range_limit = find_optimal_range(X, bit_rate, stochastic_round=False)
+    else:
+        range_limit = get_max_abs(X)
+    codes, scale, offset = _compress_uniform_codes(X, bit_rate, range_limit,
+        stochastic_round=stochastic_round)
+    elapsed = time.time() - start
+    frob_squared_error = compute_frob_squared_error_from_codes(X, codes, scale, offset)
+    return codes, scale, offset, frob_squared_error, elapsed
+
+# Internal function.  This one expects an explicit range_limit.
+def _compress_uniform_codes(X, bit_rate, range_limit, stochastic_round=False):
+    '''
+    Internal uniform quantization function returning codes.
+
+    Parameters:
+        X (numpy array): Embedding matrix (rows of X are word embeddings).
+        bit_rate (int): Number of bits to use per entry of the compressed embedding matrix.
+        range_limit (float): All values in X with absolute value greater than
+            this range_limit will be clipped.
+        stochastic_round (bool): If True, stochastic rounding is used for the quantization.
+
+    Returns:
+        codes (numpy array): The codes, in dtype get_codes_dtype(bit_rate).
+        scale (float), offset (float): The compressed embedding matrix is
+            codes * scale + offset.
+    '''
+    assert range_limit >= 0, 'range_limit must be non-negative.'
+    dtype = get_codes_dtype(bit_rate)
+    if range_limit == 0:
+        # the whole matrix is quantized to 0
+        return np.zeros(X.shape, dtype=dtype), 0.0, 0.0
+    Xq = np.clip(X, -range_limit, range_limit)
+    Xq = _quantize(Xq, bit_rate, range_limit, stochastic_round=stochastic_round)
+    scale, offset = get_scale_and_offset(bit_rate, range_limit)
+    return Xq.astype(dtype), scale, offset
+
+def _row_blocks(X, block_rows):
+    '''Yields the 2D row blocks of an iterable of rows and of row blocks.'''
+    rows = []
+    for item in X:
+        item = np.asarray(item)
+        if item.ndim == 1:
+            rows.append(item)
+            if len(rows) == block_rows:
+                yield np.stack(rows)
+                rows = []
+            continue
+        if item.ndim != 2:
+            raise ValueError('X should yield rows or 2D row blocks, got a ' +
+                             str(item.ndim) + 'D array.')
+        if rows:
+            yield np.stack(rows)
+            rows = []
+        yield item
+    if rows:
+        yield np.stack(rows)
+
+def compress_uniform_blocked(X, bit_rate, adaptive_range=False, stochastic_round=False,
+        range_limit=None, out=None, block_rows=8192, n_threads=None):
+    '''
+    Out-of-core version of compress_uniform_codes. Row blocks of X are quantized
+    in parallel on a thread pool (numpy releases the GIL) and their codes are
+    written to out, so the peak memory is a small multiple of the block size.
+
+    Parameters:
+        X (numpy array, np.memmap or iterable): Embedding matrix (rows of X are word
+            embeddings), or an iterable of its rows (1D) or of 2D row blocks of it.
+            Rows are grouped into blocks of block_rows. For iterables, range_limit
+            has to be provided since X can only be read once.
+        bit_rate (int): Number of bits to use per entry of the compressed embedding matrix.
+        adaptive_range (bool): If True, the clipping value is found with
+            find_optimal_range, using the histogram oracle for large matrices.
+        stochastic_round (bool): If True, stochastic rounding is used for the quantization.
+        range_limit (float): If set, this clipping value is used directly.
+        out (numpy array, np.memmap or str): Where to write the codes. A string is
+            used as the file name of a new np.memmap. By default the codes are
+            returned in a new in-memory array.
+        block_rows (int): Number of rows quantized by each task.
+        n_threads (int): Number of worker threads, os.cpu_count() by default.
+
+    Returns:
+        codes (numpy array): The codes, in dtype get_codes_dtype(bit_rate).
+        scale (float), offset (float): The compressed embedding matrix is
+            codes * scale + offset.
+        frob_squared_error (float): The Frobenius norm of the difference between
+            the compressed and uncompressed embedding matrices.
+        elapsed (float): The duration (in seconds) of this function call.
+    '''
+    assert 1 <= bit_rate < 32, 'Codes are only supported for 1 <= bit_rate < 32.'
+    start = time.time()
+    is_array = isinstance(X, np.ndarray)
+    if range_limit is None:
+        if not is_array:
+            raise ValueError('range_limit is required when X is an iterable of blocks.')
+        if adaptive_range:
+            range_limit = find_optimal_range(X, bit_rate, stochastic_round=False,
+                                             oracle='auto')
+        else:
+            range_limit = get_max_abs(X)
+    dtype = get_codes_dtype(bit_rate)
+    if is_array:
+        blocks = (X[i:i + block_rows] for i in range(0, X.shape[0], block_rows))
+        if isinstance(out, str):
+            out = np.memmap(out, dtype=dtype, mode='w+', shape=X.shape)
+        elif out is None:
+            out = np.empty(X.shape, dtype=dtype)
+    else:
+        blocks = _row_blocks(X, block_rows)
+        if isinstance(out, str):
+            raise ValueError('out has to be an array when X is an iterable of blocks.')
+    scale, offset = get_scale_and_offset(bit_rate, range_limit)
+    code_blocks = []
+
+    def compress_block(block, row_start):
+        codes, _, _ = _compress_uniform_codes(block, bit_rate, range_limit,
+            stochastic_round=stochastic_round)
+        if out is not None:
+            out[row_start:row_start + codes.shape[0]] = codes
+        return codes, compute_frob_squared_error_from_codes(block, codes, scale, offset)
+
+    n_threads = n_threads or os.cpu_count() or 1
+    frob_squared_error = 0.0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = collections.deque()
+        row_start = 0
+        for block in blocks:
+            block = np.asarray(block)
+            pending.append(pool.submit(compress_block, block, row_start))
+            row_start += block.shape[0]
+            # bound the number of blocks held in memory
+            while len(pending) > 2 * n_threads:
+                codes, error = pending.popleft().result()
+                frob_squared_error += error
+                if out is None:
+                    code_blocks.append(codes)
+        while pending:
+            codes, error = pending.popleft().result()
+            frob_squared_error += error
+            if out is None:
+                code_blocks.append(codes)
+    if out is None:
+        out = (np.concatenate(code_blocks) if code_blocks
+               else np.zeros([0], dtype=dtype))
+    elif isinstance(out, np.memmap):
+        out.flush()
+    elapsed = time.time() - start
+    return out, scale, offset, frob_squared_error, elapsed
+
+def compress_uniform_grouped_codes(X, bit_rate, group_size=None, adaptive_range=False,
+        stochastic_round=False, tol=1e-2, scale_dtype=np.float16, chunk_rows=8192):
+    '''
+    Group-wise uniform quantization. Each row of X is split into blocks of
+    group_size consecutive columns (a single block per row by default), and every
+    (row, block) group gets its own clipping range and scale. The ranges of all
+    groups are searched at once with golden_section_search_batched.
+
+    Parameters:
+        X (numpy array): Embedding matrix (rows of X are word embeddings).
+        bit_rate (int): Number of bits to use per entry of the compressed embedding matrix.
+        group_size (int): Number of columns sharing a scale, the full row if None.
+        adaptive_range (bool): If True, the clipping value of every group is searched
+            to minimize the group's squared error, otherwise its max abs value is used.
+        stochastic_round (bool): If True, stochastic rounding is used for the quantization.
+        tol (float): The tolerance of the golden section search.
+        scale_dtype (numpy dtype): The dtype the scales are stored in. The codes are
+            computed with the scales rounded to this dtype.
+        chunk_rows (int): Number of rows processed at a time.
+
+    Returns:
+        codes (numpy array): The codes, in dtype get_codes_dtype(bit_rate).
+        scales (numpy array): [X.shape[0], n_groups] quantization steps. Entry j of
+            row i is (codes[i, j] - (2**bit_rate - 1) / 2) * scales[i, j // group_size].
+        frob_squared_error (float): The Frobenius norm of the difference between
+            the compressed and uncompressed embedding matrices.
+        elapsed (float): The duration (in seconds) of this function call.
+    '''
+    assert 1 <= bit_rate <= 16, 'Grouped codes are only supported for 1 <= bit_rate <= 16.'
+    start = time.time()
+    n_row, dim = X.shape
+    group_size = group_size or dim
+    n_group = math.ceil(dim / group_size)
+    codes = np.empty(X.shape, dtype=get_codes_dtype(bit_rate))
+    scales = np.empty([n_row, n_group], dtype=scale_dtype)
+    frob_squared_error = 0.0
+    for i in range(0, n_row, chunk_rows):
+        X_group, mask = _group_columns(X[i:i + chunk_rows], group_size)
+        max_abs = np.max(np.abs(X_group), axis=-1)
+        if adaptive_range:
+            f = lambda range_limit : np.sum(mask * (X_group - _quantize_grouped(
+                X_group, bit_rate, _get_group_scale(bit_rate, range_limit))[1])**2,
+                axis=-1)
+            range_limit = golden_section_search_batched(f, np.zeros_like(max_abs),
+                max_abs, tol=tol)
+        else:
+            range_limit = max_abs
+        scale = _get_group_scale(bit_rate, range_limit).astype(scale_dtype)
+        group_codes, Xq = _quantize_grouped(X_group, bit_rate,
+            scale.astype(X_group.dtype), stochastic_round=stochastic_round)
+        frob_squared_error += np.sum((mask * (X_group - Xq)**2).astype(np.float64))
+        codes[i:i + chunk_rows] = group_codes.reshape(
+            group_codes.shape[0], -1)[:, :dim]
+        scales[i:i + chunk_rows] = scale
+    elapsed = time.time() - start
+    return codes, scales, frob_squared_error, elapsed
+
+def _group_columns(X, group_size):
+    '''
+    Reshape X into [n_row, n_group, group_size], zero padding the last group.
+    Returns the grouped matrix and a mask which is 0 on the padded entries.
+    '''
+    n_row, dim = X.shape
+    n_group = math.ceil(dim / group_size)
+    X_group = np.zeros([n_row, n_group * group_size], dtype=X.dtype)
+    X_group[:, :dim] = X
+    mask = np.zeros([n_group * group_size], dtype=X.dtype)
+    mask[:dim] = 1
+    return (X_group.reshape(n_row, n_group, group_size),
+            mask.reshape(n_group, group_size))
+
+def _get_group_scale(bit_rate, range_limit):
+    return 2 * range_limit / (2**bit_rate - 1)
+
+def _quantize_grouped(X_group, bit_rate, scale, stochastic_round=False):
+    '''
+    Quantize every group of X_group ([..., n_group, group_size]) with its
+    scale ([..., n_group]) on the grid (code - (2**bit_rate - 1) / 2) * scale.
+    Returns the codes (as floats) and the dequantized groups.
+    '''
+    mid = (2**bit_rate - 1) / 2
+    scale = scale[..., None]
+    # groups with a zero scale are entirely zero
+    safe_scale = np.where(scale > 0, scale, 1)
+    codes = X_group / safe_scale + mid
+    if stochastic_round:
+        np.ceil(codes - np.random.rand(*codes.shape), out=codes)
+    else:
+        np.round(codes, out=codes)
+    np.clip(codes, 0, 2**bit_rate - 1, out=codes)
+    return codes, (codes - mid) * scale
+
+def golden_section_search_batched(f, x_min, x_max, tol=1e-2):
+    '''
+    Vectorized golden_section_search: finds the argmin of many unimodal
+    functions at once. f maps an array of inputs (same shape as x_min and
+    x_max) to the array of the corresponding function values, and every
+    entry is searched independently between x_min and x_max.
+    '''
+    c = (math.sqrt(5) - 1) / 2
+    x1 = np.array(x_min, dtype=np.float64)
+    x4 = np.array(x_max, dtype=np.float64)
+    f_x1 = f(x1)
+    f_x4 = f(x4)
+    x2 = x1 + (x4 - x1) * c**2
+    x3 = x1 + (x4 - x1) * c
+    f_x2 = f(x2)
+    f_x3 = f(x3)
+    while np.any(x4 - x1 > tol):
+        left = f_x2 < f_x3
+        # left: the new points become [x1, NEW, x2, x3]
+        # otherwise: the new points become [x2, x3, NEW, x4]
+        x1, f_x1 = np.where(left, x1, x2), np.where(left, f_x1, f_x2)
+        x4, f_x4 = np.where(left, x3, x4), np.where(left, f_x3, f_x4)
+        x2_old, f_x2_old = x2, f_x2
+        x2 = np.where(left, x1 + (x4 - x1) * c**2, x3)
+        x3 = np.where(left, x2_old, x1 + (x4 - x1) * c)
+        f_new = f(np.where(left, x2, x3))
+        f_x2, f_x3 = np.where(left, f_new, f_x3), np.where(left, f_x2_old, f_new)
+    # Return x-value with minimum f(x) which was found.
+    x = np.stack([x1, x2, x3, x4])
+    i = np.argmin(np.stack([f_x1, f_x2, f_x3, f_x4]), axis=0)
+    return np.take_along_axis(x, i[None], axis=0)[0]
+
+def compute_frob_squared_error_from_codes(X, codes, scale, offset, chunk_rows=8192):
+    '''
+    Squared Frobenius error between X and codes * scale + offset. Rows are
+    processed in chunks, so no full size dequantized matrix is allocated.
+    '''
+    X = X.reshape(-1, X.shape[-1])
+    codes = codes.reshape(X.shape)
+    frob_squared_error = 0.0
+    for i in range(0, X.shape[0], chunk_rows):
+        Xq = _dequantize(codes[i:i + chunk_rows].astype(X.dtype), scale, offset)
+        frob_squared_error += np.linalg.norm(X[i:i + chunk_rows] - Xq)**2
+    return frob_squared_error
+
+# Matrices with at most this many entries use the exact error oracle
+# when find_optimal_range is called with oracle='auto' (as the out-of-core
+# and file loading paths do).
+EXACT_ORACLE_MAX_SIZE = 2**20
+
+def find_optimal_range(X, bit_rate, stochastic_round=False, tol=1e-2,
+        oracle='exact', subsample_rows=None, n_bins=2**16):
     '''
     Find the best value to use to clip the embeddings before using uniform quantization.
 
@@ -96,14 +473,153 @@ def find_optimal_range(X, bit_rate, stochastic_round=False, tol=1e-2):
         stochastic_round (bool): If True, stochastic rounding is used for the quantization.
         tol (float): The tolerance (maximum possible error) for the golden section search
             algorithm.
+        oracle (str): How the error of each candidate range is computed. 'exact'
+            compresses X for every candidate, 'histogram' answers every candidate from
+            a histogram of |X| built once (see make_histogram_error_oracle), in time
+            independent of the size of X. 'auto' uses 'exact' for matrices with at
+            most EXACT_ORACLE_MAX_SIZE entries and for stochastic rounding, and
+            'histogram' otherwise.
+        subsample_rows (int): If set, the error oracle is built from this many rows of
+            X sampled uniformly at random, and the estimated error at the returned
+            range (with its standard error) is logged.
+        n_bins (int): Number of histogram bins of the 'histogram' oracle.
 
     Returns:
         float: The optimal clipping value.
     '''
-    f = lambda range_limit : compress_and_compute_frob_squared_error(
-        X, bit_rate, range_limit, stochastic_round=stochastic_round)
+    assert oracle in ('auto', 'exact', 'histogram')
+    if oracle == 'auto':
+        oracle = 'exact' if (X.size <= EXACT_ORACLE_MAX_SIZE or
+                             stochastic_round) else 'histogram'
+    X_sample = X
+    if subsample_rows is not None and subsample_rows < X.shape[0]:
+        rows = np.sort(np.random.choice(X.shape[0], subsample_rows, replace=False))
+        X_sample = X[rows]
+    if oracle == 'histogram':
+        assert not stochastic_round, \
+            'The histogram oracle only supports deterministic rounding.'
+        f = make_histogram_error_oracle(X_sample, bit_rate, n_bins=n_bins)
+    else:
+        f = lambda range_limit : compress_and_compute_frob_squared_error(
+            X_sample, bit_rate, range_limit, stochastic_round=stochastic_round)
+
+    range_limit = golden_section_search(f, 0, get_max_abs(X), tol=tol)
+    if X_sample is not X:
+        estimate, std_error = estimate_frob_squared_error(
+            X_sample, bit_rate, range_limit, n_rows=X.shape[0])
+        logging.info('Estimated frob squared error at range limit {} from {} rows: '
+            '{} +/- {} (standard error)'.format(range_limit, X_sample.shape[0],
+            estimate, std_error))
+    return range_limit
+
+def build_abs_histogram(X, n_bins=2**16, max_abs=None, chunk_rows=8192):
+    '''
+    Histogram of the absolute values of X with n_bins equal width bins over
+    [0, max_abs]. For every bin, the number of entries, the sum of their absolute
+    values and the sum of their squares are accumulated, processing chunk_rows
+    rows at a time.
+
+    Returns:
+        (bin_width, counts, sums, squared_sums)
+    '''
+    if max_abs is None:
+        max_abs = get_max_abs(X)
+    bin_width = max(float(max_abs), np.finfo(np.float32).tiny) / n_bins
+    counts = np.zeros(n_bins)
+    sums = np.zeros(n_bins)
+    squared_sums = np.zeros(n_bins)
+    X = X.reshape(-1, X.shape[-1])
+    for i in range(0, X.shape[0], chunk_rows):
+        A = np.abs(X[i:i + chunk_rows]).ravel().astype(np.float64)
+        bins = np.minimum((A / bin_width).astype(np.int64), n_bins - 1)
+        counts += np.bincount(bins, minlength=n_bins)
+        sums += np.bincount(bins, weights=A, minlength=n_bins)
+        squared_sums += np.bincount(bins, weights=A * A, minlength=n_bins)
+    return bin_width, counts, sums, squared_sums
+
+def make_histogram_error_oracle(X, bit_rate, n_bins=2**16, histogram=None):
+    '''
+    Build a function which approximates compress_and_compute_frob_squared_error(
+    X, bit_rate, range_limit) (with deterministic rounding) from a histogram of
+    |X|, in O(n_bins) time per call.
 
-    return golden_section_search(f, 0, get_max_abs(X), tol=tol)
+    Every bin whose center is beyond range_limit is clipped, so its error is
+    exact from the bin moments. Every other bin is assigned the level its center
+    rounds to; when the quantization step is not much wider than a bin the
+    uniform quantization noise step**2 / 12 per entry is used instead.
+
+    Parameters:
+        X (numpy array): Embedding matrix (rows of X are word embeddings).
+        bit_rate (int): Number of bits to use per entry of the compressed embedding matrix.
+        n_bins (int): Number of histogram bins.
+        histogram (tuple): The build_abs_histogram(X, n_bins) result, if already
+            computed (X is then unused).
+
+    Returns:
+        function: maps a range_limit to the estimated squared Frobenius error.
+    '''
+    if histogram is None:
+        histogram = build_abs_histogram(X, n_bins=n_bins)
+    bin_width, counts, sums, squared_sums = histogram
+    n_bins = counts.shape[0]
+    centers = (np.arange(n_bins) + 0.5) * bin_width
+
+    def f(range_limit):
+        clipped = centers > range_limit
+        error = np.sum(squared_sums[clipped] - 2 * range_limit * sums[clipped] +
+            counts[clipped] * range_limit**2)
+        if bit_rate >= 32:
+            return error
+        if bit_rate == 0 or range_limit == 0:
+            return error + np.sum(squared_sums[~clipped])
+        step = 2 * range_limit / (2**bit_rate - 1)
+        if step < 8 * bin_width:
+            return error + np.sum(counts[~clipped]) * step**2 / 12
+        # the levels are symmetric, so |x| is quantized to |Q(x)|
+        levels = np.round((centers[~clipped] + range_limit) / step) * step - range_limit
+        return error + np.sum(squared_sums[~clipped] - 2 * levels * sums[~clipped] +
+            counts[~clipped] * levels**2)
+    return f
+
+def estimate_distortion_curve(X, bit_rates, n_bins=2**16, tol=1e-2):
+    '''
+    Estimate the squared Frobenius error of compressing X at every bit rate of
+    bit_rates (with deterministic rounding and the clipping range searched for
+    each bit rate). A single histogram of |X| is built, every range search is
+    then answered by the histogram oracle (see make_histogram_error_oracle).
+
+    Returns:
+        dict: maps every bit rate to its estimated error (0 for 32 bits).
+    '''
+    histogram = build_abs_histogram(X, n_bins=n_bins)
+    max_abs = histogram[0] * n_bins
+    curve = {}
+    for bit_rate in bit_rates:
+        if bit_rate >= 32:
+            curve[bit_rate] = 0.0
+            continue
+        f = make_histogram_error_oracle(X, bit_rate, histogram=histogram)
+        curve[bit_rate] = float(f(golden_section_search(f, 0, max_abs, tol=tol)))
+    return curve
+
+def estimate_frob_squared_error(X_sample, bit_rate, range_limit, n_rows,
+        stochastic_round=False):
+    '''
+    Estimate the squared Frobenius compression error of a matrix with n_rows rows
+    from X_sample, a uniform sample of its rows.
+
+    Returns:
+        (estimate, std_error): The estimated error and its standard error.
+    '''
+    Xq = _compress_uniform(X_sample, bit_rate, range_limit,
+        stochastic_round=stochastic_round)
+    row_errors = np.sum((X_sample - Xq).astype(np.float64)**2, axis=1)
+    m = row_errors.shape[0]
+    estimate = n_rows * np.mean(row_errors)
+    # finite population correction for sampling without replacement
+    std_error = n_rows * np.std(row_errors, ddof=1 if m > 1 else 0) / math.sqrt(m) * \
+        math.sqrt(max(n_rows - m, 0) / max(n_rows - 1, 1))
+    return estimate, std_error
 
 def compress_and_compute_frob_squared_error(X, bit_rate, range_limit, stochastic_round=False):
     '''
@@ -165,8 +681,9 @@ def golden_section_search(f, x_min, x_max, tol=1e-2):
     # Initialize points
     # c is equal to 1/phi, for phi = (1+sqrt(5))/2
     c = (math.sqrt(5) - 1) / 2
-    x1 = x_min
-    x4 = x_max
+    # python floats, numpy 2 keeps float32 scalars (e.g. get_max_abs) in float32
+    x1 = float(x_min)
+    x4 = float(x_max)
     f_x1 = f(x1)
     f_x4 = f(x4)
     x2 = x1 + (x4-x1) * c**2
@@ -194,5 +711,9 @@ def golden_section_search(f, x_min, x_max, tol=1e-2):
     x = [x1,x2,x3,x4]
     return x[i]
 
-def get_max_abs(X):
-    return np.max(np.abs(X))
+def get_max_abs(X, chunk_rows=8192):
+    if X.ndim < 2 or X.shape[0] <= chunk_rows:
+        return np.max(np.abs(X))
+    # avoid a full size temporary for large (e.g. memory mapped) matrices
+    return max(np.max(np.abs(X[i:i + chunk_rows]))
+               for i in range(0, X.shape[0], chunk_rows))
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+##################################################################
+# Content-addressed on-disk cache of compression results. Entries
+# are files in the binary container format of quant_embedding
+# (see save_compressed), named by a hash of the input contents and
+# of the compression settings, and evicted in least recently used
+# order once the cache exceeds its byte budget.
+##################################################################
+CACHE_FORMAT_VERSION = 1
+CACHE_SUFFIX = ".sfry"
+DEFAULT_MAX_BYTES = 16 * 2**30
+# number of bytes hashed at a time
+HASH_CHUNK_BYTES = 2**24
+
+def _new_hash(settings):
+    h = hashlib.blake2b(digest_size=20)
+    settings = dict(settings, cache_format=CACHE_FORMAT_VERSION)
+    h.update(json.dumps(settings, sort_keys=True).encode("utf8"))
+    return h
+
+def hash_array(X, settings):
+    """
+    Key of a numpy array (e.g. an np.memmap) and a JSON serializable dict
+    of settings. The array is hashed by blocks of rows, so memory-mapped
+    inputs are not loaded at once.
+    """
+    h = _new_hash(settings)
+    h.update(json.dumps([X.dtype.str, list(X.shape)]).encode("utf8"))
+    X = X.reshape(X.shape[0], -1) if X.ndim > 0 else X.reshape(1, 1)
+    row_bytes = max(1, X.shape[1] * X.dtype.itemsize)
+    block_rows = max(1, HASH_CHUNK_BYTES // row_bytes)
+    for i in range(0, X.shape[0], block_rows):
+        h.update(np.ascontiguousarray(X[i:i + block_rows]).tobytes())
+    return h.hexdigest()
+
+def hash_file(file_name, settings):
+    """ key of the contents of file_name and a dict of settings """
+    h = _new_hash(settings)
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CompressionCache(object):
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        On-disk cache of compression results in cache_dir, holding at
+        most max_bytes bytes of entries. Entries are written atomically,
+        so several processes can share the directory.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def get(self, key, mmap=True):
+        """
+        Returns the (meta, arrays) stored for key, or None. With mmap the
+        arrays are copy-on-write memory maps of the entry.
+        """
+        from smallfry.quant_embedding import load_compressed
+        path = self._path(key)
+        try:
+            meta, arrays, _ = load_compressed(path, mmap=mmap)
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except Exception as e:
+            if os.path.exists(path):
+                logging.warning("Ignoring unreadable cache entry " + path +
+                                ": " + str(e))
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.info("Loaded compression result from cache " + path)
+        return meta, arrays
+
+    def put(self, key, meta, arrays=None):
+        """ store the JSON serializable meta and the numpy arrays for key """
+        from smallfry.quant_embedding import save_compressed
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, suffix=CACHE_SUFFIX + ".tmp")
+        os.close(fd)
+        try:
+            save_compressed(tmp_path, meta, arrays or {})
+            os.replace(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def _entries(self):
+        """ (modification time, size, path) of the entries """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """ total bytes of the entries """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """ remove the least recently used entries beyond max_bytes """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                logging.info("Evicted cache entry " + path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_default_cache = None
+
+def get_default_cache():
+    """
+    The cache used when none is given: the one set by set_default_cache,
+    or a cache in the directory of the SMALLFRY_CACHE_DIR environment
+    variable (with SMALLFRY_CACHE_MAX_BYTES bytes), or None.
+    """
+    global _default_cache
+    if _default_cache is None and os.environ.get("SMALLFRY_CACHE_DIR"):
+        _default_cache = CompressionCache(
+            os.environ["SMALLFRY_CACHE_DIR"],
+            int(os.environ.get("SMALLFRY_CACHE_MAX_BYTES",
+                               DEFAULT_MAX_BYTES)))
+    return _default_cache
+
+def set_default_cache(cache):
+    """ set (or unset with None) the default cache """
+    global _default_cache
+    _default_cache = cache
+
+def resolve_cache(cache):
+    """
+    cache arguments: None for the default cache, False to disable the
+    cache, a directory name or a CompressionCache
+    """
+    if cache is None:
+        return get_default_cache()
+    if cache is False:
+        return None
+    if isinstance(cache, str):
+        return CompressionCache(cache)
+    return cache
@@ -0,0 +1,107 @@
+import torch
+import torch.nn as nn
+import logging
+from smallfry.quant_embedding import long_mat_to_bytes
+from smallfry.quant_embedding import _stream_code_position
+
+##################################################################
+# Python-free inference of quantized embeddings. QuantEmbeddingDecoder
+# holds the packed rows of a QuantEmbedding as a uint8 bit stream
+# (the long packing is re-read as bytes, see long_mat_to_bytes) along
+# with precomputed byte positions, shifts and mask, so decoding is a
+# fixed sequence of tensor ops: it can be scripted with torch.jit,
+# compiled with torch.compile and exported to ONNX (gathers, shifts
+# and bitwise ops of the default opset, no custom op needed).
+##################################################################
+class QuantEmbeddingDecoder(nn.Module):
+    def __init__(self, embedding):
+        """
+        Inference-only copy of the QuantEmbedding embedding. forward takes
+        a LongTensor of ids of any shape and returns the
+        [*input.shape, embedding_dim] rows in the dtype of value_list.
+        The packed rows are shared with embedding for the stream packing
+        and copied (with the same size) for the long packing.
+        """
+        super(QuantEmbeddingDecoder, self).__init__()
+        self.num_embeddings = embedding.num_embeddings
+        self.embedding_dim = embedding.embedding_dim
+        self.nbit = embedding.nbit
+        self.quantized = embedding.nbit != 32
+        self.grouped = self.quantized and embedding.group_size is not None
+        weight = embedding.weight.detach()
+        device = weight.device
+        # torch.jit requires every buffer, the unused ones are empty
+        empty_long = torch.zeros(0, dtype=torch.int64, device=device)
+        value_list = torch.zeros(0, device=device)
+        byte_index = next_byte_index = group_index = empty_long
+        shift = mask = empty_long.int()
+        group_scales = torch.zeros(0, 0, device=device)
+        if self.quantized:
+            if embedding.packing == "long":
+                weight = long_mat_to_bytes(weight)
+            value_list = embedding.value_list.detach()
+            byte_index, shift = _stream_code_position(
+                self.embedding_dim, self.nbit, device)
+            # codes ending in the last byte have shift >= 8, so the clamped
+            # low byte never contributes to them
+            next_byte_index = (byte_index + 1).clamp(max=weight.size(1) - 1)
+            shift = shift.int()
+            mask = torch.tensor(2**self.nbit - 1, dtype=torch.int32,
+                                device=device)
+        if self.grouped:
+            group_scales = embedding.group_scales
+            group_index = torch.arange(
+                self.embedding_dim, device=device) // embedding.group_size
+        self.register_buffer("weight", weight)
+        self.register_buffer("value_list", value_list)
+        self.register_buffer("byte_index", byte_index)
+        self.register_buffer("next_byte_index", next_byte_index)
+        self.register_buffer("shift", shift)
+        self.register_buffer("mask", mask)
+        self.register_buffer("group_scales", group_scales)
+        self.register_buffer("group_index", group_index)
+
+    def forward(self, input):
+        ids = input.reshape(-1)
+        out_shape = list(input.shape) + [self.embedding_dim]
+        if not self.quantized:
+            return self.weight.index_select(0, ids).view(out_shape)
+        packed = self.weight.index_select(0, ids)
+        high = packed.index_select(1, self.byte_index).int()
+        low = packed.index_select(1, self.next_byte_index).int()
+        # every code lies in the 16 bit window of its first byte. The
+        # bitwise_* functions (rather than the operators) export to ONNX.
+        codes = torch.bitwise_and(torch.bitwise_right_shift(
+            high * 256 + low, self.shift), self.mask)
+        out = self.value_list.index_select(0, codes.reshape(-1)).view(
+            ids.size(0), self.embedding_dim)
+        if self.grouped:
+            scales = self.group_scales.index_select(0, ids).to(out.dtype)
+            out = out * scales.index_select(1, self.group_index)
+        return out.view(out_shape)
+
+
+def script_embedding(embedding):
+    """ returns the torch.jit.script module of the decoder of embedding """
+    return torch.jit.script(QuantEmbeddingDecoder(embedding))
+
+def export_onnx(embedding, file_name, example_input=None, opset_version=18):
+    """
+    Export the decoder of the QuantEmbedding embedding to the ONNX file
+    file_name (requires the onnx and onnxscript packages). The dimensions
+    of example_input (by default a batch of ids) are dynamic in the
+    exported graph, whose input is "input" and output "output".
+    """
+    decoder = QuantEmbeddingDecoder(embedding).eval()
+    if example_input is None:
+        example_input = torch.arange(
+            min(2, embedding.num_embeddings), device=decoder.weight.device)
+    dynamic_shapes = ({i: torch.export.Dim.DYNAMIC
+                       for i in range(example_input.dim())},)
+    program = torch.onnx.export(
+        decoder, (example_input,), dynamic_shapes=dynamic_shapes,
+        input_names=["input"], output_names=["output"],
+        opset_version=opset_version, dynamo=True)
+    program.save(file_name)
+    logging.info("Exported quantized embedding to " + file_name)
+    return program
@@ -4,10 +4,25 @@ import torch.nn.functional as F
 import numpy as np
 import math
 from smallfry import compress
+from smallfry import utils
+from smallfry import compression_cache
 import logging
 import sys, os
+import json
+import struct
+import time
+import threading
+import collections
+import concurrent.futures
+import functools
 
 LONG_BITS = 64
+# number of vectors parsed and packed at once when loading embedding files
+FILE_CHUNK_ROWS = 8192
+# maximal number of vectors sampled to estimate the clipping range of files
+RANGE_SAMPLE_ROWS = 50000
+# number of codes packed or unpacked at once by the long packing
+PACK_CHUNK_VALUES = 2**16
 
 def fix_randomness(seed):
     np.random.seed(seed)
@@ -24,88 +39,477 @@ def fix_randomness(seed):
 # The core helper functions for compressing embeddings
 # into torch int64 LongTensor.
 ##################################################################
-def compress_long_mat(long_tensor, nbit):
+@functools.lru_cache(maxsize=64)
+def _long_mat_layout(nbit, device):
     """
-    we assume a single vector is along the last dimension.
-    We compress
+    number of codes per int64 word, the left shift of each of its slots
+    (the first code in the most significant bits) and the code mask.
+    Cached, the shifts must not be modified.
     """
-    assert long_tensor.dtype == torch.int64
     assert LONG_BITS % nbit == 0
-    # n_entry is the # of entries each long value can contain
     n_entry = LONG_BITS // nbit
-    mask = int("".join(['0'] * (LONG_BITS - nbit) + ['1'] * nbit), 2)
-    out_shape = list(long_tensor.shape)
-    out_shape[-1] = math.ceil(out_shape[-1] / n_entry)
-    out = torch.zeros(*out_shape, device=long_tensor.device, dtype=torch.int64)
-    out_flat = out.view(-1, out_shape[-1])
-    long_tensor_flat = long_tensor.view(-1, long_tensor.shape[-1])
+    shifts = torch.arange(
+        n_entry - 1, -1, -1, dtype=torch.int64, device=device) * nbit
+    return n_entry, shifts, 2**nbit - 1
 
-    for i in range(n_entry):
-        # number of value to compress
-        n_val = long_tensor_flat[:, i::n_entry].size(-1)
-        out_flat[:, :n_val] |= (long_tensor_flat[:, i::n_entry] & mask) << (
-            (n_entry - i - 1) * nbit)
-    return out  # out is the original version of out_flat
+def _chunk_rows(n_row_values, chunk_rows):
+    """ rows per chunk of rows of n_row_values values """
+    if chunk_rows is None:
+        chunk_rows = PACK_CHUNK_VALUES // max(1, n_row_values)
+    return max(1, chunk_rows)
+
+def compress_long_mat(long_tensor, nbit, chunk_rows=None):
+    """
+    we assume a single vector is along the last dimension.
+    We compress every n_entry = 64 // nbit consecutive codes into an
+    int64 word. The codes of chunk_rows vectors (by default as many
+    as PACK_CHUNK_VALUES codes) are packed at a time.
+    """
+    assert long_tensor.dtype == torch.int64
+    n_entry, shifts, mask = _long_mat_layout(nbit, long_tensor.device)
+    dim = long_tensor.shape[-1]
+    n_word = math.ceil(dim / n_entry)
+    out_shape = list(long_tensor.shape)
+    out_shape[-1] = n_word
+    out = torch.empty(*out_shape, device=long_tensor.device, dtype=torch.int64)
+    out_flat = out.view(-1, n_word)
+    long_tensor_flat = long_tensor.reshape(-1, dim)
+    chunk_rows = _chunk_rows(n_word * n_entry, chunk_rows)
+    for row in range(0, long_tensor_flat.size(0), chunk_rows):
+        chunk = long_tensor_flat[row:row + chunk_rows]
+        if dim == n_word * n_entry:
+            codes = chunk & mask
+        else:
+            # the last word is zero padded
+            codes = torch.zeros(chunk.size(0), n_word * n_entry,
+                                device=chunk.device, dtype=torch.int64)
+            torch.bitwise_and(chunk, mask, out=codes[:, :dim])
+        codes = codes.view(-1, n_word, n_entry).bitwise_left_shift_(shifts)
+        # the slots do not overlap, so the sum is equivalent to bitwise or
+        torch.sum(codes, dim=-1, out=out_flat[row:row + chunk_rows])
+    return out
 
-def decompress_long_mat(byte_tensor, nbit, dim=None):
+def decompress_long_mat(byte_tensor, nbit, dim=None, out=None,
+                        chunk_rows=None):
     """
     we assume a single vector is along the last dimension.
+    If out is given (an integer tensor of the output shape, e.g. of a
+    narrower dtype than int64), the codes are written into it. The words
+    of chunk_rows vectors (see compress_long_mat) are unpacked at a time.
     """
     assert byte_tensor.dtype == torch.int64
-    assert LONG_BITS % nbit == 0
-    n_entry = LONG_BITS // nbit
-    mask = int("".join(['0'] * (LONG_BITS - nbit) + ['1'] * nbit), 2)
+    n_entry, shifts, mask = _long_mat_layout(nbit, byte_tensor.device)
     out_shape = list(byte_tensor.shape)
-    out_shape[-1] *= n_entry
-    out = torch.zeros(*out_shape, device=byte_tensor.device, dtype=torch.int64)
-    # manipulate as 2d tensors
-    out_flat = out.view(-1, out_shape[-1])
-    byte_tensor_flat = byte_tensor.view(-1, byte_tensor.shape[-1])
-    for i in range(n_entry):
-        out_flat[:, i::n_entry] = (byte_tensor_flat >>
-                                   ((n_entry - i - 1) * nbit)) & mask
-    if dim is not None:
-        # cut the redundent dimensions
-        out_flat = out_flat[:, :dim].contiguous()
+    out_shape[-1] = out_shape[-1] * n_entry if dim is None else dim
+    if out is None:
+        out = torch.empty(
+            *out_shape, device=byte_tensor.device, dtype=torch.int64)
+    assert list(out.shape) == out_shape
+    dim = out_shape[-1]
+    # manipulate as 2d tensors, only the words holding the first dim
+    # values are extracted
+    n_word = math.ceil(dim / n_entry)
+    out_flat = out.view(-1, dim)
+    byte_tensor_flat = byte_tensor.reshape(-1, byte_tensor.shape[-1])
+    chunk_rows = _chunk_rows(n_word * n_entry, chunk_rows)
+    for row in range(0, byte_tensor_flat.size(0), chunk_rows):
+        words = byte_tensor_flat[row:row + chunk_rows, :n_word]
+        codes = (words.unsqueeze(-1) >> shifts).bitwise_and_(mask)
+        out_flat[row:row + chunk_rows] = codes.view(-1, n_word * n_entry)[
+            :, :dim]
+    return out
+
+##################################################################
+# Bit-stream packing. Codes of any width from 1 to 8 bits are laid
+# out as a continuous MSB-first bit stream in a uint8 tensor, so
+# e.g. 3-bit codes take exactly 3 bits per entry. The stream of each
+# vector is padded to a multiple of row_align bytes (e.g. row_align=4
+# keeps every row aligned to int32 words).
+##################################################################
+def stream_row_bytes(dim, nbit, row_align=1):
+    """ number of bytes used to store a vector of dim nbit codes """
+    n_byte = math.ceil(dim * nbit / 8)
+    return math.ceil(n_byte / row_align) * row_align
+
+@functools.lru_cache(maxsize=64)
+def _stream_code_position(dim, nbit, device):
+    """
+    For each of the dim codes, returns the byte holding its first bit
+    and the right shift which extracts it from the 16 bit window
+    formed by this byte and the following one. Cached, the returned
+    tensors must not be modified.
+    """
+    start = torch.arange(dim, device=device, dtype=torch.int64) * nbit
+    return start // 8, 16 - start % 8 - nbit
+
+def compress_stream_mat(long_tensor, nbit, row_align=1):
+    """
+    we assume a single vector is along the last dimension.
+    We compress it into a uint8 bit stream of
+    stream_row_bytes(dim, nbit, row_align) bytes.
+    """
+    assert long_tensor.dtype in (torch.uint8, torch.int16, torch.int32,
+                                 torch.int64)
+    assert 1 <= nbit <= 8
+    dim = long_tensor.shape[-1]
+    n_byte = stream_row_bytes(dim, nbit, row_align)
+    byte_idx, shift = _stream_code_position(dim, nbit, long_tensor.device)
+    long_tensor_flat = long_tensor.reshape(-1, dim).long()
+    window = (long_tensor_flat & (2**nbit - 1)) << shift
+    # every code touches at most two bytes, we accumulate the high and
+    # low halves of its 16 bit window. The bits do not overlap, so
+    # the sums are equivalent to bitwise or.
+    out_flat = torch.zeros(
+        long_tensor_flat.size(0),
+        n_byte + 1,
+        device=long_tensor.device,
+        dtype=torch.int64)
+    out_flat.index_add_(1, byte_idx, window >> 8)
+    out_flat.index_add_(1, byte_idx + 1, window & 0xFF)
+    out_shape = list(long_tensor.shape)
+    out_shape[-1] = n_byte
+    return out_flat[:, :n_byte].to(torch.uint8).view(*out_shape)
+
+@functools.lru_cache(maxsize=64)
+def _stream_decode_layout(dim, nbit, n_byte, device):
+    """
+    the bytes holding the first and the last bits of the 16 bit window
+    of every code in a stream of n_byte bytes, and the int32 right
+    shifts. Cached, the returned tensors must not be modified.
+    """
+    byte_idx, shift = _stream_code_position(dim, nbit, device)
+    # codes ending in the last byte have shift >= 8, so the clamped
+    # low byte never contributes to them
+    next_idx = (byte_idx + 1).clamp(max=n_byte - 1)
+    return byte_idx, next_idx, shift.int()
+
+def _new_tensor(device):
+    """ a workspace function (see decompress_stream_mat) which allocates """
+    return lambda name, shape, dtype: torch.empty(
+        *shape, dtype=dtype, device=device)
+
+def decompress_stream_mat(byte_tensor, nbit, dim, out=None, chunk_rows=None,
+                          workspace=None):
+    """
+    we assume a single vector is along the last dimension.
+    Returns the dim int64 codes stored in each bit stream. If out is
+    given (an integer tensor of the output shape, e.g. int32), the codes
+    are written into it. The streams of chunk_rows vectors (see
+    compress_long_mat) are unpacked at a time with uint8 and int32
+    intermediates, whose buffers are returned by
+    workspace(name, shape, dtype) if given (e.g. QuantEmbedding._workspace).
+    """
+    assert byte_tensor.dtype == torch.uint8
+    assert 1 <= nbit <= 8
+    n_byte = byte_tensor.shape[-1]
+    assert n_byte >= math.ceil(dim * nbit / 8)
+    byte_idx, next_idx, shift = _stream_decode_layout(
+        dim, nbit, n_byte, byte_tensor.device)
+    out_shape = list(byte_tensor.shape)
+    out_shape[-1] = dim
+    if out is None:
+        out = torch.empty(
+            *out_shape, device=byte_tensor.device, dtype=torch.int64)
+    assert list(out.shape) == out_shape
+    if workspace is None:
+        workspace = _new_tensor(byte_tensor.device)
+    out_flat = out.view(-1, dim)
+    byte_tensor_flat = byte_tensor.reshape(-1, n_byte)
+    chunk_rows = _chunk_rows(dim, chunk_rows)
+    for row in range(0, byte_tensor_flat.size(0), chunk_rows):
+        chunk = byte_tensor_flat[row:row + chunk_rows]
+        n = chunk.size(0)
+        high = torch.index_select(
+            chunk, 1, byte_idx,
+            out=workspace("stream_high", [n, dim], torch.uint8))
+        low = torch.index_select(
+            chunk, 1, next_idx,
+            out=workspace("stream_low", [n, dim], torch.uint8))
+        # mixed dtype ops would allocate a promoted copy of low
+        low_int = workspace("stream_low_int", [n, dim], torch.int32).copy_(low)
+        # the windows of int32 outputs are computed in place
+        in_place = out.dtype == torch.int32
+        window = out_flat[row:row + n] if in_place else workspace(
+            "stream_window", [n, dim], torch.int32)
+        window.copy_(high).bitwise_left_shift_(8).bitwise_or_(low_int)
+        window.bitwise_right_shift_(shift).bitwise_and_(2**nbit - 1)
+        if not in_place:
+            out_flat[row:row + n].copy_(window)
+    return out
+
+##################################################################
+# Lookup-table (LUT) decoding helpers. For nbit in (1, 2, 4, 8),
+# every byte of the packed representation holds 8 // nbit codes,
+# so a [256, 8 // nbit] table maps each packed byte directly to
+# its decoded float values in a single gather.
+##################################################################
+def byte_code_table(nbit):
+    """
+    Returns a [256, 8 // nbit] LongTensor, row b holds the codes
+    packed in the byte value b (most significant code first).
+    """
+    assert 8 % nbit == 0, "byte lookup tables require nbit in (1, 2, 4, 8)"
+    codes_per_byte = 8 // nbit
+    mask = 2**nbit - 1
+    byte_vals = torch.arange(256, dtype=torch.int64).view(-1, 1)
+    shifts = torch.arange(
+        codes_per_byte - 1, -1, -1, dtype=torch.int64) * nbit
+    return (byte_vals >> shifts) & mask
+
+def long_mat_to_bytes(long_tensor):
+    """
+    Reinterpret the int64 words produced by compress_long_mat as a
+    byte stream along the last dimension. The first code of each
+    word lives in its most significant bits, so bytes are ordered
+    from the most to the least significant one within each word.
+    """
+    assert long_tensor.dtype == torch.int64
+    long_tensor = long_tensor.contiguous()
+    byte_tensor = long_tensor.view(torch.uint8)
+    if sys.byteorder == "little":
         out_shape = list(byte_tensor.shape)
-        out_shape[-1] = dim
-        out = out_flat.view(*out_shape)
+        byte_tensor = byte_tensor.view(
+            *out_shape[:-1], -1, LONG_BITS // 8).flip(-1).reshape(out_shape)
+    return byte_tensor
+
+def decompress_lut(byte_tensor, lut, dim=None):
+    """
+    Decode a uint8 tensor of packed codes (last dimension is the byte
+    stream of a single vector) into float values. lut is a
+    [256, codes_per_byte] table, e.g. value_list[byte_code_table(nbit)].
+    """
+    assert byte_tensor.dtype == torch.uint8
+    codes_per_byte = lut.size(-1)
+    if dim is not None:
+        # only decode the bytes which hold the first dim codes
+        byte_tensor = byte_tensor[..., :math.ceil(dim / codes_per_byte)]
+    out_shape = list(byte_tensor.shape)
+    out_shape[-1] *= codes_per_byte
+    out = torch.index_select(lut, 0,
+                             byte_tensor.reshape(-1).int()).view(*out_shape)
+    if dim is not None and dim != out_shape[-1]:
+        # cut the redundent dimensions in the last byte
+        out = out[..., :dim].contiguous()
     return out
 
+##################################################################
+# Binary container for compressed embeddings. Layout:
+#   CONTAINER_MAGIC (8 bytes), version and header length (two
+#   little-endian uint32), a JSON header, then every array at the
+#   CONTAINER_ALIGN aligned offset recorded in the header, followed
+#   by the optional newline separated utf-8 vocabulary.
+##################################################################
+CONTAINER_MAGIC = b"SMALLFRY"
+CONTAINER_VERSION = 1
+CONTAINER_ALIGN = 64
+
+def save_compressed(file_name, meta, arrays, vocab=None):
+    """
+    Write the numpy arrays in the dict arrays together with the JSON
+    serializable dict meta (and an optional list of words) to file_name.
+    """
+    header = {"meta": meta, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header["arrays"][name] = {
+            "dtype": array.dtype.newbyteorder("<").str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += math.ceil(array.nbytes / CONTAINER_ALIGN) * CONTAINER_ALIGN
+    vocab_bytes = b""
+    if vocab is not None:
+        vocab_bytes = "\n".join(vocab).encode("utf8")
+        header["vocab"] = {"offset": offset, "nbytes": len(vocab_bytes),
+                           "size": len(vocab)}
+    header_bytes = json.dumps(header).encode("utf8")
+    prefix = len(CONTAINER_MAGIC) + 8 + len(header_bytes)
+    data_start = math.ceil(prefix / CONTAINER_ALIGN) * CONTAINER_ALIGN
+    with open(file_name, "wb") as f:
+        f.write(CONTAINER_MAGIC)
+        f.write(struct.pack("<II", CONTAINER_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).astype(
+                header["arrays"][name]["dtype"], copy=False).tobytes())
+        f.seek(data_start + offset)
+        f.write(vocab_bytes)
+        f.truncate()
+
+def load_compressed(file_name, mmap=True):
+    """
+    Read a file written by save_compressed. Returns (meta, arrays, vocab).
+    With mmap=True the arrays are copy-on-write memory maps of the file.
+    """
+    with open(file_name, "rb") as f:
+        if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+            raise Exception(file_name + " is not a compressed embedding file!")
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version > CONTAINER_VERSION:
+            raise Exception("Unsupported compressed embedding file version " +
+                            str(version))
+        header = json.loads(f.read(header_len).decode("utf8"))
+        prefix = len(CONTAINER_MAGIC) + 8 + header_len
+        data_start = math.ceil(prefix / CONTAINER_ALIGN) * CONTAINER_ALIGN
+        arrays = {}
+        for name, info in header["arrays"].items():
+            dtype = np.dtype(info["dtype"])
+            shape = tuple(info["shape"])
+            offset = data_start + info["offset"]
+            if mmap and int(np.prod(shape)) > 0:
+                arrays[name] = np.memmap(
+                    file_name, dtype=dtype, mode="c", offset=offset,
+                    shape=shape)
+            else:
+                f.seek(offset)
+                arrays[name] = np.fromfile(
+                    f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        vocab = None
+        if "vocab" in header:
+            f.seek(data_start + header["vocab"]["offset"])
+            vocab_bytes = f.read(header["vocab"]["nbytes"])
+            vocab = vocab_bytes.decode("utf8").split("\n")
+            if header["vocab"]["size"] == 0:
+                vocab = []
+    return header["meta"], arrays, vocab
+
+def tensor_to_array(tensor):
+    """
+    numpy view of a cpu copy of tensor; numpy has no bfloat16, so
+    bfloat16 tensors are returned as their int16 bit patterns.
+    """
+    tensor = tensor.detach().cpu()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+def array_to_tensor(array, dtype=None):
+    """ inverse of tensor_to_array, dtype is the dtype of the saved tensor """
+    tensor = torch.from_numpy(array)
+    if dtype == torch.bfloat16:
+        tensor = tensor.view(torch.bfloat16)
+    return tensor
+
 ##################################################################
 # Helpers for replacing original pytorch embedding layers to 
 # the quantized embedding layer (i.e. class QuantEmbedding)
 ##################################################################
-def quantize_embed(module, nbit=32):
+def quantize_embed(module,
+                   nbit=32,
+                   n_workers=1,
+                   nbit_overrides=None,
+                   report=False,
+                   **kwargs):
     """
     This function replace all embedding modules
-    to QuantEmbedding layer recursively.
+    to QuantEmbedding layer (and embedding bag modules
+    to QuantEmbeddingBag layer) recursively.
     The input module should be a torch.nn.Module object.
-    nbit specifies the precision for the desired compressed embedding
+    nbit specifies the precision for the desired compressed embedding.
+    The decoded outputs keep the dtype of the replaced embedding weights
+    (e.g. float16 for a half precision model), unless dtype is given.
+    The tables are compressed in parallel on a pool of n_workers threads
+    (the compression runs in numpy and torch, which release the GIL).
+    nbit_overrides maps module names (as in find_embedding_module_name)
+    to the nbit of that module, None leaves the module unchanged.
+    Modules which are already quantized are skipped, and a module
+    shared by several parents is compressed once. The other keyword
+    arguments are passed to QuantEmbedding (e.g. group_size).
+    With report=True, returns (module, report) where report has one
+    dict per compressed table with its name, nbit, compression time in
+    seconds and float / compressed / saved state bytes.
     """
-    for name, child in module.named_children():
-        if isinstance(child, torch.nn.Embedding):
-            quant_embedding = QuantEmbedding(
-                num_embeddings=child.num_embeddings,
-                embedding_dim=child.embedding_dim,
-                padding_idx=child.padding_idx,
-                nbit=nbit,
-                _weight=child.weight)
-            # send the quant embedding layer to gpu
-            # if the original embedding is on gpu
-            if next(child.parameters()).is_cuda:
-                quant_embedding.cuda()
-            setattr(module, name, quant_embedding)
-            logging.info("Replaced " + name + " in " +
-                         module.__class__.__name__)
-        else:
-            quantize_embed(child, nbit)
+    nbit_overrides = nbit_overrides or {}
+    targets = collections.OrderedDict()
+    for name, parent, child_name, child in _find_embedding_children(module):
+        table_nbit = nbit_overrides.get(name, nbit)
+        if table_nbit is None:
+            continue
+        if id(child) not in targets:
+            targets[id(child)] = (name, child, table_nbit, [])
+        targets[id(child)][3].append((parent, child_name))
+
+    def convert(name, child, table_nbit):
+        start = time.time()
+        quant_embedding = _quantize_embedding_module(child, table_nbit, **kwargs)
+        return quant_embedding, {
+            "name": name,
+            "nbit": table_nbit,
+            "seconds": time.time() - start,
+            "float_bytes": _state_bytes(child),
+            "quant_bytes": _state_bytes(quant_embedding),
+        }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(convert, name, child, table_nbit)
+                   for name, child, table_nbit, _ in targets.values()]
+        results = [future.result() for future in futures]
+    table_report = []
+    for (_, _, _, parents), (quant_embedding, stats) in zip(
+            targets.values(), results):
+        for parent, child_name in parents:
+            setattr(parent, child_name, quant_embedding)
+            logging.info("Replaced " + child_name + " in " +
+                         parent.__class__.__name__)
+        stats["saved_bytes"] = stats["float_bytes"] - stats["quant_bytes"]
+        table_report.append(stats)
+    if report:
+        return module, table_report
     return module
 
+def _find_embedding_children(module, module_name=""):
+    """
+    yields (name, parent, child name, child) for the float embedding
+    (bag) modules, without descending into quantized ones
+    """
+    for child_name, child in module.named_children():
+        name = child_name if module_name == "" else module_name + "." + child_name
+        if isinstance(child, QuantEmbedding):
+            continue
+        if isinstance(child, (torch.nn.Embedding, torch.nn.EmbeddingBag)):
+            yield name, module, child_name, child
+        else:
+            for target in _find_embedding_children(child, name):
+                yield target
+
+def _quantize_embedding_module(child, nbit, **kwargs):
+    """ the QuantEmbedding (or QuantEmbeddingBag) replacing child """
+    # the outputs keep the dtype of child unless dtype is given
+    kwargs.setdefault("dtype", child.weight.dtype)
+    if isinstance(child, torch.nn.EmbeddingBag):
+        quant_embedding = QuantEmbeddingBag(
+            num_embeddings=child.num_embeddings,
+            embedding_dim=child.embedding_dim,
+            mode=child.mode,
+            include_last_offset=child.include_last_offset,
+            padding_idx=child.padding_idx,
+            nbit=nbit,
+            _weight=child.weight,
+            **kwargs)
+    else:
+        quant_embedding = QuantEmbedding(
+            num_embeddings=child.num_embeddings,
+            embedding_dim=child.embedding_dim,
+            padding_idx=child.padding_idx,
+            nbit=nbit,
+            _weight=child.weight,
+            **kwargs)
+    # send the quant embedding layer to gpu
+    # if the original embedding is on gpu
+    if next(child.parameters()).is_cuda:
+        quant_embedding.cuda()
+    return quant_embedding
+
+def _state_bytes(module):
+    return sum(v.element_size() * v.nelement()
+               for v in module.state_dict().values())
+
 def find_embedding_module_name(module, module_name=""):
     module_name_list = []
     for name, child in module.named_children():
-        if isinstance(child, torch.nn.Embedding):
+        if isinstance(child, (torch.nn.Embedding, torch.nn.EmbeddingBag)):
             if module_name == "":
                 module_name_list.append(name)
             else:
@@ -118,6 +522,161 @@ def find_embedding_module_name(module, module_name=""):
                     child, module_name + "." + name)
     return module_name_list
 
+##################################################################
+# Memory-budgeted bit widths. The nbit of every embedding table is
+# chosen to minimize the sum of the estimated squared errors of the
+# tables under a byte budget: a multiple-choice knapsack, solved by
+# dynamic programming over the budget left by the smallest choices,
+# split into BUDGET_UNITS units (the bytes are rounded up to units).
+##################################################################
+BUDGET_UNITS = 10000
+BUDGET_NBITS = (1, 2, 3, 4, 5, 6, 7, 8, 16, 32)
+# rows sampled to estimate the error of group-wise quantization
+BUDGET_GROUP_SAMPLE_ROWS = 10000
+
+def quant_state_bytes(num_embeddings,
+                      embedding_dim,
+                      nbit,
+                      dtype=torch.float32,
+                      packing="auto",
+                      row_align=1,
+                      group_size=None):
+    """ state dict bytes of a QuantEmbedding with these settings """
+    element_size = torch.empty(0, dtype=dtype).element_size()
+    if nbit == 32:
+        return num_embeddings * embedding_dim * element_size
+    if packing == "auto":
+        packing = "long" if LONG_BITS % nbit == 0 else "stream"
+    if packing == "stream":
+        row_bytes = stream_row_bytes(embedding_dim, nbit, row_align)
+    else:
+        row_bytes = math.ceil(embedding_dim * nbit / LONG_BITS) * LONG_BITS // 8
+    n_bytes = num_embeddings * row_bytes + 2**nbit * element_size
+    if group_size is not None:
+        # float16 steps
+        n_bytes += num_embeddings * math.ceil(
+            embedding_dim / min(group_size, embedding_dim)) * 2
+    return n_bytes
+
+def _packing_supports(packing, nbit):
+    if packing == "long":
+        return LONG_BITS % nbit == 0
+    return packing == "auto" or nbit <= 8
+
+def _estimate_table_errors(weight, nbits, group_size=None):
+    """ estimated squared quantization error of weight for every nbit """
+    X = weight.detach().cpu().float().numpy()
+    if group_size is None:
+        return compress.estimate_distortion_curve(X, nbits)
+    # every group has its own range, the error is measured on sampled rows
+    n_sample = min(X.shape[0], BUDGET_GROUP_SAMPLE_ROWS)
+    rows = np.sort(np.random.choice(X.shape[0], n_sample, replace=False))
+    errors = {}
+    for nbit in nbits:
+        _, _, error, _ = compress.compress_uniform_grouped_codes(
+            X[rows], nbit, group_size=group_size, adaptive_range=True)
+        errors[nbit] = error * X.shape[0] / n_sample
+    return errors
+
+def plan_embedding_bits(module,
+                        byte_budget,
+                        nbits=BUDGET_NBITS,
+                        table_weights=None,
+                        **kwargs):
+    """
+    Choose the nbit (in nbits) of every float embedding (bag) module of
+    module, so that the quantized modules hold at most byte_budget state
+    bytes in total and the sum of their estimated squared quantization
+    errors (each multiplied by table_weights[name] if given) is minimal.
+    The errors are estimated from a histogram of every table (see
+    compress.estimate_distortion_curve), or on sampled rows with
+    group_size. kwargs are the QuantEmbedding arguments passed to
+    quantize_embed; packing, row_align and group_size are taken into
+    account in the bytes. Returns the plan, a list of dicts with the
+    name, nbit, state bytes and estimated error of every table.
+    """
+    table_weights = table_weights or {}
+    group_size = kwargs.get("group_size")
+    if group_size is not None:
+        # group-wise scales require nbit < 32
+        nbits = [nbit for nbit in nbits if nbit != 32]
+    layout = {key: kwargs[key] for key in ("packing", "row_align", "group_size")
+              if key in kwargs}
+    tables = []
+    seen = set()
+    for name, _, _, child in _find_embedding_children(module):
+        if id(child) in seen:
+            continue
+        seen.add(id(child))
+        errors = _estimate_table_errors(child.weight, nbits, group_size)
+        options = [(quant_state_bytes(child.num_embeddings,
+                                      child.embedding_dim, nbit,
+                                      dtype=kwargs.get(
+                                          "dtype", child.weight.dtype),
+                                      **layout),
+                    errors[nbit] * table_weights.get(name, 1.0), nbit)
+                   for nbit in nbits if _packing_supports(
+                       layout.get("packing", "auto"), nbit)]
+        tables.append((name, options))
+    min_bytes = sum(min(option[0] for option in options)
+                    for _, options in tables)
+    if min_bytes > byte_budget:
+        raise Exception("The byte budget is below the " + str(min_bytes) +
+                        " bytes of the smallest plan!")
+    # dynamic programming over the budget above the smallest choices,
+    # best[b] is the least error of the tables so far within b units
+    unit = max(1.0, (byte_budget - min_bytes) / BUDGET_UNITS)
+    n_unit = int((byte_budget - min_bytes) // unit)
+    best = np.zeros(n_unit + 1)
+    choices = []
+    for _, options in tables:
+        base = min(option[0] for option in options)
+        costs = [math.ceil((option[0] - base) / unit) for option in options]
+        new_best = np.full(n_unit + 1, np.inf)
+        choice = np.zeros(n_unit + 1, dtype=np.int64)
+        for k, (cost, (_, error, _)) in enumerate(zip(costs, options)):
+            if cost > n_unit:
+                continue
+            candidate = np.full(n_unit + 1, np.inf)
+            candidate[cost:] = best[:n_unit + 1 - cost] + error
+            better = candidate < new_best
+            new_best[better] = candidate[better]
+            choice[better] = k
+        best = new_best
+        choices.append((choice, costs))
+    plan = []
+    budget = n_unit
+    for (name, options), (choice, costs) in reversed(
+            list(zip(tables, choices))):
+        k = int(choice[budget])
+        budget -= costs[k]
+        n_bytes, error, nbit = options[k]
+        plan.append({"name": name, "nbit": nbit, "bytes": n_bytes,
+                     "error": error})
+    plan.reverse()
+    logging.info("Planned embedding bits " + json.dumps(
+        {table["name"]: table["nbit"] for table in plan}) + " in " +
+        str(sum(table["bytes"] for table in plan)) + " bytes")
+    return plan
+
+def quantize_embed_to_budget(module,
+                             byte_budget,
+                             nbits=BUDGET_NBITS,
+                             table_weights=None,
+                             n_workers=1,
+                             **kwargs):
+    """
+    Quantize the embedding modules of module (see quantize_embed) with
+    the nbit of every table chosen by plan_embedding_bits to fit
+    byte_budget bytes. Returns (module, plan).
+    """
+    plan = plan_embedding_bits(module, byte_budget, nbits=nbits,
+                               table_weights=table_weights, **kwargs)
+    quantize_embed(module, n_workers=n_workers,
+                   nbit_overrides={table["name"]: table["nbit"]
+                                   for table in plan}, **kwargs)
+    return module, plan
+
 ##################################################################
 # Misc helpers
 ##################################################################
@@ -153,7 +712,8 @@ def load_embed_from_ckpt(model, ckpt_file):
     model_dict.update(emb_state_dict)
     model.load_state_dict(model_dict)
 
-def print_model_mem(model):
+def get_model_mem(model):
+    """ returns the (embedding, non-embedding) state memory in bytes """
     embed_module_names = find_embedding_module_name(model)
     embed_mem = 0.0
     non_embed_mem = 0.0
@@ -167,6 +727,10 @@ def print_model_mem(model):
             embed_mem += v.element_size() * v.nelement()
         else:
             non_embed_mem += v.element_size() * v.nelement()
+    return embed_mem, non_embed_mem
+
+def print_model_mem(model):
+    embed_mem, non_embed_mem = get_model_mem(model)
     logging.info("Embed memory (bytes) " + str(embed_mem))
     logging.info("Non-embed memory (bytes) " + str(non_embed_mem))
 
@@ -176,8 +740,8 @@ def reshape_ckpt_value_list_shape(model, state, nbit):
         # print("test ", name, state.keys())
         if name + ".value_list" in state.keys():
             # assert name + ".value_list" in state.keys(), "embedding not found in the ckpt!"
-            value_list = torch.zeros([2**nbit], dtype=torch.float32)
             old_value_list = state[name + ".value_list"]
+            value_list = torch.zeros([2**nbit], dtype=old_value_list.dtype)
             state[name + ".value_list"] = value_list
             state[name + ".value_list"][:old_value_list.nelement()].copy_(
                 old_value_list)
@@ -202,12 +766,146 @@ def log_param_list(model):
     for name, param in model.named_parameters():
         logging.info('{} {} {} {}'.format(name, param.dtype, param.requires_grad, param.shape))
 
+##################################################################
+# Runtime instrumentation. The counters of a QuantEmbedding are off
+# until enable_stats is called; the decode stages are then timed and
+# marked as smallfry::<stage> ranges in torch.profiler traces (the
+# ranges are also recorded while a profiler runs without counters).
+##################################################################
+STAT_STAGES = ("gather", "decode", "value_map")
+STAT_COUNTERS = ("calls", "lookups", "unique_ids", "decoded_rows",
+                 "bytes_read", "bytes_produced", "cache_hits",
+                 "cache_misses") + tuple(
+                     stage + "_seconds" for stage in STAT_STAGES)
+# counters are updated from concurrent forward calls
+_stats_lock = threading.Lock()
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    """ times a decode stage of module and marks it in profiler traces """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.sync = module._stats is not None and module.weight.is_cuda
+
+    def __enter__(self):
+        self.range = None
+        if torch.autograd._profiler_enabled():
+            self.range = torch.profiler.record_function(
+                "smallfry::" + self.name)
+            self.range.__enter__()
+        if self.sync:
+            torch.cuda.synchronize(self.module.weight.device)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.module._stats is not None:
+            if self.sync:
+                torch.cuda.synchronize(self.module.weight.device)
+            self.module._count(**{
+                self.name + "_seconds": time.perf_counter() - self.start})
+        if self.range is not None:
+            self.range.__exit__(*args)
+        return False
+
+def _derive_stats(counters):
+    """ counters along with the rates derived from them """
+    stats = dict(counters)
+    calls = counters["calls"]
+    stats["unique_ids_per_batch"] = counters["unique_ids"] / calls if calls else 0.
+    stats["lookups_per_batch"] = counters["lookups"] / calls if calls else 0.
+    n_cached = counters["cache_hits"] + counters["cache_misses"]
+    stats["cache_hit_rate"] = (counters["cache_hits"] / n_cached
+                               if n_cached else None)
+    stats["bytes_ratio"] = (counters["bytes_read"] / counters["bytes_produced"]
+                            if counters["bytes_produced"] else None)
+    return stats
+
+def _quant_embedding_modules(model):
+    """ (name, module) of the QuantEmbedding modules of model """
+    modules = dict(model.named_modules())
+    return [(name, modules[name]) for name in find_embedding_module_name(model)
+            if isinstance(modules[name], QuantEmbedding)]
+
+def enable_embedding_stats(model):
+    """ enable the counters of every QuantEmbedding module of model """
+    for _, module in _quant_embedding_modules(model):
+        module.enable_stats()
+
+def disable_embedding_stats(model):
+    for _, module in _quant_embedding_modules(model):
+        module.disable_stats()
+
+def get_embedding_stats(model):
+    """
+    Returns a dict from the names of the QuantEmbedding modules of model
+    with enabled counters to their stats(), with the sum of the counters
+    over these modules under "total".
+    """
+    stats = {}
+    total = dict.fromkeys(STAT_COUNTERS, 0)
+    for name, module in _quant_embedding_modules(model):
+        if module._stats is None:
+            continue
+        stats[name] = module.stats()
+        for key in STAT_COUNTERS:
+            total[key] += stats[name][key]
+    stats["total"] = _derive_stats(total)
+    return stats
+
+
+##################################################################
+# Codebook training. The packed codes stay fixed and value_list is
+# the trainable tensor: the gradient of a value is the sum of the
+# output gradients (times the group steps) of the entries holding
+# its code, accumulated batch by batch without a float table.
+##################################################################
+# rows of a batch whose codes are gathered at once in backward
+CODEBOOK_GRAD_CHUNK_ROWS = 4096
+
+
+class _CodebookLookup(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, value_list, module, input):
+        ctx.module = module
+        ctx.save_for_backward(input)
+        return module._decode_rows(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        module = ctx.module
+        grad_value_list = module._codebook_grad(
+            input.reshape(-1), grad_output.reshape(-1, module.embedding_dim))
+        return grad_value_list, None, None
 
 
 ##################################################################
 # The quantized embedding pytorch layer
 ##################################################################
 class QuantEmbedding(nn.Embedding):
+    # batches with at most DEDUP_MIN_SIZE ids are never deduplicated
+    DEDUP_MIN_SIZE = 256
+    # rows scored per task by topk
+    TOPK_BLOCK_ROWS = 16384
+    # topk scores at most ADC_MAX_QUERIES queries from the packed bytes
+    ADC_MAX_QUERIES = 2
+    dedup = "auto"
+    dedup_ratio = 0.5
+    # runtime counters, None while disabled (see enable_stats)
+    _stats = None
+
     def __init__(self,
                  num_embeddings,
                  embedding_dim,
@@ -218,14 +916,28 @@ class QuantEmbedding(nn.Embedding):
                  sparse=False,
                  _weight=None,
                  nbit=32,
-                 embedding_file=None):
+                 embedding_file=None,
+                 decode="auto",
+                 packing="auto",
+                 row_align=1,
+                 group_size=None,
+                 dedup="auto",
+                 dedup_ratio=0.5,
+                 dtype=None,
+                 range_limit=None,
+                 cache=None):
         """
         Impelmentation of the quantized embedding layer. This layer
         memory efficient embedding storage during inference. Currently,
-        the implementation support 1, 2, 4, 8, 16 bit represention.
+        the implementation support 1 to 8 and 16 bit represention.
         The QuantEmbedding layer save the quantized representation in
         LongTensor, during forward for inference, the bits are extracted
         from LongTensor and put into Float32 tensor for inference.
+        packing selects the storage layout: "long" packs 64 // nbit codes
+        into each int64 word (nbit in 1, 2, 4, 8, 16), "stream" stores
+        the codes of each vector as a continuous bit stream in a uint8
+        tensor padded to a multiple of row_align bytes (nbit from 1 to 8).
+        "auto" uses "long" whenever nbit divides 64.
         There are 2 ways to initialize the quantized embedding layer:
             1. a float32 tensor containing quantized or unquantized values
                 _weight=<a float32 tensor>, embedding_file=None
@@ -233,8 +945,39 @@ class QuantEmbedding(nn.Embedding):
                 _weight=None, quantized_input=<file name>
         If you use the file-style input, for reference format,
         please refer to http://nlp.stanford.edu/data/glove.6B.zip.
+        decode selects how forward extracts the values: "lut" maps every
+        packed byte to its float values with a precomputed lookup table
+        (nbit in 1, 2, 4, 8), "shift" extracts the integer codes with
+        decompress_long_mat / decompress_stream_mat before indexing
+        value_list. "auto" uses "lut" whenever it is supported.
+        group_size enables group-wise quantization: every row is split
+        into blocks of group_size columns (use embedding_dim for one
+        block per row), and each block gets its own clipping range. The
+        per-block steps are kept in the float16 group_scales buffer and
+        applied to the decoded (centered) codes during forward.
+        dedup makes forward decode every distinct id of a batch once and
+        scatter the rows back through the inverse index. With "auto" this
+        is done when the ratio of distinct ids to positions is at most
+        dedup_ratio.
+        dtype (float32 by default, float16 or bfloat16) is the dtype of
+        value_list, and thus of the decode and of the forward outputs. For
+        nbit=32 it is the dtype of the stored weight.
+        range_limit, if set, is the clipping range of the quantization
+        instead of the one searched from the data (e.g. to share
+        value_list between tables).
+        cache is the on-disk cache of compressed tables (see
+        compression_cache.resolve_cache, the SMALLFRY_CACHE_DIR cache by
+        default): the packed table is looked up by a hash of the input
+        weights or file and of the settings, and compression is skipped
+        on a hit.
         """
-        assert nbit in (1, 2, 4, 8, 16, 32)
+        if dtype is None:
+            dtype = torch.float32
+        assert dtype in (torch.float32, torch.float16, torch.bfloat16)
+        assert dedup in ("auto", True, False)
+        self.dedup = dedup
+        self.dedup_ratio = dedup_ratio
+        assert nbit in (1, 2, 3, 4, 5, 6, 7, 8, 16, 32)
         assert max_norm == None
         assert norm_type == 2.
         assert scale_grad_by_freq == False
@@ -243,12 +986,11 @@ class QuantEmbedding(nn.Embedding):
                 _weight is not None and embedding_file is not None):
             raise Exception(
                 "Should provide input either from a tensor or a file!")
-        self.nbit = nbit
-        # set the dimensionality of the actual compressed tensor
-        if self.nbit == 32:
-            self.tensor_dim = embedding_dim
-        else:
-            self.tensor_dim = math.ceil(embedding_dim * nbit / LONG_BITS)
+        self._init_layout(embedding_dim, nbit, decode, packing, row_align,
+                          group_size)
+        if range_limit is not None:
+            assert nbit != 32 and group_size is None, \
+                "range_limit requires nbit < 32 and no group-wise scales"
         nn.Embedding.__init__(
             self,
             num_embeddings,  # we use the actual tensor dim here, otherwise will raise error
@@ -257,7 +999,8 @@ class QuantEmbedding(nn.Embedding):
             max_norm=max_norm,
             norm_type=norm_type,
             scale_grad_by_freq=scale_grad_by_freq,
-            sparse=sparse)
+            sparse=sparse,
+            dtype=dtype if nbit == 32 else None)
 
         # if we have an cuda input _weight, we convert it to cpu
         # so that the intermediate memory in initialization would
@@ -268,36 +1011,97 @@ class QuantEmbedding(nn.Embedding):
             # we only support forward pass
             self.weight.requires_grad = False
             if embedding_file is not None:
-                _weight = self._load_from_unquant_file_to_uncompressed_tensor(
-                    embedding_file)
-            self.weight.copy_(_weight.data)
+                self._load_from_file(embedding_file)
+            else:
+                self.weight.copy_(_weight.data)
         else:
             self.weight = nn.Parameter(
                 torch.zeros(
-                    num_embeddings, self.tensor_dim, dtype=torch.int64),
+                    num_embeddings,
+                    self.tensor_dim,
+                    dtype=torch.uint8
+                    if self.packing == "stream" else torch.int64),
                 requires_grad=False)
             # record the true embeding_dim
             self.embedding_dim = embedding_dim
-            # load the quantized values from file / tensor to the int64 tensor
-            if self._quantized_input(_weight, embedding_file):
-                if _weight is not None:
-                    assert isinstance(_weight, torch.FloatTensor)
+            # filled in by the compression, in the requested output dtype
+            self.register_buffer("value_list",
+                                 torch.zeros([2**self.nbit], dtype=dtype))
+            self._init_decode_tables()
+            if self.group_size is not None:
+                self._init_group_scales()
+            cache = compression_cache.resolve_cache(cache)
+            if cache is not None:
+                cache_key = self._cache_key(_weight, embedding_file, range_limit)
+            cache_hit = cache is not None and self._load_from_cache(
+                cache, cache_key)
+            if cache_hit:
+                logging.info("Reused the cached compressed embedding")
+            elif embedding_file is not None:
+                # the functionality of compress tensor is included in the loading function here
+                self._load_from_file(embedding_file, range_limit)
+            else:
+                assert _weight.is_floating_point()
+                # quantization runs in float32 (numpy has no bfloat16)
+                _weight = _weight.detach().float()
+                # load the quantized values from tensor to the int64 tensor
+                if self.group_size is not None:
+                    self._compress_tensor_grouped(_weight)
+                elif range_limit is not None:
+                    self._compress_tensor(_weight, range_limit=range_limit)
+                elif self._quantized_input(_weight):
                     # the input weight is already quantized and does not need clipping/quantization
                     self._compress_tensor(_weight, do_quant=False)
-                elif embedding_file is not None:
-                    # the functionality of compress tensor is included in the loading function here
-                    self._load_from_quant_file_to_compressed_tensor(
-                        embedding_file)
-            else:
-                if _weight is not None:
-                    assert isinstance(_weight, torch.FloatTensor)
-                elif embedding_file is not None:
-                    _weight = self._load_from_unquant_file_to_uncompressed_tensor(
-                        embedding_file)
-                # compress _weight into self.weight
-                self._compress_tensor(_weight)
+                else:
+                    # compress _weight into self.weight
+                    self._compress_tensor(_weight)
+            if cache is not None and not cache_hit:
+                cache.put(cache_key, *self._container())
         logging.info("Compressed embedding to " + str(self.nbit) + " bits!")
 
+    def _init_layout(self,
+                     embedding_dim,
+                     nbit,
+                     decode,
+                     packing,
+                     row_align,
+                     group_size=None):
+        """ resolve the storage layout and decoding mode for nbit """
+        assert nbit in (1, 2, 3, 4, 5, 6, 7, 8, 16, 32)
+        if group_size is not None:
+            assert nbit != 32, "group-wise scales require nbit < 32"
+            group_size = min(group_size, embedding_dim)
+        assert packing in ("auto", "long", "stream")
+        if packing == "auto":
+            packing = "long" if LONG_BITS % nbit == 0 else "stream"
+        if packing == "long" and LONG_BITS % nbit != 0:
+            raise Exception("Long packing only supports nbit dividing 64!")
+        if packing == "stream" and nbit > 8:
+            raise Exception("Stream packing only supports nbit <= 8!")
+        assert decode in ("auto", "lut", "shift")
+        if decode == "auto":
+            decode = "lut" if 8 % nbit == 0 else "shift"
+        if decode == "lut" and 8 % nbit != 0:
+            raise Exception("LUT decoding only supports nbit in (1, 2, 4, 8)!")
+        self.nbit = nbit
+        self.decode = decode
+        self.packing = packing
+        self.row_align = row_align
+        self.group_size = group_size
+        # set the dimensionality of the actual compressed tensor
+        if self.nbit == 32:
+            self.tensor_dim = embedding_dim
+        elif self.packing == "stream":
+            self.tensor_dim = stream_row_bytes(embedding_dim, nbit, row_align)
+        else:
+            self.tensor_dim = math.ceil(embedding_dim * nbit / LONG_BITS)
+
+    def _init_decode_tables(self):
+        if self.decode == "lut":
+            # the table is derived from nbit only, no need to save it
+            self.register_buffer(
+                "byte_codes", byte_code_table(self.nbit), persistent=False)
+
     def _get_value_list_from_tensor(self, weight):
         # get the unique values into a list
         if isinstance(weight, torch.FloatTensor):
@@ -305,40 +1109,26 @@ class QuantEmbedding(nn.Embedding):
         sorted_vals = sorted(np.unique(weight).tolist())
         return sorted_vals
 
-    def _get_value_list_from_file(self, file_name):
-        value_set = set([])
-        with open(file_name, "r") as f:
-            for line_id, line in enumerate(f.readlines()):
-                for value in line.strip('\n').split(" ")[1:]:
-                    value_set.add(float(value))
-        sorted_vals = sorted(list(value_set))
-        return sorted_vals
+    def _quantized_input(self, weight):
+        # a few rows are usually enough to tell an unquantized tensor apart
+        if len(self._get_value_list_from_tensor(
+                weight[:FILE_CHUNK_ROWS])) > 2**self.nbit:
+            return False
+        return len(self._get_value_list_from_tensor(weight)) <= 2**self.nbit
 
-    def _quantized_input(self, weight, embedding_file):
-        assert weight is None or embedding_file is None, " Can only use one out of Tensor or File as input!"
-        if weight is not None:
-            return len(
-                self._get_value_list_from_tensor(weight)) <= 2**self.nbit
-        else:
-            return len(
-                self._get_value_list_from_file(embedding_file)) <= 2**self.nbit
-
-    def _load_from_unquant_file_to_uncompressed_tensor(self, file_name):
-        weight = torch.zeros(self.num_embeddings, self.embedding_dim)
-        # put vectors into int32 tensor
-        with open(file_name, "r") as f:
-            for line_id, line in enumerate(f.readlines()):
-                vector = line2vec(line)
-                if self.embedding_dim != vector.numel():
-                    raise Exception(
-                        "Dimensionality in embedding file does not match dimensionality specified for embedding layer"
-                    )
-                weight[line_id].copy_(vector)
-        return weight
-
-    def _compress_tensor(self, weight, do_quant=True):
+    def _set_value_list(self, sorted_vals):
+        """ register sorted_vals, padded to 2**nbit entries, as value_list """
+        assert len(sorted_vals) <= 2**self.nbit
+        if len(sorted_vals) < 2**self.nbit:
+            logging.warning(
+                "Set of actual values is smaller than set of possible values.")
+        self.value_list.zero_()
+        self.value_list[:len(sorted_vals)].copy_(torch.FloatTensor(sorted_vals))
+
+    def _compress_tensor(self, weight, do_quant=True, range_limit=None):
         '''
-        if weight is not quantized yet, we specify do_quant to quantize here
+        if weight is not quantized yet, we specify do_quant to quantize here,
+        with the clipping range range_limit if given
         '''
         if (weight.shape[0] != self.num_embeddings) or (weight.shape[1] !=
                                                         self.embedding_dim):
@@ -346,73 +1136,1138 @@ class QuantEmbedding(nn.Embedding):
                 "The shape of the input embedding does not match the compressed tensor!"
             )
         assert self.nbit != 32, "_compress_tensor should only be called when nbit < 32"
+        weight = weight.detach().cpu().numpy()
         if do_quant:
-            weight, _, _ = compress.compress_uniform(
-                weight.detach().cpu().numpy(),
-                self.nbit,
-                adaptive_range=True,
-                stochastic_round=False)
+            if range_limit is None:
+                codes, scale, offset, _, _ = compress.compress_uniform_codes(
+                    weight,
+                    self.nbit,
+                    adaptive_range=True,
+                    stochastic_round=False)
+            else:
+                codes, scale, offset = compress._compress_uniform_codes(
+                    weight, self.nbit, range_limit)
+            sorted_vals = compress._dequantize(
+                np.arange(2**self.nbit, dtype=weight.dtype), scale, offset)
         else:
-            weight = weight.detach().cpu().numpy()
-        # construct value dict
-        sorted_vals = self._get_value_list_from_tensor(weight)
-        value_list = torch.zeros([2**self.nbit], dtype=torch.float32)
-        value_list[:len(sorted_vals)].copy_(torch.FloatTensor(sorted_vals))
-        self.register_buffer("value_list", value_list)
-        self.value_dict = {
-            float(value): i
-            for i, value in enumerate(sorted_vals)
-        }
-        assert len(sorted_vals) <= 2**self.nbit
-        if len(sorted_vals) < 2**self.nbit:
-            logging.warning(
-                "Set of actual values is smaller than set of possible values.")
-        weight = np.vectorize(self.value_dict.get)(weight)
+            # the codes index the sorted set of values of the input
+            sorted_vals, codes = np.unique(weight, return_inverse=True)
+            codes = codes.reshape(weight.shape)
+        self._set_value_list(sorted_vals)
         # compress vectors into quantized embeddings
-        self.weight.copy_(
-            compress_long_mat(torch.LongTensor(weight), nbit=self.nbit))
+        self._pack_into(codes)
 
-    def _load_from_quant_file_to_compressed_tensor(self, file_name):
-        if self.nbit != 32:
-            # construct the mapping between quantized index and quantized value
-            sorted_vals = self._get_value_list_from_file(file_name)
-            self.register_buffer("value_list", torch.FloatTensor(sorted_vals))
-            self.value_dict = {
-                float(value): i
-                for i, value in enumerate(sorted_vals)
-            }
-            assert len(sorted_vals) <= 2**self.nbit
-            if len(sorted_vals) < 2**self.nbit:
-                logging.warning(
-                    "Set of actual values is smaller than set of possible values."
-                )
+    def _init_group_scales(self):
+        """ grouped codes decode to centered levels, scaled per group in forward """
+        self.value_list.copy_(torch.arange(
+            2**self.nbit, dtype=torch.float32) - (2**self.nbit - 1) / 2)
+        self.register_buffer(
+            "group_scales",
+            torch.zeros(
+                self.num_embeddings,
+                math.ceil(self.embedding_dim / self.group_size),
+                dtype=torch.float16))
+
+    def _compress_tensor_grouped(self, weight, row_start=None):
+        """
+        quantize the rows of weight with group-wise scales and write them
+        to self.weight / self.group_scales starting from row row_start
+        (weight is a chunk of rows), or as the whole table if None
+        """
+        n_rows = self.num_embeddings if row_start is None else (
+            min(weight.shape[0], self.num_embeddings - row_start))
+        if (weight.shape[0] != n_rows) or (weight.shape[1] !=
+                                           self.embedding_dim):
+            raise Exception(
+                "The shape of the input embedding does not match the compressed tensor!"
+            )
+        row_start = row_start or 0
+        if isinstance(weight, torch.Tensor):
+            weight = weight.detach().cpu().numpy()
+        codes, scales, _, _ = compress.compress_uniform_grouped_codes(
+            weight, self.nbit, group_size=self.group_size, adaptive_range=True)
+        self._pack_into(codes, row_start)
+        self.group_scales[row_start:row_start + scales.shape[0]].copy_(
+            torch.from_numpy(scales))
+
+    def _scan_file(self, file_name):
+        """
+        First streaming pass over an embedding file. Collects the number
+        of vectors, the set of distinct values (as long as the file still
+        looks quantized) and a uniform reservoir sample of at most
+        RANGE_SAMPLE_ROWS vectors used to estimate the clipping range.
+        """
+        n_row = 0
+        value_set = set()
+        sample = np.zeros([RANGE_SAMPLE_ROWS, self.embedding_dim],
+                          dtype=np.float32)
+        for _, chunk in utils.iter_embedding_chunks(
+                file_name, self.embedding_dim, chunk_size=FILE_CHUNK_ROWS):
+            if value_set is not None:
+                value_set.update(np.unique(chunk).tolist())
+                if len(value_set) > 2**self.nbit:
+                    # the file needs to be quantized, stop tracking values
+                    value_set = None
+            # reservoir sampling, rows with a collided slot overwrite
+            # it in file order
+            row_id = np.arange(n_row, n_row + chunk.shape[0])
+            slot = row_id.copy()
+            is_late = row_id >= RANGE_SAMPLE_ROWS
+            slot[is_late] = np.random.randint(0, row_id[is_late] + 1)
+            keep = slot < RANGE_SAMPLE_ROWS
+            sample[slot[keep]] = chunk[keep]
+            n_row += chunk.shape[0]
+        sample = sample[:min(n_row, RANGE_SAMPLE_ROWS)]
+        return n_row, value_set, sample
+
+    def _load_from_file(self, file_name, range_limit=None):
+        """
+        Streams the embedding file in blocks of FILE_CHUNK_ROWS vectors
+        and writes each block straight into self.weight, so the peak
+        memory does not depend on the vocabulary size. For nbit < 32 the
+        file is first scanned once to decide between reusing the values
+        of an already quantized file and clipping/quantizing with a range
+        estimated from a row sample (or the given range_limit).
+        """
+        if self.nbit == 32:
+            self.weight.zero_()
+        elif self.group_size is not None:
+            # groups are quantized independently, no need to scan the file
+            value_set = None
+        elif range_limit is not None:
+            value_set = None
+            scale, offset = compress.get_scale_and_offset(
+                self.nbit, range_limit)
+            self._set_value_list(compress._dequantize(
+                np.arange(2**self.nbit, dtype=np.float32), scale, offset))
         else:
-            with open(file_name, "r") as f:
-                line_cnt = len(f.readlines())
-
-        # put vectors into int64 tensor
-        with open(file_name, "r") as f:
-            for line_id, line in enumerate(f.readlines()):
-                if self.nbit != 32:
-                    vector = line2vec(line, self.value_dict)
-                    self.weight[line_id].copy_(
-                        compress_long_mat(vector, self.nbit))
-                else:
-                    self.weight[line_id].copy_(
-                        torch.tensor(
-                            [float(value) for value in line.split(" ")[1:]],
-                            dtype=self.weight.dtype))
-        if self.num_embeddings > line_id + 1:
+            n_row, value_set, sample = self._scan_file(file_name)
+            if n_row > self.num_embeddings:
+                raise Exception(
+                    "The input vocab is larger than the specified vocab size")
+            if value_set is not None:
+                # quantized input, the codes index the sorted values
+                sorted_vals = np.array(sorted(value_set))
+            else:
+                # the sample can be large, see RANGE_SAMPLE_ROWS
+                range_limit = compress.find_optimal_range(
+                    sample, self.nbit, stochastic_round=False, oracle="auto")
+                scale, offset = compress.get_scale_and_offset(
+                    self.nbit, range_limit)
+                sorted_vals = compress._dequantize(
+                    np.arange(2**self.nbit, dtype=np.float32), scale, offset)
+            del sample
+            self._set_value_list(sorted_vals)
+
+        line_id = 0
+        for _, chunk in utils.iter_embedding_chunks(
+                file_name, self.embedding_dim, chunk_size=FILE_CHUNK_ROWS):
+            if line_id + chunk.shape[0] > self.num_embeddings:
+                raise Exception(
+                    "The input vocab is larger than the specified vocab size")
+            rows = slice(line_id, line_id + chunk.shape[0])
+            if self.nbit == 32:
+                self.weight[rows].copy_(torch.from_numpy(chunk))
+            elif self.group_size is not None:
+                self._compress_tensor_grouped(
+                    chunk.astype(np.float32), line_id)
+            elif value_set is not None:
+                self._pack_into(np.searchsorted(sorted_vals, chunk), line_id)
+            else:
+                codes, _, _ = compress._compress_uniform_codes(
+                    chunk.astype(np.float32), self.nbit, range_limit)
+                self._pack_into(codes, line_id)
+            line_id += chunk.shape[0]
+        if self.num_embeddings > line_id:
             logging.warning(
                 "The input vocab is smaller then the specified vocab size")
+            if self.nbit != 32 and self.group_size is None and value_set is None:
+                # rows which are not in the file hold the quantized zero vector
+                codes, _, _ = compress._compress_uniform_codes(
+                    np.zeros([1, self.embedding_dim], dtype=np.float32),
+                    self.nbit, range_limit)
+                self.weight[line_id:].copy_(
+                    self._pack(torch.from_numpy(codes.astype(np.int64))))
+
+    def _cache_key(self, weight, embedding_file, range_limit):
+        settings = {
+            "function": "QuantEmbedding",
+            "nbit": self.nbit,
+            "num_embeddings": self.num_embeddings,
+            "embedding_dim": self.embedding_dim,
+            "packing": self.packing,
+            "row_align": self.row_align,
+            "group_size": self.group_size,
+            "dtype": str(self._output_dtype()),
+            "range_limit": range_limit,
+            "adaptive_range": True,
+            "stochastic_round": False,
+        }
+        if embedding_file is not None:
+            return compression_cache.hash_file(embedding_file, settings)
+        return compression_cache.hash_array(
+            weight.detach().float().cpu().numpy(), settings)
+
+    def _load_from_cache(self, cache, key):
+        """ fill the compressed state from the cache entry key, if any """
+        entry = cache.get(key)
+        if entry is None:
+            return False
+        meta, arrays = entry
+        dtype = getattr(torch, meta["dtype"])
+        self.weight.copy_(array_to_tensor(arrays["weight"]))
+        self.value_list.copy_(array_to_tensor(arrays["value_list"], dtype))
+        if self.group_size is not None:
+            self.group_scales.copy_(array_to_tensor(arrays["group_scales"]))
+        return True
 
-    def forward(self, input):
-        embedding = F.embedding(input, self.weight, self.padding_idx,
-                                self.max_norm, self.norm_type,
-                                self.scale_grad_by_freq, self.sparse)
+    def _container(self):
+        """ the (meta, arrays) of the container format """
+        meta = {
+            "nbit": self.nbit,
+            "num_embeddings": self.num_embeddings,
+            "embedding_dim": self.embedding_dim,
+            "padding_idx": self.padding_idx,
+            "packing": self.packing,
+            "row_align": self.row_align,
+            "group_size": self.group_size,
+            "dtype": str(self._output_dtype()).replace("torch.", ""),
+        }
+        arrays = {"weight": tensor_to_array(self.weight)}
         if self.nbit != 32:
-            embedding = decompress_long_mat(embedding, self.nbit,
-                                            self.embedding_dim)
-            embedding = self.value_list[embedding]
-        assert self.weight.requires_grad == False, " QuantEmbedding only support fixed embedding"
+            arrays["value_list"] = tensor_to_array(self.value_list)
+        if self.group_size is not None:
+            arrays["group_scales"] = self.group_scales.detach().cpu().numpy()
+        return meta, arrays
+
+    def save(self, file_name, vocab=None):
+        """
+        Save the compressed embedding into the binary container format
+        (see save_compressed), optionally along with its vocabulary.
+        """
+        meta, arrays = self._container()
+        save_compressed(file_name, meta, arrays, vocab)
+
+    @classmethod
+    def from_file(cls, file_name, mmap=True, decode="auto", dtype=None):
+        """
+        Construct a QuantEmbedding from a file written by QuantEmbedding.save.
+        No compression is run. With mmap=True the packed weight is a
+        copy-on-write memory map of the file, so construction is O(1) and
+        processes loading the same file share the page cache copy.
+        The vocabulary (or None) is available as the vocab attribute.
+        dtype overrides the saved output dtype of value_list.
+        """
+        meta, arrays, vocab = load_compressed(file_name, mmap=mmap)
+        saved_dtype = getattr(torch, meta.get("dtype", "float32"))
+        module = cls.__new__(cls)
+        module._init_layout(meta["embedding_dim"], meta["nbit"], decode,
+                            meta["packing"], meta["row_align"],
+                            meta.get("group_size"))
+        # the actual weight is attached below, avoid allocating a dummy one
+        nn.Embedding.__init__(
+            module,
+            meta["num_embeddings"],
+            0,
+            padding_idx=meta["padding_idx"])
+        module.embedding_dim = meta["embedding_dim"]
+        weight = array_to_tensor(arrays["weight"], saved_dtype
+                                 if module.nbit == 32 else None)
+        if module.nbit == 32 and dtype is not None:
+            weight = weight.to(dtype)
+        module.weight = nn.Parameter(weight, requires_grad=False)
+        if module.nbit != 32:
+            value_list = array_to_tensor(arrays["value_list"], saved_dtype)
+            module.register_buffer("value_list", value_list.to(
+                dtype if dtype is not None else saved_dtype))
+            module._init_decode_tables()
+        if module.group_size is not None:
+            module.register_buffer("group_scales",
+                                   torch.from_numpy(arrays["group_scales"]))
+        module.vocab = vocab
+        return module
+
+    def _pack(self, codes):
+        """ pack integer codes (last dim is embedding_dim) into the storage layout """
+        if self.packing == "stream":
+            return compress_stream_mat(codes, self.nbit, self.row_align)
+        return compress_long_mat(codes, self.nbit)
+
+    def _pack_into(self, codes, row_start=0):
+        """
+        pack the numpy integer codes of consecutive rows into self.weight,
+        starting from row row_start, FILE_CHUNK_ROWS rows at a time
+        """
+        for i in range(0, codes.shape[0], FILE_CHUNK_ROWS):
+            chunk = torch.from_numpy(
+                codes[i:i + FILE_CHUNK_ROWS].astype(np.int64))
+            self.weight[row_start + i:row_start + i + chunk.size(0)].copy_(
+                self._pack(chunk))
+
+    def _unpack(self, packed, out=None):
+        """ extract the codes from packed rows (into out if given) """
+        if self.packing == "stream":
+            return decompress_stream_mat(
+                packed, self.nbit, self.embedding_dim, out=out,
+                workspace=self._workspace)
+        return decompress_long_mat(
+            packed, self.nbit, self.embedding_dim, out=out)
+
+    def _workspace(self, name, shape, dtype):
+        """
+        Returns a tensor of the given shape backed by the module workspace
+        arena. Every buffer grows to the largest size requested so far, so
+        steady-state forward calls do not allocate. The arena is kept per
+        thread, so concurrent forward calls do not share buffers; the arenas
+        of exited threads are dropped when a new thread gets one.
+        """
+        numel = 1
+        for size in shape:
+            numel *= size
+        arenas = self.__dict__.setdefault("_workspace_buffers", {})
+        arena = arenas.get(threading.get_ident())
+        if arena is None:
+            self._release_exited_workspaces()
+            arena = arenas.setdefault(threading.get_ident(), {})
+        buf = arena.get(name)
+        if (buf is None or buf.numel() < numel or buf.dtype != dtype
+                or buf.device != self.weight.device):
+            buf = torch.empty(numel, dtype=dtype, device=self.weight.device)
+            arena[name] = buf
+        return buf[:numel].view(*shape)
+
+    def release_workspace(self):
+        """ free the buffers of the workspace arena """
+        self.__dict__.pop("_workspace_buffers", None)
+
+    def _release_exited_workspaces(self):
+        """ free the workspace arenas of the threads which have exited """
+        arenas = self.__dict__.get("_workspace_buffers", {})
+        alive = set(thread.ident for thread in threading.enumerate())
+        for ident in list(arenas):
+            if ident not in alive:
+                arenas.pop(ident, None)
+
+    def __getstate__(self):
+        # workspace buffers are scratch memory, do not pickle or copy them
+        state = self.__dict__.copy()
+        state.pop("_workspace_buffers", None)
+        state.pop("_stream_byte_index_cache", None)
+        state.pop("_cache_lock", None)
+        return state
+
+    def _cache_guard(self):
+        """ the lock of the adaptive cache, created on first use """
+        lock = self.__dict__.get("_cache_lock")
+        if lock is None:
+            lock = self.__dict__.setdefault("_cache_lock", threading.Lock())
+        return lock
+
+    def _stream_byte_index(self):
+        """
+        Positions, in the byte view of a packed row, of the bytes holding
+        the first embedding_dim codes in stream order (most significant
+        code first). For the long packing the bytes of every word are
+        reversed on little-endian machines.
+        """
+        device = self.weight.device
+        index = self.__dict__.get("_stream_byte_index_cache")
+        if index is None or index.device != device:
+            codes_per_byte = 8 // self.nbit
+            n_byte = math.ceil(self.embedding_dim / codes_per_byte)
+            index = torch.arange(n_byte, device=device)
+            if self.packing == "long" and sys.byteorder == "little":
+                word_bytes = LONG_BITS // 8
+                index = (index // word_bytes * word_bytes +
+                         word_bytes - 1 - index % word_bytes)
+            self._stream_byte_index_cache = index
+        return index
+
+    def _gather_codes(self, ids):
+        """
+        int64 codes ([ids.numel(), embedding_dim]) of the rows ids, read
+        with the byte lookup table when LUT decoding is enabled
+        """
+        if self._stats is not None:
+            self._count(bytes_read=ids.numel() * self.tensor_dim *
+                        self.weight.element_size())
+        with self._stage("gather"):
+            packed = torch.index_select(self.weight, 0, ids.reshape(-1))
+        with self._stage("decode"):
+            if self.decode != "lut":
+                return self._unpack(packed)
+            byte_index = self._stream_byte_index()
+            stream = torch.index_select(
+                packed.view(torch.uint8), 1, byte_index)
+            codes = torch.index_select(
+                self.byte_codes, 0, stream.view(-1).int())
+        # explicit sizes, -1 can not be inferred for an empty batch
+        return codes.view(ids.numel(), byte_index.numel() * (8 // self.nbit))[
+            :, :self.embedding_dim]
+
+    def _apply_group_scales(self, embedding, scales):
+        """
+        multiply the centered decoded values ([n, embedding_dim]) with
+        their group steps ([n, n_group]) in place
+        """
+        n_group = self.group_scales.size(1)
+        n = embedding.size(0)
+        if scales.dtype != embedding.dtype:
+            scales = self._workspace("group_scales_cast", [n, n_group],
+                                     embedding.dtype).copy_(scales)
+        if self.embedding_dim % self.group_size == 0:
+            embedding.view(-1, n_group, self.group_size).mul_(
+                scales.unsqueeze(-1))
+        else:
+            group_idx = torch.arange(
+                self.embedding_dim, device=scales.device) // self.group_size
+            embedding.mul_(torch.index_select(
+                scales, 1, group_idx,
+                out=self._workspace("group_scales_dim",
+                                    [n, self.embedding_dim],
+                                    embedding.dtype)))
         return embedding
+
+    def enable_cache(self,
+                     frequencies=None,
+                     top_k=None,
+                     byte_budget=None,
+                     refresh_every=100,
+                     decay=0.5):
+        """
+        Keep the decoded float rows of frequent ids, so lookups of these ids
+        skip decoding. The cache holds top_k rows, or as many rows as fit in
+        byte_budget bytes. With a frequencies tensor ([num_embeddings]
+        counts, or the vocabulary order when it is sorted by frequency) the
+        most frequent ids are pinned once. Without it, the cache is an
+        adaptive LFU: lookups are counted per id and every refresh_every
+        forward calls the cache is refilled with the most counted ids,
+        whose counts are then multiplied by decay.
+        The cache is derived from weight and value_list and is not saved
+        in the state dict, call enable_cache again after changing them.
+        """
+        if (top_k is None) == (byte_budget is None):
+            raise Exception("Should provide either top_k or byte_budget!")
+        if top_k is None:
+            row_bytes = self.embedding_dim * torch.empty(
+                0, dtype=self._output_dtype()).element_size()
+            top_k = byte_budget // row_bytes
+        top_k = min(top_k, self.num_embeddings)
+        device = self.weight.device
+        self.register_buffer(
+            "cache_slot",
+            torch.full([self.num_embeddings], -1, dtype=torch.int32,
+                       device=device),
+            persistent=False)
+        self.register_buffer(
+            "cache_rows",
+            torch.zeros(top_k, self.embedding_dim,
+                        dtype=self._output_dtype(), device=device),
+            persistent=False)
+        self.cache_adaptive = frequencies is None
+        self.cache_refresh_every = refresh_every
+        self.cache_decay = decay
+        self.cache_calls = 0
+        if self.cache_adaptive:
+            self.register_buffer(
+                "cache_counts",
+                torch.zeros(self.num_embeddings, dtype=torch.float32,
+                            device=device),
+                persistent=False)
+        else:
+            frequencies = torch.as_tensor(frequencies, dtype=torch.float32)
+            self._fill_cache(
+                frequencies.to(device).topk(top_k).indices)
+
+    def disable_cache(self):
+        for name in ("cache_slot", "cache_rows", "cache_counts"):
+            if name in self._buffers:
+                del self._buffers[name]
+
+    def enable_stats(self):
+        """
+        Start counting lookups, unique ids per batch, decoded rows, the
+        bytes read (packed rows, group scales and cached rows) and produced
+        (output rows), the cache hits and misses and the time spent in the
+        gather, decode and value_map stages. On GPU the stages synchronize
+        the device to be timed. Disabled counters cost one attribute check.
+        """
+        if self._stats is None:
+            self.reset_stats()
+
+    def disable_stats(self):
+        self._stats = None
+
+    def reset_stats(self):
+        self._stats = dict.fromkeys(STAT_COUNTERS, 0)
+
+    def stats(self):
+        """
+        Returns the counters (see enable_stats) along with the unique ids
+        and lookups per batch, the cache hit rate (None without cached
+        lookups) and the ratio of read to produced bytes.
+        """
+        if self._stats is None:
+            raise Exception("Stats are disabled, call enable_stats first!")
+        with _stats_lock:
+            return _derive_stats(self._stats)
+
+    def _count(self, **increments):
+        stats = self._stats
+        if stats is None:
+            return
+        with _stats_lock:
+            for key, value in increments.items():
+                stats[key] += value
+
+    def _stage(self, name):
+        """ context of the decode stage name, see enable_stats """
+        if self._stats is None and not torch.autograd._profiler_enabled():
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def enable_codebook_training(self):
+        """
+        Make value_list a trainable parameter while the packed codes stay
+        fixed, so fine-tuning only keeps the 2**nbit values (and their
+        optimizer state). forward then decodes every id (the decoded row
+        cache is bypassed) and backward scatter-adds the output gradients
+        into the code buckets. Call requantize to refresh the codes and
+        disable_codebook_training to freeze value_list again.
+        """
+        if self.nbit == 32:
+            raise Exception("Codebook training requires nbit < 32!")
+        if not self._trainable_codebook():
+            self.value_list = nn.Parameter(self.value_list.detach().clone())
+
+    def disable_codebook_training(self):
+        if self._trainable_codebook():
+            value_list = self.value_list.detach()
+            del self._parameters["value_list"]
+            self.register_buffer("value_list", value_list)
+        self._refresh_decoded()
+
+    def _trainable_codebook(self):
+        return isinstance(self._parameters.get("value_list"), nn.Parameter)
+
+    def _codebook_grad(self, ids, grad):
+        """ gradient of value_list from the [n, embedding_dim] grad of the rows ids """
+        grad_value_list = torch.zeros(
+            2**self.nbit, dtype=torch.float32, device=grad.device)
+        for start in range(0, ids.numel(), CODEBOOK_GRAD_CHUNK_ROWS):
+            chunk = ids[start:start + CODEBOOK_GRAD_CHUNK_ROWS]
+            chunk_grad = grad[start:start + CODEBOOK_GRAD_CHUNK_ROWS].to(
+                torch.float32, copy=self.group_size is not None)
+            if self.group_size is not None:
+                self._apply_group_scales(chunk_grad, self.group_scales[chunk])
+            grad_value_list.index_add_(
+                0, self._gather_codes(chunk).reshape(-1),
+                chunk_grad.reshape(-1))
+        return grad_value_list.to(self.value_list.dtype)
+
+    def requantize(self, _weight, chunk_rows=FILE_CHUNK_ROWS):
+        """
+        Refresh the codes for the current value_list, e.g. periodically
+        during codebook training: every entry gets the code of the value
+        nearest to the matching entry of _weight (a float tensor or numpy
+        array, e.g. an np.memmap of the pretrained table, read chunk_rows
+        rows at a time). With group_size the entries are divided by their
+        group steps first. value_list itself is not reordered, so the
+        optimizer state stays aligned with it.
+        """
+        if self.nbit == 32:
+            raise Exception("Requantization requires nbit < 32!")
+        if list(_weight.shape) != [self.num_embeddings, self.embedding_dim]:
+            raise Exception(
+                "The shape of the input embedding does not match the compressed tensor!")
+        device = self.weight.device
+        with torch.no_grad():
+            sorted_vals, order = self.value_list.float().sort()
+            bounds = (sorted_vals[1:] + sorted_vals[:-1]) / 2
+            for start in range(0, self.num_embeddings, chunk_rows):
+                end = min(start + chunk_rows, self.num_embeddings)
+                target = torch.as_tensor(_weight[start:end]).to(
+                    device=device, dtype=torch.float32)
+                if self.group_size is not None:
+                    scales = self.group_scales[start:end].float(
+                        ).repeat_interleave(self.group_size, dim=1)[
+                            :, :self.embedding_dim]
+                    target = torch.where(scales == 0, torch.zeros_like(target),
+                                         target / scales)
+                codes = order[torch.bucketize(target, bounds)]
+                self.weight[start:end] = self._pack(codes)
+        self._refresh_decoded()
+
+    def _refresh_decoded(self):
+        """ update the decoded row cache and drop the row norms """
+        if "cache_slot" in self._buffers:
+            ids = (self.cache_slot >= 0).nonzero().view(-1)
+            with torch.no_grad():
+                self.cache_rows[self.cache_slot[ids].long()] = (
+                    self._decode_rows(ids))
+        if "row_norms" in self._buffers:
+            del self._buffers["row_norms"]
+
+    def _output_dtype(self):
+        if self.nbit == 32:
+            return self.weight.dtype
+        return self.value_list.dtype
+
+    def _fill_cache(self, ids):
+        """ decode the rows of ids into the cache, replacing its content """
+        self.cache_slot.fill_(-1)
+        if ids.numel() == 0:
+            return
+        self.cache_rows[:ids.numel()].copy_(self._decode_rows(ids))
+        self.cache_slot[ids] = torch.arange(
+            ids.numel(), dtype=torch.int32, device=ids.device)
+
+    def _lookup_cached(self, input, out=None):
+        """
+        serve the cached rows of input and decode the misses only. The
+        adaptive cache is counted, refreshed and read under a lock, so
+        concurrent calls (e.g. of a BatchingEmbeddingServer) never read
+        rows being replaced; the misses are decoded outside of it.
+        """
+        with self._cache_guard() if self.cache_adaptive else _NO_STAGE:
+            if self.cache_adaptive:
+                self.cache_counts.index_add_(
+                    0, input.reshape(-1),
+                    torch.ones(input.numel(), device=input.device))
+                self.cache_calls += 1
+                if self.cache_calls % self.cache_refresh_every == 0:
+                    n_cached = min(self.cache_rows.size(0),
+                                   int((self.cache_counts > 0).sum()))
+                    self._fill_cache(self.cache_counts.topk(n_cached).indices)
+                    self.cache_counts.mul_(self.cache_decay)
+            slots = self.cache_slot[input]
+            hit = slots >= 0
+            n_hit = int(hit.sum())
+            if self._stats is not None:
+                self._count(cache_hits=n_hit,
+                            cache_misses=input.numel() - n_hit,
+                            bytes_read=n_hit * self.embedding_dim *
+                            self.cache_rows.element_size())
+            if n_hit == 0:
+                return self._decode_rows(input, out=out)
+            if out is None:
+                out = self._new_output(input)
+            if n_hit == input.numel():
+                torch.index_select(self.cache_rows, 0, slots.reshape(-1),
+                                   out=out.view(-1, self.embedding_dim))
+                return out
+            out[hit] = F.embedding(slots[hit], self.cache_rows)
+        miss = ~hit
+        out[miss] = self._decode_rows(input[miss])
+        return out
+
+    def _new_output(self, input):
+        return torch.empty(
+            *input.shape,
+            self.embedding_dim,
+            dtype=self._output_dtype(),
+            device=self.weight.device)
+
+    def _decode_rows(self, input, out=None):
+        """
+        gather the packed rows of input and decode them to floats, into
+        out if given. All intermediates live in the workspace arena.
+        """
+        if out is None:
+            out = self._new_output(input)
+        ids = input.reshape(-1)
+        n = ids.numel()
+        out_flat = out.view(n, self.embedding_dim)
+        if self._stats is not None:
+            row_bytes = self.tensor_dim * self.weight.element_size()
+            if self.group_size is not None:
+                row_bytes += (self.group_scales.size(1) *
+                              self.group_scales.element_size())
+            self._count(decoded_rows=n, bytes_read=n * row_bytes)
+        if self.nbit == 32:
+            with self._stage("gather"):
+                torch.index_select(self.weight, 0, ids, out=out_flat)
+            return out
+        with self._stage("gather"):
+            packed = torch.index_select(
+                self.weight, 0, ids,
+                out=self._workspace("packed", [n, self.tensor_dim],
+                                    self.weight.dtype))
+            if self.group_size is not None:
+                scales = torch.index_select(
+                    self.group_scales, 0, ids,
+                    out=self._workspace("group_scales",
+                                        [n, self.group_scales.size(1)],
+                                        self.group_scales.dtype))
+        self._decode_packed(packed, out_flat)
+        if self.group_size is not None:
+            with self._stage("value_map"):
+                self._apply_group_scales(out_flat, scales)
+        return out
+
+    def _decode_packed(self, packed, out_flat):
+        """
+        decode packed rows ([n, tensor_dim]) into out_flat
+        ([n, embedding_dim]), before the group scales
+        """
+        n = packed.size(0)
+        # out= gathers do not support autograd, which only flows through
+        # _CodebookLookup for a trainable value_list
+        value_list = self.value_list.detach()
+        if self.decode == "lut":
+            codes_per_byte = 8 // self.nbit
+            byte_index = self._stream_byte_index()
+            n_byte = byte_index.numel()
+            with self._stage("decode"):
+                # the bytes holding the codes, in stream order
+                stream = torch.index_select(
+                    packed.view(torch.uint8), 1, byte_index,
+                    out=self._workspace("stream", [n, n_byte], torch.uint8))
+                # uint8 tensors can not index, int32 is the narrowest index dtype
+                stream_index = self._workspace(
+                    "stream_index", [n * n_byte], torch.int32).copy_(
+                        stream.view(-1))
+            with self._stage("value_map"):
+                # 256 x codes_per_byte float table for the current value_list
+                lut = torch.index_select(
+                    value_list, 0, self.byte_codes.view(-1),
+                    out=self._workspace("lut", [256 * codes_per_byte],
+                                        out_flat.dtype)).view(
+                                            256, codes_per_byte)
+                if n_byte * codes_per_byte == self.embedding_dim:
+                    torch.index_select(
+                        lut, 0, stream_index,
+                        out=out_flat.view(n * n_byte, codes_per_byte))
+                else:
+                    # cut the redundent dimensions in the last byte
+                    decoded = torch.index_select(
+                        lut, 0, stream_index,
+                        out=self._workspace("decoded",
+                                            [n * n_byte, codes_per_byte],
+                                            out_flat.dtype))
+                    out_flat.copy_(decoded.view(n, n_byte * codes_per_byte)[
+                        :, :self.embedding_dim])
+        else:
+            with self._stage("decode"):
+                codes = self._unpack(
+                    packed,
+                    out=self._workspace("codes", [n, self.embedding_dim],
+                                        torch.int32))
+            with self._stage("value_map"):
+                torch.index_select(
+                    value_list, 0, codes.view(-1),
+                    out=out_flat.view(-1))
+        return out_flat
+
+    def _count_batch(self, input, n_row=None):
+        """ count a forward call on input producing n_row rows """
+        n_row = input.numel() if n_row is None else n_row
+        self._count(calls=1, lookups=input.numel(),
+                    bytes_produced=n_row * self.embedding_dim * torch.empty(
+                        0, dtype=self._output_dtype()).element_size())
+
+    def _lookup(self, input, out=None):
+        if "cache_slot" in self._buffers:
+            return self._lookup_cached(input, out=out)
+        return self._decode_rows(input, out=out)
+
+    def forward(self, input, out=None):
+        """
+        out optionally receives the output, a tensor of shape
+        [*input.shape, embedding_dim] and of the dtype of value_list.
+        """
+        assert self.weight.requires_grad == False, " QuantEmbedding only support fixed embedding"
+        if out is not None:
+            assert list(out.shape) == list(input.shape) + [self.embedding_dim]
+            assert out.is_contiguous()
+        if self._stats is not None:
+            self._count_batch(input)
+        if self.nbit != 32 and self._trainable_codebook():
+            out_rows = _CodebookLookup.apply(self.value_list, self, input)
+            if out is None:
+                return out_rows
+            return out.copy_(out_rows)
+        if self.dedup is False or (self.dedup == "auto" and
+                                   input.numel() <= self.DEDUP_MIN_SIZE):
+            if self._stats is not None:
+                self._count(unique_ids=torch.unique(input).numel())
+            return self._lookup(input, out=out)
+        unique_ids, inverse = torch.unique(input, return_inverse=True)
+        if self._stats is not None:
+            self._count(unique_ids=unique_ids.numel())
+        if self.dedup == "auto" and (
+                unique_ids.numel() > self.dedup_ratio * input.numel()):
+            return self._lookup(input, out=out)
+        # decode every distinct id once and scatter the rows back
+        rows = self._lookup(unique_ids)
+        if out is None:
+            return F.embedding(inverse, rows)
+        torch.index_select(rows, 0, inverse.reshape(-1),
+                           out=out.view(-1, self.embedding_dim))
+        return out
+
+    def _adc_supported(self):
+        """ scoring from the packed bytes requires LUT decoding and byte aligned groups """
+        if self.decode != "lut":
+            return False
+        return self.group_size is None or (
+            self.group_size % (8 // self.nbit) == 0)
+
+    def _adc_tables(self, query):
+        """
+        Per query lookup tables of the asymmetric distance computation:
+        entry [q, j * 256 + b] is the dot product of query q with the
+        values packed in byte b at byte position j of a row (before the
+        group scales). Returns a [n_query, n_byte * 256] tensor.
+        """
+        codes_per_byte = 8 // self.nbit
+        n_byte = self._stream_byte_index().numel()
+        query = F.pad(query, (0, n_byte * codes_per_byte - self.embedding_dim))
+        lut = self.value_list.detach().float()[self.byte_codes]
+        tables = torch.matmul(
+            query.view(query.size(0), n_byte, codes_per_byte), lut.t())
+        return tables.view(query.size(0), -1)
+
+    def _adc_scores(self, tables, rows):
+        """ dot products of the queries with the rows (a range) from the packed bytes """
+        byte_index = self._stream_byte_index()
+        n_byte = byte_index.numel()
+        index = torch.index_select(
+            self.weight[rows].view(torch.uint8), 1, byte_index).int()
+        index += torch.arange(
+            0, n_byte * 256, 256, dtype=torch.int32, device=index.device)
+        partial = torch.index_select(tables, 1, index.view(-1)).view(
+            tables.size(0), -1, n_byte)
+        if self.group_size is None:
+            return partial.sum(-1)
+        # scale the partial products of every byte with its group step
+        byte_group = (torch.arange(n_byte, device=index.device) *
+                      (8 // self.nbit) // self.group_size)
+        byte_scales = self.group_scales[rows][:, byte_group].float()
+        return (partial * byte_scales).sum(-1)
+
+    def _decode_range(self, rows):
+        """ float32 decoded vectors of a range of rows """
+        ids = torch.arange(rows.start, rows.stop, device=self.weight.device)
+        return self._decode_rows(ids).float()
+
+    def compute_row_norms(self, block_rows=None):
+        """
+        Compute the euclidean norms of the decoded rows once and keep them
+        in the row_norms buffer, used by topk for the cosine and l2
+        metrics (otherwise they are recomputed in every call).
+        The buffer is derived from the weights and is not saved.
+        """
+        block_rows = block_rows or self.TOPK_BLOCK_ROWS
+        norms = torch.zeros(self.num_embeddings, device=self.weight.device)
+        for start in range(0, self.num_embeddings, block_rows):
+            rows = slice(start, min(start + block_rows, self.num_embeddings))
+            norms[rows] = self._decode_range(rows).norm(dim=1)
+        self.register_buffer("row_norms", norms, persistent=False)
+        return norms
+
+    def topk(self,
+             query,
+             k=10,
+             metric="dot",
+             block_rows=None,
+             n_threads=None,
+             adc="auto"):
+        """
+        Search the k rows most similar to query ([embedding_dim] or
+        [n_query, embedding_dim]) without decompressing the table.
+        metric is "dot", "cosine" or "l2" (squared euclidean distance, the
+        k closest rows are returned). Returns (scores, indices) of shape
+        [n_query, k], or [k] for a single query vector.
+        The vocabulary is scanned in blocks of block_rows rows on a pool of
+        n_threads threads (os.cpu_count() by default). With adc each row
+        is scored straight from its packed bytes with per query lookup
+        tables (see _adc_tables), otherwise the blocks are decoded and
+        multiplied with the queries. The gathers of adc only beat the
+        matrix product for a few queries, "auto" uses it for at most
+        ADC_MAX_QUERIES queries with LUT decoding and no group scales.
+        """
+        assert metric in ("dot", "cosine", "l2")
+        assert adc in ("auto", True, False)
+        single = query.dim() == 1
+        query = query.view(-1, self.embedding_dim).float().to(self.weight.device)
+        k = min(k, self.num_embeddings)
+        block_rows = block_rows or self.TOPK_BLOCK_ROWS
+        if adc == "auto":
+            adc = (self._adc_supported() and self.group_size is None and
+                   query.size(0) <= self.ADC_MAX_QUERIES)
+        elif adc and not self._adc_supported():
+            raise Exception("ADC scoring requires LUT decoding"
+                            " and groups aligned to bytes!")
+        if metric == "cosine":
+            query = query / query.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        if adc:
+            tables = self._adc_tables(query)
+        row_norms = self._buffers.get("row_norms")
+
+        def search_block(start):
+            rows = slice(start, min(start + block_rows, self.num_embeddings))
+            if adc:
+                scores = self._adc_scores(tables, rows)
+                norms = None if metric == "dot" or row_norms is not None \
+                    else self._decode_range(rows).norm(dim=1)
+            else:
+                decoded = self._decode_range(rows)
+                scores = torch.matmul(query, decoded.t())
+                norms = None if metric == "dot" or row_norms is not None \
+                    else decoded.norm(dim=1)
+            if row_norms is not None:
+                norms = row_norms[rows]
+            if metric == "cosine":
+                scores = scores / norms.clamp(min=1e-12)
+            elif metric == "l2":
+                # ranking by 2 <q, r> - |r|^2 is ranking by -|q - r|^2
+                scores = 2 * scores - norms.pow(2)
+            values, indices = scores.topk(min(k, scores.size(1)), dim=1)
+            return values, indices + start
+
+        n_threads = n_threads or os.cpu_count() or 1
+        starts = range(0, self.num_embeddings, block_rows)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(search_block, starts))
+        # the pool threads have exited, their block sized arenas would
+        # otherwise stay on the module
+        self._release_exited_workspaces()
+        values = torch.cat([r[0] for r in results], dim=1)
+        indices = torch.cat([r[1] for r in results], dim=1)
+        values, order = values.topk(k, dim=1)
+        indices = torch.gather(indices, 1, order)
+        if metric == "l2":
+            values = query.pow(2).sum(1, keepdim=True) - values
+        if single:
+            return values[0], indices[0]
+        return values, indices
+
+
+class QuantEmbeddingBag(QuantEmbedding):
+    # maximal number of (bag, byte position, byte value) counters
+    # allocated at once by the counting pooling
+    COUNT_BUDGET = 2**22
+    mode = "mean"
+    include_last_offset = False
+    pooling = "auto"
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 max_norm=None,
+                 norm_type=2.,
+                 scale_grad_by_freq=False,
+                 mode="mean",
+                 sparse=False,
+                 _weight=None,
+                 include_last_offset=False,
+                 padding_idx=None,
+                 nbit=32,
+                 embedding_file=None,
+                 pooling="auto",
+                 **kwargs):
+        """
+        Quantized counterpart of nn.EmbeddingBag. The arguments are those
+        of nn.EmbeddingBag plus the QuantEmbedding ones (nbit,
+        embedding_file, decode, packing, group_size, dtype, ...).
+        pooling selects how sum / mean bags are computed: "count"
+        accumulates, for every bag and byte position of the packed rows,
+        the (weighted) number of occurrences of each byte value, and
+        multiplies the counts with the byte lookup table of value_list,
+        so the decoded vectors of the tokens are never materialized. It
+        requires LUT decoding (nbit in 1, 2, 4, 8), and groups aligned to
+        bytes for group-wise scales. "decode" decodes every token and
+        adds the vectors. "auto" counts when the bags are long enough for
+        the counts to be smaller than the decoded vectors. In max mode
+        the largest code of every dimension is taken, value_list being
+        sorted.
+        """
+        assert mode in ("sum", "mean", "max")
+        assert pooling in ("auto", "count", "decode")
+        self.mode = mode
+        self.include_last_offset = include_last_offset
+        self.pooling = pooling
+        QuantEmbedding.__init__(
+            self,
+            num_embeddings,
+            embedding_dim,
+            padding_idx=padding_idx,
+            max_norm=max_norm,
+            norm_type=norm_type,
+            scale_grad_by_freq=scale_grad_by_freq,
+            sparse=sparse,
+            _weight=_weight,
+            nbit=nbit,
+            embedding_file=embedding_file,
+            **kwargs)
+        if pooling == "count" and not self._can_count():
+            raise Exception("Counting pooling requires LUT decoding"
+                            " and groups aligned to bytes!")
+
+    def _can_count(self):
+        if self.decode != "lut":
+            return False
+        return self.group_size is None or (
+            self.group_size % (8 // self.nbit) == 0)
+
+    def _get_bags(self, input, offsets, per_sample_weights):
+        """
+        flatten the bags of input into the token ids, the bag of every
+        token and the token weights (None for unweighted bags), following
+        the conventions of nn.EmbeddingBag. Returns them with the number
+        of bags.
+        """
+        if per_sample_weights is not None:
+            assert self.mode == "sum", \
+                "per_sample_weights are only supported for mode='sum'"
+            assert per_sample_weights.shape == input.shape
+        if input.dim() == 2:
+            assert offsets is None, "offsets must be None for 2D input"
+            n_bag = input.size(0)
+            bags = torch.arange(
+                n_bag, device=input.device).repeat_interleave(input.size(1))
+        else:
+            assert input.dim() == 1 and offsets is not None
+            offsets = offsets.to(input.device).long()
+            if self.include_last_offset:
+                n_bag = offsets.numel() - 1
+                ends = offsets[1:]
+            else:
+                n_bag = offsets.numel()
+                ends = torch.cat(
+                    [offsets[1:], offsets.new_tensor([input.numel()])])
+            bags = torch.arange(n_bag, device=input.device).repeat_interleave(
+                ends - offsets[:n_bag])
+        ids = input.reshape(-1)
+        weights = None
+        if per_sample_weights is not None:
+            weights = per_sample_weights.reshape(-1)
+        if self.padding_idx is not None:
+            # padding tokens do not contribute to the bags
+            keep = ids != self.padding_idx
+            ids, bags = ids[keep], bags[keep]
+            if weights is not None:
+                weights = weights[keep]
+        return ids, bags, weights, n_bag
+
+    def _count_pool(self, ids, bags, weights, n_bag):
+        """ sum pooling from the per (bag, byte position, byte value) counts """
+        codes_per_byte = 8 // self.nbit
+        byte_index = self._stream_byte_index()
+        n_byte = byte_index.numel()
+        out = torch.zeros(n_bag, n_byte * codes_per_byte,
+                          device=self.weight.device)
+        # [256, codes_per_byte] values of every byte value
+        lut = self.value_list.float()[self.byte_codes]
+        if self.group_size is not None:
+            byte_group = (torch.arange(n_byte, device=ids.device) *
+                          codes_per_byte // self.group_size)
+        bag_chunk = max(1, self.COUNT_BUDGET // (n_byte * 256))
+        # tokens are ordered by bag, each chunk of bags is a token range
+        starts = torch.searchsorted(
+            bags, torch.arange(0, n_bag + bag_chunk, bag_chunk,
+                               device=bags.device)).tolist()
+        # int32 indices, the counters of a chunk are below COUNT_BUDGET
+        position = torch.arange(
+            0, n_byte * 256, 256, dtype=torch.int32, device=ids.device)
+        for i, bag_start in enumerate(range(0, n_bag, bag_chunk)):
+            if starts[i] == starts[i + 1]:
+                continue
+            tokens = slice(starts[i], starts[i + 1])
+            chunk_ids = ids[tokens]
+            n_chunk_bag = min(bag_chunk, n_bag - bag_start)
+            with self._stage("gather"):
+                packed = torch.index_select(self.weight, 0, chunk_ids)
+            with self._stage("decode"):
+                index = torch.index_select(
+                    packed.view(torch.uint8), 1, byte_index).int()
+            index += position
+            index += ((bags[tokens] - bag_start).int() *
+                      (n_byte * 256)).unsqueeze(1)
+            if self.group_size is not None:
+                # the counts are weighted with the group steps of each token
+                count_weights = self.group_scales[chunk_ids][:, byte_group].float()
+                if weights is not None:
+                    count_weights = count_weights * weights[tokens].unsqueeze(1)
+            elif weights is not None:
+                count_weights = weights[tokens].float().unsqueeze(1).expand(
+                    -1, n_byte)
+            else:
+                count_weights = torch.ones(1, device=ids.device).expand(
+                    index.shape)
+            counts = torch.zeros(
+                n_chunk_bag * n_byte * 256, device=self.weight.device)
+            counts.index_add_(0, index.view(-1), count_weights.reshape(-1))
+            with self._stage("value_map"):
+                out[bag_start:bag_start + n_chunk_bag] = torch.matmul(
+                    counts.view(n_chunk_bag, n_byte, 256), lut).view(
+                        n_chunk_bag, -1)
+        if self._stats is not None:
+            self._count(bytes_read=ids.numel() * self.tensor_dim *
+                        self.weight.element_size())
+        return out[:, :self.embedding_dim]
+
+    def _code_max_pool(self, ids, bags, n_bag):
+        """ max pooling of the codes, value_list being sorted """
+        codes = self._gather_codes(ids)
+        max_codes = torch.zeros(
+            n_bag, self.embedding_dim, dtype=codes.dtype, device=codes.device)
+        max_codes.scatter_reduce_(0, bags.unsqueeze(1).expand_as(codes), codes,
+                                  "amax", include_self=False)
+        out = self.value_list[max_codes].float()
+        # empty bags are zeros
+        out[torch.bincount(bags, minlength=n_bag) == 0] = 0
+        return out
+
+    def _decode_pool(self, ids, bags, weights, n_bag):
+        """ decode every token and pool the float vectors """
+        if self.nbit != 32 and self._trainable_codebook():
+            rows = _CodebookLookup.apply(self.value_list, self, ids).float()
+        else:
+            rows = self._decode_rows(ids).float()
+        out = torch.zeros(n_bag, self.embedding_dim, device=rows.device)
+        if self.mode == "max":
+            return out.scatter_reduce_(0, bags.unsqueeze(1).expand_as(rows),
+                                       rows, "amax", include_self=False)
+        if weights is not None:
+            rows = rows * weights.unsqueeze(1)
+        return out.index_add_(0, bags, rows)
+
+    def _use_count(self, n_token, n_bag):
+        if self.pooling == "count":
+            return True
+        if self.pooling == "decode" or not self._can_count():
+            return False
+        # a bag needs 256 counters per byte, i.e. per 8 // nbit values
+        return n_token * (8 // self.nbit) >= n_bag * 256
+
+    def forward(self, input, offsets=None, per_sample_weights=None):
+        """
+        input, offsets and per_sample_weights follow nn.EmbeddingBag.forward.
+        Returns a [n_bag, embedding_dim] tensor, empty bags are zeros.
+        """
+        assert self.weight.requires_grad == False, " QuantEmbeddingBag only support fixed embedding"
+        ids, bags, weights, n_bag = self._get_bags(
+            input, offsets, per_sample_weights)
+        if self._stats is not None:
+            self._count_batch(input, n_row=n_bag)
+            self._count(unique_ids=torch.unique(ids).numel())
+        if self.nbit != 32 and self._trainable_codebook():
+            out = self._decode_pool(ids, bags, weights, n_bag)
+        elif self.mode == "max":
+            # the max of the codes is the max of the values for a sorted
+            # value_list (a trained one may not be)
+            if self.nbit == 32 or self.group_size is not None or bool(
+                    (self.value_list[1:] < self.value_list[:-1]).any()):
+                out = self._decode_pool(ids, bags, weights, n_bag)
+            else:
+                out = self._code_max_pool(ids, bags, n_bag)
+        elif self._use_count(ids.numel(), n_bag):
+            out = self._count_pool(ids, bags, weights, n_bag)
+        else:
+            out = self._decode_pool(ids, bags, weights, n_bag)
+        if self.mode == "mean":
+            bag_sizes = torch.bincount(bags, minlength=n_bag).clamp(min=1)
+            out = out / bag_sizes.unsqueeze(1).to(out.dtype)
+        return out.to(self._output_dtype())
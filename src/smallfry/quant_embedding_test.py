@@ -1,23 +1,65 @@
 from quant_embedding import compress_long_mat
 from quant_embedding import decompress_long_mat
+from quant_embedding import compress_stream_mat
+from quant_embedding import decompress_stream_mat
+from quant_embedding import stream_row_bytes
 from quant_embedding import QuantEmbedding
+from quant_embedding import QuantEmbeddingBag
 from quant_embedding import quantize_embed
+import quant_embedding
 import compress
 from unittest import TestCase
 import torch
 import numpy as np
 import logging
 import sys
+import os
+import json
+import tempfile
+import threading
+import shutil
+import torch.multiprocessing as mp
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger("quant embedding test")
 
 EMBEDDING_TEST_FILE = "./test_embed.txt"
 
 
+def _sharded_embedding_worker(rank, world_size, init_file, weight, files,
+                              inputs, expected):
+    import torch.distributed as dist
+    from sharded_embedding import ShardedQuantEmbedding, shard_range
+    dist.init_process_group(
+        "gloo", init_method="file://" + init_file, rank=rank,
+        world_size=world_size)
+    for file_name, input, out in zip(files, inputs[rank], expected[rank]):
+        sharded = ShardedQuantEmbedding.from_file(file_name)
+        assert sharded.shard.weight.size(0) == (
+            sharded.row_end - sharded.row_start)
+        assert torch.all(torch.eq(sharded(input), out))
+    row_start, row_end = shard_range(weight.size(0), rank, world_size)
+    for nbit in [2, 32]:
+        sharded = ShardedQuantEmbedding(
+            weight.size(0), weight.size(1), nbit=nbit, padding_idx=-1,
+            _weight=weight[row_start:row_end])
+        # the last rank holds the padding row
+        assert sharded.shard.padding_idx == (
+            row_end - row_start - 1 if rank == world_size - 1 else None)
+        out = sharded(inputs[rank][0])
+        if nbit == 32:
+            assert torch.all(torch.eq(out, weight[inputs[rank][0]]))
+        else:
+            # every shard shares value_list
+            value_lists = [torch.zeros(2**nbit) for _ in range(world_size)]
+            dist.all_gather(value_lists, sharded.shard.value_list)
+            assert all(torch.equal(v, value_lists[0]) for v in value_lists)
+    dist.destroy_process_group()
+
+
 class QuantEmbeddingTest(TestCase):
     def test_compress_decompress_funcs(self):
         # test the compress and decompress functions are reverse to each other
-        n_bit = int(np.random.choice([2, 4, 8, 16, 32]))
+        n_bit = int(np.random.choice([1, 2, 4, 8, 16, 32]))
         n_vals = int(2**n_bit)
         n_dim = np.random.randint(low=2, high=100)
         batch_size = np.random.randint(low=3, high=16)
@@ -28,6 +70,498 @@ class QuantEmbeddingTest(TestCase):
         # print(input)
         # print(decompressed)
         assert torch.all(torch.eq(input, decompressed))
+        # the row chunks do not change the result
+        chunk_rows = int(np.random.randint(low=1, high=20))
+        assert torch.equal(
+            compress_long_mat(input, n_bit, chunk_rows=chunk_rows), compressed)
+        assert torch.equal(decompress_long_mat(
+            compressed, n_bit, dim=n_dim, chunk_rows=chunk_rows), input)
+
+    def test_stream_compress_decompress_funcs(self):
+        # test the bit stream packing for every bit width up to 8 bits
+        for n_bit in range(1, 9):
+            n_vals = int(2**n_bit)
+            n_dim = np.random.randint(low=1, high=100)
+            row_align = int(np.random.choice([1, 4, 8]))
+            input = torch.LongTensor(5, 7, n_dim).random_(to=n_vals)
+            compressed = compress_stream_mat(input, n_bit, row_align=row_align)
+            assert compressed.dtype == torch.uint8
+            assert compressed.size(-1) == stream_row_bytes(
+                n_dim, n_bit, row_align)
+            assert compressed.size(-1) % row_align == 0
+            decompressed = decompress_stream_mat(compressed, n_bit, dim=n_dim)
+            assert torch.all(torch.eq(input, decompressed))
+            # chunked, into a narrow out
+            out = torch.empty(5, 7, n_dim, dtype=torch.int32)
+            assert decompress_stream_mat(
+                compressed, n_bit, dim=n_dim, out=out, chunk_rows=3) is out
+            assert torch.equal(out.long(), input)
+
+    def test_lut_decode(self):
+        # test the lookup table decoding is identical to the shift based decoding
+        for n_bit in [1, 2, 4, 8]:
+            n_dim = np.random.randint(low=2, high=100)
+            n_word = np.random.randint(low=2, high=100)
+            weight = torch.FloatTensor(np.random.rand(n_word, n_dim))
+            lut_embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=n_bit,
+                _weight=weight.clone(),
+                decode="lut")
+            shift_embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=n_bit,
+                _weight=weight.clone(),
+                decode="shift")
+            stream_embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=n_bit,
+                _weight=weight.clone(),
+                packing="stream")
+            input = torch.LongTensor(7, 13).random_(to=n_word)
+            lut_out = lut_embedding(input)
+            assert lut_out.is_contiguous()
+            assert torch.all(torch.eq(lut_out, shift_embedding(input)))
+            assert torch.all(torch.eq(lut_out, stream_embedding(input)))
+
+    def test_empty_input(self):
+        # test empty batches for a dim which is not a multiple of the
+        # codes per byte of the LUT decoding
+        weight = torch.FloatTensor(np.random.randn(50, 13))
+        for nbit in [1, 2, 4]:
+            for kwargs in [{}, {"packing": "stream"}, {"group_size": 5}]:
+                embedding = QuantEmbedding(
+                    50, 13, nbit=nbit, _weight=weight, **kwargs)
+                assert embedding.decode == "lut"
+                assert embedding(torch.LongTensor(0, 3)).shape == (0, 3, 13)
+                assert embedding._gather_codes(
+                    torch.LongTensor(0)).shape == (0, 13)
+
+    def test_compress_uniform_codes(self):
+        # test the codes reproduce the matrix returned by compress_uniform
+        for n_bit in [1, 3, 8, 16]:
+            X = np.random.randn(50, 30).astype(np.float32)
+            Xq, frob_squared_error, _ = compress.compress_uniform(
+                X, n_bit, adaptive_range=True)
+            codes, scale, offset, codes_frob_squared_error, _ = \
+                compress.compress_uniform_codes(X, n_bit, adaptive_range=True)
+            assert codes.dtype == compress.get_codes_dtype(n_bit)
+            assert codes.max() < 2**n_bit
+            assert np.array_equal(
+                compress._dequantize(codes.astype(X.dtype), scale, offset), Xq)
+            assert np.isclose(frob_squared_error, codes_frob_squared_error)
+
+    def test_compress_uniform_blocked(self):
+        # test the blocked compression matches the in-memory compression
+        memmap_file = "./test_embed.npy"
+        X = np.random.randn(1000, 20).astype(np.float32)
+        X_memmap = np.memmap(memmap_file, dtype=np.float32, mode="w+",
+                             shape=X.shape)
+        X_memmap[:] = X
+        n_bit = 3
+        range_limit = compress.find_optimal_range(X, n_bit)
+        codes, scale, offset, frob_squared_error, _ = \
+            compress.compress_uniform_codes(X, n_bit, adaptive_range=True)
+        for input in [X_memmap, [X[i:i + 64] for i in range(0, 1000, 64)]]:
+            blocked_codes, blocked_scale, blocked_offset, \
+                blocked_frob_squared_error, _ = compress.compress_uniform_blocked(
+                    input, n_bit, range_limit=range_limit, block_rows=100,
+                    n_threads=3)
+            assert np.array_equal(blocked_codes, codes)
+            assert (blocked_scale, blocked_offset) == (scale, offset)
+            assert np.isclose(blocked_frob_squared_error, frob_squared_error)
+        # a plain row iterator, with and without out
+        blocked_codes = compress.compress_uniform_blocked(
+            iter(X), n_bit, range_limit=range_limit, block_rows=100)[0]
+        assert np.array_equal(blocked_codes, codes)
+        out = np.zeros_like(codes)
+        compress.compress_uniform_blocked(
+            iter(X), n_bit, range_limit=range_limit, out=out, block_rows=100)
+        assert np.array_equal(out, codes)
+        with self.assertRaises(ValueError):
+            compress.compress_uniform_blocked(
+                [X[None]], n_bit, range_limit=range_limit)
+        del X_memmap
+        os.remove(memmap_file)
+
+    def test_histogram_range_search(self):
+        # test the histogram oracle finds a range as good as the exact search
+        X = np.random.laplace(size=(2000, 50)).astype(np.float32)
+        for n_bit in [1, 2, 4]:
+            exact_range = compress.find_optimal_range(X, n_bit, oracle="exact")
+            hist_range = compress.find_optimal_range(
+                X, n_bit, oracle="histogram")
+            sample_range = compress.find_optimal_range(
+                X, n_bit, oracle="histogram", subsample_rows=500)
+            exact_error = compress.compress_and_compute_frob_squared_error(
+                X, n_bit, exact_range)
+            # the exact search stays the default, "auto" switches to the
+            # histogram for large matrices only
+            max_size = compress.EXACT_ORACLE_MAX_SIZE
+            compress.EXACT_ORACLE_MAX_SIZE = X.size - 1
+            try:
+                assert compress.find_optimal_range(X, n_bit) == exact_range
+                assert compress.find_optimal_range(
+                    X, n_bit, oracle="auto") == hist_range
+            finally:
+                compress.EXACT_ORACLE_MAX_SIZE = max_size
+            assert compress.compress_and_compute_frob_squared_error(
+                X, n_bit, hist_range) <= 1.01 * exact_error
+            assert compress.compress_and_compute_frob_squared_error(
+                X, n_bit, sample_range) <= 1.05 * exact_error
+            f = compress.make_histogram_error_oracle(X, n_bit)
+            assert np.isclose(f(exact_range), exact_error, rtol=1e-2)
+
+    def test_group_wise_scales(self):
+        # test group-wise quantization against compress_uniform_grouped_codes
+        n_word, n_dim = 60, 30
+        weight = np.random.randn(n_word, n_dim).astype(np.float32)
+        # a few outlier rows force coarse steps on a global range
+        weight[:3] *= 20
+        input = torch.LongTensor(5, 9).random_(to=n_word)
+        global_embedding = QuantEmbedding(
+            num_embeddings=n_word,
+            embedding_dim=n_dim,
+            nbit=2,
+            _weight=torch.FloatTensor(weight))
+        global_error = torch.norm(
+            global_embedding(torch.arange(n_word)) - torch.FloatTensor(weight))
+        for group_size in [n_dim, 7]:
+            for n_bit in [2, 3]:
+                embedding = QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    nbit=n_bit,
+                    _weight=torch.FloatTensor(weight),
+                    group_size=group_size)
+                codes, scales, _, _ = compress.compress_uniform_grouped_codes(
+                    weight, n_bit, group_size=group_size, adaptive_range=True)
+                group_idx = np.arange(n_dim) // group_size
+                ref = (codes - (2**n_bit - 1) / 2) * scales.astype(
+                    np.float32)[:, group_idx]
+                ref = torch.FloatTensor(ref)
+                assert torch.allclose(embedding(input), ref[input])
+                error = torch.norm(
+                    embedding(torch.arange(n_word)) - torch.FloatTensor(weight))
+                assert error < global_error
+        # the rows of _weight have to match num_embeddings
+        for n_rows in [n_word - 1, n_word + 1]:
+            with self.assertRaises(Exception):
+                QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    nbit=2,
+                    _weight=torch.randn(n_rows, n_dim),
+                    group_size=7)
+
+    def test_decoded_row_cache(self):
+        # test cached lookups return the same rows as uncached ones
+        n_word, n_dim = 200, 30
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        embedding = QuantEmbedding(
+            num_embeddings=n_word, embedding_dim=n_dim, nbit=3, _weight=weight)
+        inputs = [
+            torch.LongTensor(4, 25).random_(to=n_word) for _ in range(10)
+        ]
+        ref_outs = [embedding(input) for input in inputs]
+        # pinned to the most frequent ids, where ids < 20 are all hits
+        embedding.enable_cache(
+            frequencies=torch.arange(n_word, 0, -1), top_k=20)
+        assert embedding.cache_rows.size(0) == 20
+        for input, ref_out in zip(inputs, ref_outs):
+            assert torch.all(torch.eq(embedding(input), ref_out))
+        hot_input = torch.LongTensor(3, 5).random_(to=20)
+        assert torch.all(torch.eq(embedding(hot_input), embedding.cache_rows[
+            hot_input]))
+        # adaptive LFU with a byte budget
+        embedding.enable_cache(byte_budget=50 * n_dim * 4, refresh_every=3)
+        assert embedding.cache_rows.size(0) == 50
+        for _ in range(2):
+            for input, ref_out in zip(inputs, ref_outs):
+                assert torch.all(torch.eq(embedding(input), ref_out))
+        assert int((embedding.cache_slot >= 0).sum()) == 50
+        embedding.disable_cache()
+        assert torch.all(torch.eq(embedding(inputs[0]), ref_outs[0]))
+
+    def test_dedup_forward(self):
+        # test deduplicated lookups return the same rows
+        n_word, n_dim = 50, 20
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        input = torch.LongTensor(16, 40).random_(to=n_word)
+        outs = []
+        for dedup in [False, True, "auto"]:
+            embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=4,
+                _weight=weight,
+                dedup=dedup)
+            outs.append(embedding(input))
+        for out in outs[1:]:
+            assert torch.all(torch.eq(out, outs[0]))
+
+    def test_forward_out_and_workspace(self):
+        # test out= and repeated forward calls reusing the workspace
+        n_word, n_dim = 50, 21
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        for nbit, kwargs in [(4, {}), (4, {"decode": "shift"}), (3, {}),
+                             (2, {"group_size": 8}), (32, {})]:
+            embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=nbit,
+                _weight=weight,
+                **kwargs)
+            for shape in [(16, 40), (3, 5), (16, 40)]:
+                input = torch.LongTensor(*shape).random_(to=n_word)
+                expected = embedding(input)
+                out = torch.empty(*shape, n_dim)
+                assert embedding(input, out=out) is out
+                assert torch.all(torch.eq(out, expected))
+                assert torch.all(torch.eq(embedding(input), expected))
+            embedding.release_workspace()
+            assert torch.all(torch.eq(embedding(input), expected))
+            if nbit == 32:
+                continue
+            # the arenas of exited threads are dropped
+            thread = threading.Thread(target=embedding, args=(input,))
+            thread.start()
+            thread.join()
+            assert len(embedding._workspace_buffers) == 2
+            embedding(input)
+            thread = threading.Thread(target=embedding, args=(input,))
+            thread.start()
+            thread.join()
+            assert len(embedding._workspace_buffers) == 2
+
+    def test_reduced_precision_output(self):
+        # test float16 / bfloat16 value_list and outputs
+        n_word, n_dim = 60, 24
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        input = torch.LongTensor(8, 50).random_(to=n_word)
+        for nbit, kwargs in [(4, {}), (3, {}), (2, {"group_size": 8}),
+                             (32, {})]:
+            ref = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=nbit,
+                _weight=weight,
+                **kwargs)
+            for dtype in [torch.float16, torch.bfloat16]:
+                embedding = QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    nbit=nbit,
+                    _weight=weight,
+                    dtype=dtype,
+                    **kwargs)
+                out = embedding(input)
+                assert out.dtype == dtype
+                assert torch.allclose(
+                    out.float(), ref(input).to(dtype).float(),
+                    rtol=1e-2, atol=1e-2)
+                embedding.save("test_embed.sfy")
+                loaded = QuantEmbedding.from_file("test_embed.sfy")
+                assert torch.all(torch.eq(loaded(input), out))
+                os.remove("test_embed.sfy")
+        model = torch.nn.Sequential(torch.nn.Embedding(n_word, n_dim)).half()
+        model = quantize_embed(model, nbit=4)
+        assert model[0](input).dtype == torch.float16
+
+    def test_embedding_bag(self):
+        # test bag pooling against nn.EmbeddingBag on the decoded rows
+        n_word, n_dim = 80, 21
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        input = torch.LongTensor(30).random_(to=n_word)
+        input[:3] = 3
+        offsets = torch.LongTensor([0, 5, 5, 12, 20])
+        for nbit, kwargs in [(4, {}), (1, {}), (3, {}), (8, {}),
+                             (2, {"group_size": 8}), (32, {})]:
+            ref_weight = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=nbit,
+                _weight=weight,
+                **kwargs)(torch.arange(n_word))
+            for mode in ["sum", "mean", "max"]:
+                for pooling in ["count", "decode"]:
+                    if pooling == "count" and nbit in (3, 32):
+                        continue
+                    bag = QuantEmbeddingBag(
+                        num_embeddings=n_word,
+                        embedding_dim=n_dim,
+                        mode=mode,
+                        padding_idx=3,
+                        nbit=nbit,
+                        _weight=weight,
+                        pooling=pooling,
+                        **kwargs)
+                    # a small budget to pool in several chunks of bags
+                    bag.COUNT_BUDGET = 2 * 256 * n_dim
+                    ref = torch.nn.EmbeddingBag(
+                        n_word, n_dim, mode=mode, padding_idx=3,
+                        _weight=ref_weight)
+                    per_sample_weights = torch.rand(30) if mode == "sum" else None
+                    assert torch.allclose(
+                        bag(input, offsets, per_sample_weights),
+                        ref(input, offsets, per_sample_weights), atol=1e-5)
+                    input_2d = input.view(5, 6)
+                    assert torch.allclose(
+                        bag(input_2d), ref(input_2d), atol=1e-5)
+        model = torch.nn.Sequential(torch.nn.EmbeddingBag(n_word, n_dim))
+        model = quantize_embed(model, nbit=2)
+        assert isinstance(model[0], QuantEmbeddingBag)
+        assert model[0].mode == "mean"
+
+    def test_topk_search(self):
+        # test topk against a brute force search over the decoded rows
+        n_word, n_dim = 300, 21
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        query = torch.FloatTensor(np.random.randn(3, n_dim))
+        for nbit, kwargs in [(4, {}), (1, {}), (3, {}), (8, {}),
+                             (2, {"group_size": 8}), (32, {})]:
+            embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=nbit,
+                _weight=weight,
+                **kwargs)
+            decoded = embedding(torch.arange(n_word)).float()
+            norms = decoded.norm(dim=1)
+            expected = {
+                "dot": torch.matmul(query, decoded.t()),
+                "cosine": torch.matmul(query, decoded.t()) /
+                (query.norm(dim=1, keepdim=True) * norms),
+                "l2": -torch.cdist(query, decoded).pow(2),
+            }
+            for adc in [True, False]:
+                if adc and not embedding._adc_supported():
+                    continue
+                for metric in ["dot", "cosine", "l2"]:
+                    for with_norms in [False, True]:
+                        if with_norms:
+                            embedding.compute_row_norms(block_rows=64)
+                        values, indices = embedding.topk(
+                            query, k=5, metric=metric, block_rows=64,
+                            n_threads=2, adc=adc)
+                        ref_values, ref_indices = expected[metric].topk(5)
+                        if metric == "l2":
+                            ref_values = -ref_values
+                        assert torch.equal(indices, ref_indices)
+                        assert torch.allclose(values, ref_values, atol=1e-4)
+                    del embedding.row_norms
+                values, indices = embedding.topk(query[0], k=5, adc=adc)
+                assert indices.shape == (5,)
+                # the workspace arenas of the pool threads are freed
+                assert set(embedding.__dict__.get(
+                    "_workspace_buffers", {})) <= set([threading.get_ident()])
+
+    def test_sharded_embedding(self):
+        # test routed lookups of a 2 process gloo group against QuantEmbedding
+        n_word, n_dim, world_size = 103, 21, 2
+        weight = torch.FloatTensor(np.random.randn(n_word, n_dim))
+        tmp_dir = tempfile.mkdtemp()
+        files = []
+        modules = []
+        for nbit, kwargs in [(4, {}), (3, {"group_size": 8})]:
+            embedding = QuantEmbedding(
+                num_embeddings=n_word,
+                embedding_dim=n_dim,
+                nbit=nbit,
+                _weight=weight,
+                **kwargs)
+            files.append(os.path.join(tmp_dir, str(nbit) + ".sfy"))
+            embedding.save(files[-1])
+            modules.append(embedding)
+        # rank 1 also looks up empty batches (of LUT decoded layouts, the
+        # dim being odd)
+        inputs = [[torch.LongTensor(5, 7).random_(to=n_word)
+                   for _ in modules],
+                  [torch.LongTensor(0, 3),
+                   torch.LongTensor(4, 3).random_(to=n_word)]]
+        expected = [[m(input) for m, input in zip(modules, rank_inputs)]
+                    for rank_inputs in inputs]
+        mp.spawn(_sharded_embedding_worker,
+                 args=(world_size, os.path.join(tmp_dir, "init"), weight,
+                       files, inputs, expected),
+                 nprocs=world_size)
+        shutil.rmtree(tmp_dir)
+
+    def test_batching_server(self):
+        # test concurrent threaded and asyncio lookups through the server
+        import asyncio
+        import threading
+        import concurrent.futures
+        from serving import BatchingEmbeddingServer
+        n_word, n_dim = 100, 20
+        embedding = QuantEmbedding(
+            num_embeddings=n_word,
+            embedding_dim=n_dim,
+            nbit=4,
+            _weight=torch.FloatTensor(np.random.randn(n_word, n_dim)))
+        inputs = [torch.LongTensor(i % 3 + 1, 4).random_(to=n_word)
+                  for i in range(40)]
+        outputs = [None] * len(inputs)
+        with BatchingEmbeddingServer(
+                embedding, max_batch_size=32, max_wait=0.01) as server:
+            def lookup(i):
+                outputs[i] = server.lookup(inputs[i])
+            threads = [threading.Thread(target=lookup, args=(i,))
+                       for i in range(len(inputs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for input, output in zip(inputs, outputs):
+                assert torch.equal(output, embedding(input))
+
+            async def lookup_all():
+                return await asyncio.gather(
+                    *[server.lookup_async(input) for input in inputs])
+            for input, output in zip(inputs, asyncio.run(lookup_all())):
+                assert torch.equal(output, embedding(input))
+            stats = server.stats()
+        assert stats["n_requests"] == 2 * len(inputs)
+        assert sum(stats["batch_requests"].values()) == stats["n_batches"]
+        # batches never exceed max_batch_size ids
+        assert max(stats["batch_ids"].keys()) <= 32
+        assert stats["n_batches"] < 2 * len(inputs)
+        # concurrent batches through an adaptive cache refreshed every call
+        embedding.enable_cache(top_k=10, refresh_every=1)
+        with BatchingEmbeddingServer(
+                embedding, max_batch_size=8, max_wait=0.001,
+                n_threads=4) as server:
+            with self.assertRaises(Exception):
+                server.submit([1, 2, 3])
+            futures = [server.submit(input) for input in inputs * 5]
+            for input, future in zip(inputs * 5, futures):
+                assert torch.equal(future.result(),
+                                   embedding._decode_rows(input))
+        # requests racing close are either rejected or resolved
+        server = BatchingEmbeddingServer(embedding, max_wait=0.001)
+        futures = []
+
+        def submit_all():
+            for input in inputs * 5:
+                try:
+                    futures.append(server.submit(input))
+                except Exception:
+                    return
+        threads = [threading.Thread(target=submit_all) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        server.close()
+        for thread in threads:
+            thread.join()
+        for future in futures:
+            # served or failed by close, a hanging future times out
+            concurrent.futures.wait([future], timeout=10)
+            assert future.done()
+        with self.assertRaises(Exception):
+            server.submit(inputs[0])
 
     def test_embeding_replacement_func(self):
         layer1 = torch.nn.Embedding(100, 10)
@@ -56,6 +590,290 @@ class QuantEmbeddingTest(TestCase):
         assert isinstance(module_list_comp[1][0], QuantEmbedding)
         assert isinstance(module_list_comp[1][1], QuantEmbedding)
 
+    def test_parallel_quantize_embed(self):
+        # test overrides, skipped / shared modules and the report
+        shared = torch.nn.Embedding(50, 8)
+        model = torch.nn.ModuleDict({
+            "word": torch.nn.Embedding(300, 20),
+            "char": torch.nn.Sequential(torch.nn.Embedding(100, 10), shared),
+            "tied": shared,
+            "keep": torch.nn.Embedding(30, 5),
+            "done": QuantEmbedding(40, 6, nbit=2,
+                                   _weight=torch.FloatTensor(40, 6).normal_()),
+            "bag": torch.nn.EmbeddingBag(60, 12),
+        })
+        word_weight = model["word"].weight.detach().clone()
+        done = model["done"]
+        model, report = quantize_embed(
+            model, nbit=4, n_workers=3,
+            nbit_overrides={"word": 2, "keep": None}, report=True)
+        assert model["word"].nbit == 2
+        assert model["char"][0].nbit == 4
+        assert model["char"][1] is model["tied"]
+        assert isinstance(model["tied"], QuantEmbedding)
+        assert isinstance(model["keep"], torch.nn.Embedding) and not (
+            isinstance(model["keep"], QuantEmbedding))
+        assert model["done"] is done
+        assert isinstance(model["bag"], QuantEmbeddingBag)
+        assert [r["name"] for r in report] == [
+            "word", "char.0", "char.1", "bag"]
+        for r in report:
+            assert r["saved_bytes"] == r["float_bytes"] - r["quant_bytes"] > 0
+            assert r["seconds"] >= 0
+        reference = QuantEmbedding(300, 20, nbit=2, _weight=word_weight)
+        assert torch.equal(model["word"].weight, reference.weight)
+        # dtype overrides the dtype of the replaced tables
+        model = quantize_embed(torch.nn.ModuleDict({
+            "word": torch.nn.Embedding(30, 8),
+            "bag": torch.nn.EmbeddingBag(30, 8)}), nbit=4, dtype=torch.float16)
+        assert model["word"].value_list.dtype == torch.float16
+        assert model["bag"].value_list.dtype == torch.float16
+
+    def test_tiered_embedding(self):
+        # test every row is decoded by the tier of its frequency rank
+        from tiered_embedding import TieredQuantEmbedding
+        weight = torch.FloatTensor(np.random.randn(200, 20))
+        frequencies = torch.rand(200)
+        input = torch.LongTensor(7, 13).random_(to=200)
+        for kwargs in [{}, {"frequencies": frequencies},
+                       {"frequencies": frequencies, "group_size": 8}]:
+            embedding = TieredQuantEmbedding(
+                200, 20, _weight=weight, tiers=((10, 8), (50, 2), (None, 1)),
+                **kwargs)
+            assert [tier.num_embeddings for tier in embedding.tiers] == [
+                10, 50, 140]
+            if "frequencies" in kwargs:
+                order = frequencies.argsort(descending=True)
+            else:
+                order = torch.arange(200)
+            rank = torch.empty(200, dtype=torch.int64)
+            rank[order] = torch.arange(200)
+            input_rank = rank[input.view(-1)]
+            input_tier = (input_rank >= 10).long() + (input_rank >= 60).long()
+            local = input_rank - torch.LongTensor([0, 10, 60])[input_tier]
+            expected = torch.stack([
+                embedding.tiers[t](local[i:i + 1])[0]
+                for i, t in enumerate(input_tier.tolist())])
+            out = embedding(input)
+            assert list(out.shape) == [7, 13, 20]
+            assert torch.equal(out.view(-1, 20), expected)
+            # the most frequent rows have the smallest error
+            error = ((embedding(order) - weight[order])**2).sum(dim=1)
+            assert error[:10].mean() < error[10:60].mean() < error[60:].mean()
+        # the padding row is a local row of the tier holding it
+        embedding = TieredQuantEmbedding(
+            200, 20, _weight=weight, tiers=((10, 8), (None, 2)),
+            padding_idx=-1, frequencies=frequencies)
+        padding_rank = int(rank[199])
+        tier = int(padding_rank >= 10)
+        assert embedding.tiers[tier].padding_idx == padding_rank - 10 * tier
+        assert embedding.tiers[1 - tier].padding_idx is None
+        with self.assertRaises(Exception):
+            TieredQuantEmbedding(200, 20, _weight=weight,
+                                 tiers=((10, 8), (50, 2)))
+
+    def test_trainable_codebook(self):
+        # test the codebook gradient, fine-tuning and requantization
+        weight = torch.FloatTensor(np.random.randn(100, 12))
+        input = torch.LongTensor(9, 7).random_(to=100)
+        for kwargs in [{"nbit": 2}, {"nbit": 3, "group_size": 5},
+                       {"nbit": 4, "packing": "stream", "decode": "shift"}]:
+            embedding = QuantEmbedding(100, 12, _weight=weight, **kwargs)
+            embedding.enable_codebook_training()
+            assert [name for name, _ in embedding.named_parameters()] == [
+                "weight", "value_list"]
+            assert "value_list" in embedding.state_dict()
+            # reference gradient from the materialized value_list[codes]
+            codes = embedding._gather_codes(input.view(-1))
+            value_list = embedding.value_list.detach().clone().requires_grad_()
+            ref = value_list[codes]
+            if embedding.group_size is not None:
+                scales = embedding.group_scales[input.view(-1)].float(
+                    ).repeat_interleave(5, dim=1)[:, :12]
+                ref = ref * scales
+            grad_out = torch.randn(9, 7, 12)
+            (ref.view(9, 7, 12) * grad_out).sum().backward()
+            out = embedding(input)
+            assert torch.allclose(out, ref.view(9, 7, 12), atol=1e-6)
+            (out * grad_out).sum().backward()
+            assert torch.allclose(embedding.value_list.grad, value_list.grad,
+                                  atol=1e-4)
+            # fine-tuning a perturbed codebook reduces the error
+            target = embedding(torch.arange(100)).detach()
+            with torch.no_grad():
+                embedding.value_list.mul_(1.5)
+            optimizer = torch.optim.Adam([embedding.value_list], lr=0.05)
+            losses = []
+            for _ in range(50):
+                optimizer.zero_grad()
+                loss = ((embedding(torch.arange(100)) - target)**2).mean()
+                loss.backward()
+                optimizer.step()
+                losses.append(loss.item())
+            assert losses[-1] < 0.1 * losses[0]
+            # the non-differentiable decodes work while training
+            decoded = embedding(torch.arange(100)).detach()
+            values, indices = embedding.topk(decoded[:2], k=3, adc=False)
+            assert torch.allclose(values[:, 0], torch.matmul(
+                decoded[:2], decoded.t()).max(dim=1)[0], atol=1e-5)
+            embedding.topk(decoded[0], k=3, metric="cosine")
+            norms = embedding.compute_row_norms()
+            assert torch.allclose(norms, decoded.norm(dim=1))
+            del embedding.row_norms
+            embedding.enable_cache(top_k=5, frequencies=torch.arange(100))
+            assert torch.equal(embedding._lookup_cached(torch.arange(100)),
+                               decoded)
+            assert embedding(input).requires_grad
+            embedding.disable_cache()
+            # requantization assigns the nearest values of the codebook
+            embedding.requantize(weight)
+            out = embedding(torch.arange(100)).detach()
+            values = embedding.value_list.detach()
+            if embedding.group_size is None:
+                nearest = values[(weight.unsqueeze(-1) - values).abs().argmin(-1)]
+                assert torch.allclose(out, nearest)
+            embedding.disable_codebook_training()
+            assert len(list(embedding.parameters())) == 1
+            assert torch.equal(embedding(torch.arange(100)), out)
+        with self.assertRaises(Exception):
+            QuantEmbedding(100, 12, _weight=weight,
+                           nbit=32).enable_codebook_training()
+
+    def test_budgeted_quantize_embed(self):
+        # test the planned bits fit the budget with the least estimated error
+        import itertools
+        nbits = [1, 2, 4, 32]
+        model = torch.nn.Sequential(
+            torch.nn.Embedding(300, 20), torch.nn.Embedding(30, 8),
+            torch.nn.Sequential(torch.nn.EmbeddingBag(50, 4)))
+        tables = [model[0], model[1], model[2][0]]
+        byte_budget = 6000
+        plan = quant_embedding.plan_embedding_bits(model, byte_budget, nbits)
+        assert [table["name"] for table in plan] == ["0", "1", "2.0"]
+        assert sum(table["bytes"] for table in plan) <= byte_budget
+        options = [[(quant_embedding.quant_state_bytes(
+            t.num_embeddings, t.embedding_dim, nbit), error) for nbit, error in
+                    compress.estimate_distortion_curve(
+                        t.weight.detach().numpy(), nbits).items()]
+                   for t in tables]
+        best = min(sum(error for _, error in choice)
+                   for choice in itertools.product(*options)
+                   if sum(n_bytes for n_bytes, _ in choice) <= byte_budget)
+        assert np.isclose(sum(table["error"] for table in plan), best)
+        model, plan = quant_embedding.quantize_embed_to_budget(
+            model, byte_budget, nbits)
+        assert [m.nbit for m in (model[0], model[1], model[2][0])] == [
+            table["nbit"] for table in plan]
+        assert quant_embedding.get_model_mem(model)[0] == sum(
+            table["bytes"] for table in plan)
+        with self.assertRaises(Exception):
+            quant_embedding.plan_embedding_bits(torch.nn.Sequential(
+                torch.nn.Embedding(300, 20)), 100, nbits)
+
+    def test_compression_cache(self):
+        # test cache hits reuse the compression results, and eviction
+        from compression_cache import CompressionCache
+        cache_dir = tempfile.mkdtemp()
+        cache = CompressionCache(cache_dir)
+        weight = torch.FloatTensor(np.random.randn(100, 20))
+        for kwargs in [{}, {"group_size": 8}, {"dtype": torch.bfloat16}]:
+            embeddings = [QuantEmbedding(
+                num_embeddings=100,
+                embedding_dim=20,
+                nbit=3,
+                _weight=weight,
+                cache=cache,
+                **kwargs) for _ in range(2)]
+            input = torch.LongTensor(10).random_(to=100)
+            assert torch.equal(embeddings[0](input), embeddings[1](input))
+        assert (cache.hits, cache.misses) == (3, 3)
+        # the settings are part of the key
+        QuantEmbedding(100, 20, nbit=2, _weight=weight, cache=cache)
+        assert (cache.hits, cache.misses) == (3, 4)
+        X = weight.numpy().astype(np.float64)
+        for _ in range(2):
+            Xq, _, _ = compress.compress_uniform(
+                X, 4, adaptive_range=True, cache=cache)
+            assert np.array_equal(
+                Xq, compress.compress_uniform(X, 4, adaptive_range=True,
+                                              cache=False)[0])
+        assert (cache.hits, cache.misses) == (4, 5)
+        # the least recently used entries are evicted
+        n_entry = len(os.listdir(cache_dir))
+        cache.max_bytes = cache.size() - 1
+        cache.evict()
+        assert len(os.listdir(cache_dir)) == n_entry - 1
+        assert cache.size() <= cache.max_bytes
+        shutil.rmtree(cache_dir)
+
+    def test_runtime_stats(self):
+        # test the counters of the embedding modules and their aggregation
+        weight = torch.FloatTensor(np.random.randn(100, 20))
+        model = torch.nn.Sequential(
+            QuantEmbedding(100, 20, nbit=4, _weight=weight),
+            torch.nn.Sequential(QuantEmbedding(
+                100, 20, nbit=3, _weight=weight, group_size=8, dedup=True)))
+        input = torch.LongTensor([1, 2, 2, 3, 3, 3])
+        model[0](input)
+        assert model[0]._stats is None
+        quant_embedding.enable_embedding_stats(model)
+        out = model[0](input)
+        model[1][0](input)
+        model[0].enable_cache(top_k=2, frequencies=torch.arange(100))
+        assert torch.equal(model[0](input), out)
+        stats = quant_embedding.get_embedding_stats(model)
+        assert set(stats.keys()) == {"0", "1.0", "total"}
+        assert stats["0"]["calls"] == 2 and stats["0"]["lookups"] == 12
+        assert stats["0"]["unique_ids_per_batch"] == 3
+        # the cache holds rows 98 and 99, the first call decodes every id
+        assert stats["0"]["decoded_rows"] == 6 + 2 + 6
+        assert stats["0"]["cache_misses"] == 6
+        assert stats["0"]["cache_hit_rate"] == 0
+        # deduplicated lookups decode the unique ids only
+        assert stats["1.0"]["decoded_rows"] == 3
+        assert stats["1.0"]["bytes_produced"] == 6 * 20 * 4
+        assert stats["1.0"]["gather_seconds"] > 0
+        assert stats["1.0"]["value_map_seconds"] > 0
+        assert stats["total"]["calls"] == 3
+        quant_embedding.disable_embedding_stats(model)
+        assert quant_embedding.get_embedding_stats(model)["total"]["calls"] == 0
+
+    def test_scripted_decoder(self):
+        # test the torchscript decoder matches forward for every layout
+        from export import script_embedding
+        weight = torch.FloatTensor(np.random.randn(100, 37))
+        input = torch.LongTensor(5, 7).random_(to=100)
+        file_name = tempfile.mktemp(suffix=".pt")
+        for kwargs in [{"nbit": 32}, {"nbit": 4}, {"nbit": 3},
+                       {"nbit": 2, "packing": "stream"},
+                       {"nbit": 4, "group_size": 8},
+                       {"nbit": 8, "dtype": torch.float16}]:
+            embedding = QuantEmbedding(100, 37, _weight=weight, **kwargs)
+            scripted = script_embedding(embedding)
+            torch.jit.save(scripted, file_name)
+            out = torch.jit.load(file_name)(input)
+            assert out.dtype == embedding(input).dtype
+            assert torch.equal(out, embedding(input))
+        os.remove(file_name)
+
+    def test_onnx_export(self):
+        try:
+            import onnxruntime
+        except ImportError:
+            self.skipTest("onnxruntime is not installed")
+        from export import export_onnx
+        weight = torch.FloatTensor(np.random.randn(100, 37))
+        input = torch.LongTensor(11).random_(to=100)
+        tmp_dir = tempfile.mkdtemp()
+        for kwargs in [{"nbit": 3}, {"nbit": 4, "group_size": 8}]:
+            embedding = QuantEmbedding(100, 37, _weight=weight, **kwargs)
+            file_name = os.path.join(tmp_dir, "embed.onnx")
+            export_onnx(embedding, file_name)
+            session = onnxruntime.InferenceSession(file_name)
+            out = session.run(None, {"input": input.numpy()})[0]
+            assert np.array_equal(out, embedding(input).numpy())
+        shutil.rmtree(tmp_dir)
+
     def generate_embedding_file(self,
                                 n_bit,
                                 n_dim,
@@ -80,7 +898,7 @@ class QuantEmbeddingTest(TestCase):
 
     def get_embeddings_for_test(self, quantized_input=False, use_file=True):
         n_dim = int(np.random.randint(low=1, high=100))
-        n_bit = int(np.random.choice([2, 4, 8, 16]))
+        n_bit = int(np.random.choice([2, 3, 4, 5, 6, 7, 8, 16]))
         n_word = np.random.choice(np.arange(1, 100))
 
         input_embedding = self.generate_embedding_file(
@@ -130,6 +948,84 @@ class QuantEmbeddingTest(TestCase):
         assert quant_embedding.embedding_dim == ref_embedding.size(-1)
         return input_embedding, ref_embedding, embedding, quant_embedding
 
+    def test_chunked_file_loading(self):
+        # test loading a file in several chunks matches loading the tensor
+        chunk_rows = quant_embedding.FILE_CHUNK_ROWS
+        quant_embedding.FILE_CHUNK_ROWS = 7
+        try:
+            for quantized_input in [True, False]:
+                n_bit, n_dim, n_word = 3, 20, 50
+                input_embedding = self.generate_embedding_file(
+                    n_bit=n_bit,
+                    n_dim=n_dim,
+                    n_word=n_word,
+                    quantized_input=quantized_input)
+                # prepend a fastText style header
+                with open(EMBEDDING_TEST_FILE, "r") as f:
+                    content = f.read()
+                with open(EMBEDDING_TEST_FILE, "w") as f:
+                    f.write(str(n_word) + " " + str(n_dim) + "\n" + content)
+                file_embedding = QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    nbit=n_bit,
+                    embedding_file=EMBEDDING_TEST_FILE)
+                tensor_embedding = QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    nbit=n_bit,
+                    _weight=input_embedding)
+                input = torch.arange(n_word)
+                assert torch.all(
+                    torch.eq(file_embedding(input), tensor_embedding(input)))
+        finally:
+            quant_embedding.FILE_CHUNK_ROWS = chunk_rows
+
+    def test_save_and_load_container(self):
+        # test the binary container reproduces the compressed embedding
+        container_file = "./test_embed.sfry"
+        for n_bit, group_size in [(2, None), (3, None), (32, None), (4, 8)]:
+            for mmap in [True, False]:
+                n_dim = np.random.randint(low=1, high=100)
+                n_word = np.random.randint(low=2, high=100)
+                embedding = QuantEmbedding(
+                    num_embeddings=n_word,
+                    embedding_dim=n_dim,
+                    padding_idx=1,
+                    nbit=n_bit,
+                    _weight=torch.FloatTensor(np.random.rand(n_word, n_dim)),
+                    group_size=group_size)
+                vocab = ["x" + str(i) for i in range(n_word)]
+                embedding.save(container_file, vocab=vocab)
+                loaded = QuantEmbedding.from_file(container_file, mmap=mmap)
+                assert loaded.vocab == vocab
+                assert loaded.nbit == n_bit
+                assert loaded.padding_idx == 1
+                assert loaded.embedding_dim == n_dim
+                assert torch.all(torch.eq(loaded.weight, embedding.weight))
+                input = torch.LongTensor(3, 11).random_(to=n_word)
+                assert torch.all(torch.eq(loaded(input), embedding(input)))
+                del loaded
+        os.remove(container_file)
+
+    def test_benchmark_quick(self):
+        # smoke test of the benchmark harness
+        import benchmark
+        out_file = "./test_bench.json"
+        assert benchmark.main(["--quick", "--out", out_file]) == 0
+        with open(out_file) as f:
+            records = json.load(f)["records"]
+        assert set(r["benchmark"] for r in records) == set(
+            ["forward", "packing", "compress", "file_load"])
+        for r in records:
+            # every case runs in its own process
+            assert 0 <= r["results"]["rss_increase_bytes"] <= r["results"][
+                "peak_rss_bytes"]
+        assert benchmark.main(
+            ["--quick", "--out", out_file, "--compare", out_file,
+             "--threshold", "1e9"]) == 0
+        os.remove(out_file)
+
     def forward(self, cuda=False):
         config_list = [("load quantized file as input test ", {
             "quantized_input": True,
@@ -0,0 +1,191 @@
+import torch
+import math
+import time
+import queue
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+
+##################################################################
+# Micro-batching lookup service. Concurrent lookup requests are
+# coalesced into a single forward call of the embedding module
+# (e.g. a QuantEmbedding), and every caller gets its own rows back.
+##################################################################
+Request = collections.namedtuple("Request", ["ids", "future"])
+# queued by close to stop the dispatcher
+_STOP = object()
+
+
+def _bucket(size):
+    """ power of two histogram bucket (upper bound) of size """
+    return 1 if size <= 1 else 2**math.ceil(math.log2(size))
+
+
+class BatchingEmbeddingServer(object):
+    def __init__(self, module, max_batch_size=4096, max_wait=0.002,
+                 n_threads=1):
+        """
+        Serve lookups of the embedding module (called as module(ids) on a
+        1D LongTensor) from many concurrent callers. A dispatcher thread
+        waits for the first pending request, then gathers more requests
+        until the batch holds max_batch_size ids or max_wait seconds have
+        passed since the first one arrived; requests larger than
+        max_batch_size are served alone. The batches are decoded on a
+        pool of n_threads threads; while all of them are busy, requests
+        accumulate into the next batch.
+        lookup is the blocking (threaded) API and lookup_async the asyncio
+        one. stats returns the queue depth and batch size histograms.
+        """
+        self.module = module
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_threads)
+        self._slots = threading.Semaphore(n_threads)
+        self._carry = None
+        self._closed = False
+        # makes the closed check and the enqueueing of submit atomic with
+        # respect to close, so no request is queued behind _STOP
+        self._submit_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "n_requests": 0,
+            "n_batches": 0,
+            "max_queue_depth": 0,
+            "queue_depth": collections.Counter(),
+            "batch_requests": collections.Counter(),
+            "batch_ids": collections.Counter(),
+        }
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="smallfry-batching", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, ids):
+        """
+        Queue the lookup of the LongTensor ids (any shape) and return a
+        concurrent.futures.Future of the [*ids.shape, embedding_dim] rows.
+        """
+        # the dispatcher thread must only see valid requests
+        if not isinstance(ids, torch.Tensor) or ids.dtype not in (
+                torch.int64, torch.int32):
+            raise Exception("The ids should be an int64 or int32 tensor!")
+        future = concurrent.futures.Future()
+        with self._submit_lock:
+            if self._closed:
+                raise Exception("The embedding server is closed!")
+            self._queue.put(Request(ids, future))
+        return future
+
+    def lookup(self, ids, timeout=None):
+        """ blocking lookup of ids, see submit """
+        return self.submit(ids).result(timeout)
+
+    async def lookup_async(self, ids):
+        """ asyncio lookup of ids, see submit """
+        return await asyncio.wrap_future(self.submit(ids))
+
+    def _next_batch(self):
+        """ block for the first request, then collect a batch of requests """
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            first = self._queue.get()
+        if first is _STOP:
+            return None
+        deadline = time.perf_counter() + self.max_wait
+        # wait for a free decoding thread, requests keep queuing meanwhile
+        self._slots.acquire()
+        batch = [first]
+        n_ids = first.ids.numel()
+        while n_ids < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = (self._queue.get_nowait() if remaining <= 0 else
+                           self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if request is _STOP or (
+                    n_ids + request.ids.numel() > self.max_batch_size):
+                # serve it (or stop) after this batch
+                self._carry = request
+                break
+            batch.append(request)
+            n_ids += request.ids.numel()
+        self._record(batch, n_ids)
+        return batch
+
+    def _record(self, batch, n_ids):
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            stats = self._stats
+            stats["n_requests"] += len(batch)
+            stats["n_batches"] += 1
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], depth)
+            stats["queue_depth"][_bucket(depth)] += 1
+            stats["batch_requests"][_bucket(len(batch))] += 1
+            stats["batch_ids"][_bucket(n_ids)] += 1
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            self._pool.submit(self._run_batch, batch)
+        # fail the requests left behind by close
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if request is not _STOP:
+                request.future.set_exception(
+                    Exception("The embedding server is closed!"))
+
+    def _run_batch(self, batch):
+        try:
+            ids = torch.cat([request.ids.reshape(-1) for request in batch])
+            with torch.no_grad():
+                rows = self.module(ids)
+            start = 0
+            for request in batch:
+                n = request.ids.numel()
+                request.future.set_result(
+                    rows[start:start + n].view(*request.ids.shape, -1))
+                start += n
+        except Exception as e:
+            logging.exception("Embedding lookup batch failed")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """
+        Returns the number of served requests and batches, the current and
+        maximal queue depth, and histograms (dicts from the power of two
+        upper bound of a bucket to its count) of the queue depth at batch
+        formation and of the number of requests and ids per batch.
+        """
+        with self._stats_lock:
+            stats = {key: dict(value) if isinstance(value, dict) else value
+                     for key, value in self._stats.items()}
+        stats["current_queue_depth"] = self._queue.qsize()
+        return stats
+
+    def close(self):
+        """ serve the queued requests and stop the server """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -0,0 +1,215 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+import numpy as np
+import math
+import logging
+from smallfry import compress
+from smallfry.quant_embedding import QuantEmbedding
+from smallfry.quant_embedding import RANGE_SAMPLE_ROWS
+
+##################################################################
+# Row-sharded quantized embedding over torch.distributed. Rank r
+# holds the contiguous rows shard_range(num_embeddings, r, world_size)
+# as a local QuantEmbedding; every rank holds the same value_list.
+##################################################################
+def shard_range(num_embeddings, rank, world_size):
+    """ returns the (row_start, row_end) rows held by rank """
+    rows_per_shard = math.ceil(num_embeddings / world_size)
+    row_start = min(rank * rows_per_shard, num_embeddings)
+    return row_start, min(row_start + rows_per_shard, num_embeddings)
+
+def _all_gather_rows(rows, group=None):
+    """
+    all_gather float32 2D tensors with different numbers of rows, the
+    collectives run on the device of rows
+    """
+    world_size = dist.get_world_size(group)
+    device = rows.device
+    n_rows = [torch.zeros(1, dtype=torch.int64, device=device)
+              for _ in range(world_size)]
+    dist.all_gather(n_rows, torch.tensor([rows.size(0)], device=device),
+                    group=group)
+    n_rows = [int(n) for n in n_rows]
+    padded = torch.zeros(max(n_rows), rows.size(1), device=device)
+    padded[:rows.size(0)] = rows
+    gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded, group=group)
+    return torch.cat([g[:n] for g, n in zip(gathered, n_rows)])
+
+def find_shared_range(weight, nbit, group=None):
+    """
+    Clipping range of the quantization shared by all the shards. Every
+    rank contributes a random sample of its rows (weight) and the range
+    is searched on rank 0 over the gathered sample, then shared. The
+    collectives run on the device of weight (e.g. a GPU for nccl).
+    """
+    world_size = dist.get_world_size(group)
+    n_sample = min(weight.size(0), math.ceil(RANGE_SAMPLE_ROWS / world_size))
+    rows = torch.from_numpy(np.sort(np.random.choice(
+        weight.size(0), n_sample, replace=False))).to(weight.device)
+    sample = _all_gather_rows(weight[rows].float(), group)
+    range_limit = torch.zeros(1, dtype=torch.float64, device=weight.device)
+    if dist.get_rank(group) == 0:
+        range_limit[0] = compress.find_optimal_range(
+            sample.cpu().numpy(), nbit, stochastic_round=False,
+            oracle="auto")
+    # only rank 0 holds a non zero range
+    dist.all_reduce(range_limit, group=group)
+    return float(range_limit[0])
+
+
+class ShardedQuantEmbedding(nn.Module):
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 padding_idx=None,
+                 _weight=None,
+                 nbit=32,
+                 group=None,
+                 _shard=None,
+                 **kwargs):
+        """
+        QuantEmbedding whose rows are split across the ranks of the
+        process group group (the default group if None). Rank r holds
+        rows shard_range(num_embeddings, r, world_size) and _weight is
+        the float tensor of these rows only, so the full table never has
+        to fit on one host. The quantization range is searched once over
+        a sample of all the shards (see find_shared_range) so that every
+        shard shares value_list; with group_size each row has its own
+        scales anyway. The other keyword arguments are passed to the
+        local QuantEmbedding (decode, packing, group_size, dtype, ...).
+        forward is a collective: every rank has to call it (possibly
+        with an empty input). The ids are routed to the ranks holding
+        them, which send back their packed rows (and group scales); the
+        rows are decoded by the requesting rank, so only packed bytes are
+        exchanged. Any backend supporting all_to_all_single (e.g. gloo,
+        nccl) can be used; the collectives run on the device of _weight
+        (of the shard), which has to be a GPU for nccl.
+        padding_idx is passed, as a local row, to the shard holding it.
+        """
+        super(ShardedQuantEmbedding, self).__init__()
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        if padding_idx is not None and padding_idx < 0:
+            padding_idx += num_embeddings
+        self.padding_idx = padding_idx
+        self.row_start, self.row_end = shard_range(
+            num_embeddings, self.rank, self.world_size)
+        if _shard is not None:
+            self.shard = _shard
+            return
+        assert _weight is not None, "Should provide the rows of this shard!"
+        if _weight.shape[0] != self.row_end - self.row_start:
+            raise Exception("_weight should hold rows " + str(self.row_start) +
+                            " to " + str(self.row_end) + " of the embedding")
+        if nbit != 32 and kwargs.get("group_size") is None and (
+                kwargs.get("range_limit") is None):
+            kwargs["range_limit"] = find_shared_range(_weight, nbit, group)
+        self.shard = QuantEmbedding(
+            num_embeddings=self.row_end - self.row_start,
+            embedding_dim=embedding_dim,
+            padding_idx=self._local_padding_idx(),
+            _weight=_weight,
+            nbit=nbit,
+            **kwargs)
+
+    @classmethod
+    def from_file(cls, file_name, group=None, decode="auto", dtype=None):
+        """
+        Build the shard of this rank from a file written by
+        QuantEmbedding.save. The file is memory-mapped, only the rows of
+        the shard are read and copied.
+        """
+        full = QuantEmbedding.from_file(
+            file_name, mmap=True, decode=decode, dtype=dtype)
+        module = cls(full.num_embeddings, full.embedding_dim,
+                     padding_idx=full.padding_idx, group=group, _shard=full)
+        rows = slice(module.row_start, module.row_end)
+        full.weight = nn.Parameter(full.weight[rows].clone(),
+                                   requires_grad=False)
+        if full.group_size is not None:
+            full.group_scales = full.group_scales[rows].clone()
+        full.num_embeddings = module.row_end - module.row_start
+        full.padding_idx = module._local_padding_idx()
+        full.vocab = None
+        logging.info("Loaded rows " + str(module.row_start) + " to " +
+                     str(module.row_end) + " of " + file_name)
+        return module
+
+    def _local_padding_idx(self):
+        """ the shard row of padding_idx, None if another rank holds it """
+        if self.padding_idx is None or not (
+                self.row_start <= self.padding_idx < self.row_end):
+            return None
+        return self.padding_idx - self.row_start
+
+    def _row_bytes(self):
+        """ bytes of a packed row and of its group scales """
+        shard = self.shard
+        row_bytes = shard.tensor_dim * shard.weight.element_size()
+        scale_bytes = 0
+        if shard.group_size is not None:
+            scale_bytes = (shard.group_scales.size(1) *
+                           shard.group_scales.element_size())
+        return row_bytes, scale_bytes
+
+    def _payload(self, ids):
+        """
+        uint8 [len(ids), row_bytes + scale_bytes] tensor of the packed
+        local rows ids, followed by their group scales
+        """
+        row_bytes, scale_bytes = self._row_bytes()
+        payload = [self.shard.weight[ids].view(torch.uint8).view(
+            ids.numel(), row_bytes)]
+        if scale_bytes > 0:
+            payload.append(self.shard.group_scales[ids].view(
+                torch.uint8).view(ids.numel(), scale_bytes))
+        return torch.cat(payload, dim=1)
+
+    def _decode_payload(self, payload):
+        """ decode the rows received from _payload """
+        shard = self.shard
+        n = payload.size(0)
+        row_bytes, _ = self._row_bytes()
+        packed = payload[:, :row_bytes].contiguous().view(shard.weight.dtype)
+        if shard.nbit == 32:
+            return packed
+        out = torch.empty(n, self.embedding_dim,
+                          dtype=shard._output_dtype(), device=payload.device)
+        shard._decode_packed(packed, out)
+        if shard.group_size is not None:
+            scales = payload[:, row_bytes:].contiguous().view(
+                shard.group_scales.dtype)
+            shard._apply_group_scales(out, scales)
+        return out
+
+    def forward(self, input):
+        assert self.shard.weight.requires_grad == False, " ShardedQuantEmbedding only support fixed embedding"
+        device = self.shard.weight.device
+        ids = input.reshape(-1).to(device)
+        # sorted unique ids are grouped by owner, each row is sent once
+        unique_ids, inverse = torch.unique(ids, return_inverse=True)
+        rows_per_shard = math.ceil(self.num_embeddings / self.world_size)
+        send_counts = torch.bincount(
+            unique_ids // rows_per_shard, minlength=self.world_size)
+        recv_counts = torch.empty_like(send_counts)
+        dist.all_to_all_single(recv_counts, send_counts, group=self.group)
+        send_counts, recv_counts = send_counts.tolist(), recv_counts.tolist()
+        requested = torch.empty(
+            sum(recv_counts), dtype=unique_ids.dtype, device=device)
+        dist.all_to_all_single(requested, unique_ids, recv_counts,
+                               send_counts, group=self.group)
+        payload = self._payload(requested - self.row_start)
+        received = torch.empty(
+            unique_ids.numel(), sum(self._row_bytes()), dtype=torch.uint8,
+            device=device)
+        dist.all_to_all_single(received, payload, send_counts, recv_counts,
+                               group=self.group)
+        rows = self._decode_payload(received)
+        return F.embedding(inverse, rows).view(*input.shape,
+                                               self.embedding_dim)
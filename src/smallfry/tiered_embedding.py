@@ -0,0 +1,105 @@
+import torch
+import torch.nn as nn
+import logging
+from smallfry.quant_embedding import QuantEmbedding
+
+##################################################################
+# Frequency-aware mixed-precision rows. The rows of one vocabulary
+# are ranked by frequency and split into consecutive precision
+# tiers (e.g. 8 bits for the head and 1 bit for the tail); every
+# tier is a QuantEmbedding with its own packed rows and value_list.
+##################################################################
+class TieredQuantEmbedding(nn.Module):
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 padding_idx=None,
+                 _weight=None,
+                 tiers=((4096, 8), (None, 2)),
+                 frequencies=None,
+                 **kwargs):
+        """
+        tiers is a list of (n_rows, nbit), from the most to the least
+        frequent rows; the n_rows of the last tier may be None for the
+        remaining rows. The rows are ranked by frequencies (a
+        [num_embeddings] tensor of counts) or, without it, by the
+        vocabulary order (row 0 being the most frequent, as in frequency
+        sorted vocabularies). _weight is the float embedding. The other
+        keyword arguments are passed to the QuantEmbedding of every tier
+        (decode, packing, group_size, dtype, ...).
+        Without frequencies the tiers are ranges of ids; with them, the
+        rank of every id is stored as an int32 map (4 bytes per row).
+        padding_idx is passed, as a local row, to the tier holding it.
+        """
+        super(TieredQuantEmbedding, self).__init__()
+        assert _weight is not None, "Should provide the float embedding!"
+        assert list(_weight.shape) == [num_embeddings, embedding_dim]
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        if padding_idx is not None and padding_idx < 0:
+            padding_idx += num_embeddings
+        self.padding_idx = padding_idx
+        tier_rows = [n_rows for n_rows, _ in tiers]
+        if tier_rows[-1] is None:
+            tier_rows[-1] = num_embeddings - sum(tier_rows[:-1])
+        if any(n_rows <= 0 for n_rows in tier_rows) or (
+                sum(tier_rows) != num_embeddings):
+            raise Exception("The tiers should hold the " +
+                            str(num_embeddings) + " rows of the embedding!")
+        weight = _weight.detach()
+        if frequencies is None:
+            self.row_rank = None
+        else:
+            order = torch.as_tensor(frequencies, dtype=torch.float32).to(
+                weight.device).argsort(descending=True)
+            row_rank = torch.empty(
+                num_embeddings, dtype=torch.int32, device=weight.device)
+            row_rank[order] = torch.arange(
+                num_embeddings, dtype=torch.int32, device=weight.device)
+            self.register_buffer("row_rank", row_rank)
+            weight = weight[order]
+        self.register_buffer("tier_ends", torch.cumsum(
+            torch.LongTensor(tier_rows), dim=0).to(weight.device))
+        padding_rank = padding_idx
+        if padding_idx is not None and self.row_rank is not None:
+            padding_rank = int(self.row_rank[padding_idx])
+        self.tiers = nn.ModuleList()
+        start = 0
+        for n_rows, (_, nbit) in zip(tier_rows, tiers):
+            local_padding_idx = None
+            if padding_rank is not None and (
+                    start <= padding_rank < start + n_rows):
+                local_padding_idx = padding_rank - start
+            self.tiers.append(QuantEmbedding(
+                num_embeddings=n_rows,
+                embedding_dim=embedding_dim,
+                padding_idx=local_padding_idx,
+                _weight=weight[start:start + n_rows],
+                nbit=nbit,
+                **kwargs))
+            start += n_rows
+        logging.info("Tiered embedding with " + str(self.bits_per_entry()) +
+                     " bits per entry")
+
+    def bits_per_entry(self):
+        """ average number of bits per entry of the state dict """
+        n_bytes = sum(v.element_size() * v.nelement()
+                      for v in self.state_dict().values())
+        return 8 * n_bytes / (self.num_embeddings * self.embedding_dim)
+
+    def forward(self, input):
+        ids = input.reshape(-1)
+        rank = ids if self.row_rank is None else self.row_rank[ids].long()
+        tier = torch.bucketize(rank, self.tier_ends, right=True)
+        out = torch.empty(ids.numel(), self.embedding_dim,
+                          dtype=self.tiers[0]._output_dtype(),
+                          device=ids.device)
+        start = 0
+        for i, module in enumerate(self.tiers):
+            selected = (tier == i).nonzero().view(-1)
+            if selected.numel() > 0:
+                # one gather (and decode) of the rows of each tier
+                out.index_copy_(0, selected, module(
+                    rank[selected] - start).to(out.dtype))
+            start = int(self.tier_ends[i])
+        return out.view(*input.shape, self.embedding_dim)
@@ -11,6 +11,7 @@ import subprocess
 import argparse
 import numpy as np
 import getpass
+import itertools
 
 
 def load_embeddings(path):
@@ -34,6 +35,34 @@ def load_embeddings(path):
     logging.info('Finished loading embeddings')
     return embeddings, wordlist
 
+def iter_embedding_chunks(path, dim, chunk_size=8192):
+    """
+    Streams a GloVe or FastText format embedding file in blocks of at most
+    chunk_size lines. Yields (wordlist, embeddings) tuples where embeddings
+    is a [len(wordlist), dim] float64 numpy matrix, so only one block is
+    held in memory at a time.
+    """
+    with open(path, 'r', encoding='utf8') as f:
+        first_block = True
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if first_block and lines and is_fasttext_format(lines):
+                lines = lines[1:]
+            first_block = False
+            if not lines:
+                break
+            wordlist = []
+            values = []
+            for line in lines:
+                word, _, value_str = line.rstrip('\n').partition(' ')
+                wordlist.append(word)
+                values.append(value_str)
+            embeddings = np.fromstring(' '.join(values), dtype=np.float64, sep=' ')
+            if embeddings.size != len(wordlist) * dim:
+                raise Exception(
+                    "Dimensionality in embedding file does not match dimensionality specified for embedding layer")
+            yield wordlist, embeddings.reshape(len(wordlist), dim)
+
 def get_embedding_dimension(embed_path):
     with open(embed_path) as f_embed:
         for line in f_embed: